@@ -0,0 +1,111 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from ..Utils.ants_registration import ANTsRegistration
+
+
+def generate_phantom_pair(size: int, rng: np.random.RandomState) -> tuple:
+    """
+    Creates a synthetic fixed volume made of nested ellipsoids, and a moving volume obtained through a smooth
+    non-linear deformation and an offset of the fixed volume, together with an annotation of the moving volume.
+    """
+    grid = np.stack(np.meshgrid(*[np.linspace(-1., 1., size)] * 3, indexing='ij'))
+
+    def phantom(coords):
+        volume = np.zeros(coords.shape[1:], dtype='float32')
+        for radii, intensity in [[(0.8, 0.9, 0.7), 100.], [(0.5, 0.6, 0.4), 250.], [(0.15, 0.2, 0.15), 400.]]:
+            volume[sum((c / r) ** 2 for c, r in zip(coords, radii)) <= 1.] = intensity
+        return volume
+
+    fixed = phantom(grid)
+    offset = rng.uniform(-0.08, 0.08, size=3)
+    displacement = 0.06 * np.sin(np.pi * grid[[1, 2, 0]]) + offset[:, None, None, None]
+    moving = phantom(grid + displacement) + rng.normal(0., 2., size=fixed.shape).astype('float32')
+    label = (moving > 325.).astype('uint8')
+    return fixed, moving, label
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the composite displacement field against the chain of '
+                                                 'registration transforms, for repeated warps.')
+    parser.add_argument('--fixed', type=str, default=None, help='Fixed volume, a synthetic phantom if not provided')
+    parser.add_argument('--moving', type=str, default=None, help='Moving volume, a synthetic phantom if not provided')
+    parser.add_argument('--label', type=str, default=None, help='Annotation of the moving volume, thresholded from '
+                                                                'the moving volume if not provided')
+    parser.add_argument('--size', type=int, default=96, help='Grid size of the synthetic phantoms')
+    parser.add_argument('--repeats', type=int, default=10, help='Number of repeated warps of the volume and label')
+    parser.add_argument('--tolerance', type=float, default=0.01,
+                        help='Maximum mean absolute intensity difference, relative to the intensity range')
+    parser.add_argument('--label-tolerance', type=float, default=0.005,
+                        help='Maximum fraction of the annotation voxels differing between both warps')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import ants
+    working_folder = tempfile.mkdtemp(prefix='composite_benchmark_')
+    try:
+        fixed_fn, moving_fn, label_fn = args.fixed, args.moving, args.label
+        if fixed_fn is None or moving_fn is None:
+            fixed, moving, label = generate_phantom_pair(args.size, np.random.RandomState(args.seed))
+            fixed_fn, moving_fn, label_fn = [os.path.join(working_folder, x + '.nii.gz')
+                                             for x in ['fixed', 'moving', 'label']]
+            for fn, data in zip([fixed_fn, moving_fn, label_fn], [fixed, moving, label]):
+                nib.save(nib.Nifti1Image(data, np.eye(4)), fn)
+        elif label_fn is None:
+            moving_ni = nib.load(moving_fn)
+            moving = moving_ni.get_fdata()
+            label_fn = os.path.join(working_folder, 'label.nii.gz')
+            nib.save(nib.Nifti1Image((moving > np.percentile(moving, 99)).astype('uint8'), moving_ni.affine), label_fn)
+
+        start = time.perf_counter()
+        reg_transform = ants.registration(ants.image_read(fixed_fn), ants.image_read(moving_fn), 'SyN',
+                                          outprefix=os.path.join(working_folder, 'reg_'))
+        print('Registration computed in {:.1f} s.'.format(time.perf_counter() - start))
+
+        results = {}
+        timings = {}
+        for mode in ['chain', 'composite']:
+            runner = ANTsRegistration(registration_folder=os.path.join(working_folder, mode))
+            runner.reg_transform = {'fwdtransforms': reg_transform['fwdtransforms'],
+                                    'invtransforms': reg_transform['invtransforms']}
+            runner.composite_warp = mode == 'composite'
+            runner.composite_folder = os.path.join(working_folder, mode + '_composite')
+            start = time.perf_counter()
+            if runner.composite_warp:
+                runner.get_composite_transform(fixed_fn)
+                runner.get_composite_transform(moving_fn, inverse=True)
+            timings[mode + ' build'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                warped = runner.apply_registration_transforms(moving=[moving_fn, label_fn], fixed=fixed_fn,
+                                                              interpolations=['linear', 'nearestNeighbor'])
+                inverse = runner.apply_registration_inverse_transform(moving=warped[1], fixed=moving_fn,
+                                                                      label='label')
+            timings[mode] = time.perf_counter() - start
+            results[mode] = [nib.load(x).get_fdata() for x in warped + [inverse]]
+
+        intensity_range = np.ptp(results['chain'][0])
+        volume_error = np.mean(np.abs(results['chain'][0] - results['composite'][0])) / intensity_range
+        label_errors = [np.count_nonzero(results['chain'][i] != results['composite'][i]) /
+                        max(1, np.count_nonzero(results['chain'][i])) for i in [1, 2]]
+        print('Mean absolute intensity difference: {:.5f} of the intensity range.'.format(volume_error))
+        print('Differing annotation voxels: {:.5f} (forward), {:.5f} (inverse).'.format(*label_errors))
+        for k in timings:
+            print('{}: {:.3f} s'.format(k, timings[k]))
+        print('Speed-up over {} repeats: x{:.2f} (x{:.2f} including the composite build)'.format(
+            args.repeats, timings['chain'] / timings['composite'],
+            timings['chain'] / (timings['composite'] + timings['composite build'])))
+        if volume_error > args.tolerance or max(label_errors) > args.label_tolerance:
+            raise ValueError('Warped outputs mismatch between the transforms chain and the composite transform.')
+    finally:
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
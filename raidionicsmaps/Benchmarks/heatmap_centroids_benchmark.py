@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+import scipy.ndimage.measurements as smeas
+from scipy.ndimage import measurements
+from skimage.measure import regionprops
+
+from ..Computation.heatmap_computation_processor import compute_foci_centroids
+
+
+def reference_foci_centroids(labels: np.ndarray, voxel_volume: float) -> list:
+    """
+    Former implementation, allocating and scanning a full atlas-sized volume for each foci, kept as reference.
+    """
+    tumor_clusters = measurements.label(labels)[0]
+    tumor_clusters_labels = regionprops(tumor_clusters)
+    tumor_clusters_labels = sorted(tumor_clusters_labels, key=lambda r: r.area, reverse=True)
+
+    centroids = []
+    for clus in tumor_clusters_labels:
+        clus_volume_ml = clus.area * voxel_volume * 1e-3
+        if clus_volume_ml >= 0.1:
+            clus_lab = np.zeros(labels.shape)
+            clus_lab[tumor_clusters == clus.label] = 1
+            centroids.append(smeas.center_of_mass(clus_lab))
+    return centroids
+
+
+def generate_multifocal_mask(shape: tuple, nb_foci: int, rng: np.random.RandomState) -> np.ndarray:
+    """
+    Creates a synthetic annotation mask made of spherical foci with random centers and radii.
+    """
+    labels = np.zeros(shape, dtype='uint8')
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for f in range(nb_foci):
+        radius = rng.randint(3, 15)
+        center = [rng.randint(radius, s - radius) for s in shape]
+        labels[sum((g - c) ** 2 for g, c in zip(grid, center)) <= radius ** 2] = 1
+    return labels
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the foci centroids extraction used for the heatmaps.')
+    parser.add_argument('--patients', type=int, default=20, help='Number of synthetic patients')
+    parser.add_argument('--foci', type=int, default=5, help='Maximum number of foci per patient')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Default MNI ICBM152 2009a grid
+    shape = (197, 233, 189)
+    rng = np.random.RandomState(args.seed)
+    cohort = [generate_multifocal_mask(shape, rng.randint(1, args.foci + 1), rng) for _ in range(args.patients)]
+
+    timings = {'reference': 0., 'vectorised': 0.}
+    for labels in cohort:
+        start = time.perf_counter()
+        reference_foci_centroids(labels, voxel_volume=1.)
+        timings['reference'] += time.perf_counter() - start
+        start = time.perf_counter()
+        compute_foci_centroids(labels, voxel_volume=1.)
+        timings['vectorised'] += time.perf_counter() - start
+
+    for k in timings:
+        print('{}: {:.3f} s total, {:.1f} ms per patient'.format(k, timings[k], 1000. * timings[k] / args.patients))
+    print('Speed-up: x{:.1f}'.format(timings['reference'] / timings['vectorised']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import nibabel as nib
+
+from ..Utils.ants_registration import ANTsRegistration, REGISTRATION_PRESETS
+from .composite_warp_benchmark import generate_phantom_pair
+
+
+def compute_dice(a: np.ndarray, b: np.ndarray) -> float:
+    """
+    Dice overlap between two binary masks.
+    """
+    a = a > 0
+    b = b > 0
+    total = np.count_nonzero(a) + np.count_nonzero(b)
+    return 1. if total == 0 else 2. * np.count_nonzero(a & b) / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the registration presets, reporting the wall time and '
+                                                 'the Dice overlap of the warped annotations against syn-full.')
+    parser.add_argument('--patients', type=int, default=5, help='Number of synthetic patients')
+    parser.add_argument('--size', type=int, default=96, help='Grid size of the synthetic phantoms')
+    parser.add_argument('--presets', type=str, default=','.join(REGISTRATION_PRESETS.keys()),
+                        help='Comma-separated list of presets to benchmark, syn-full always being included')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    presets = [x.strip() for x in args.presets.split(',') if x.strip() != '' and x.strip() != 'syn-full']
+    presets = ['syn-full'] + presets
+    working_folder = tempfile.mkdtemp(prefix='presets_benchmark_')
+    rng = np.random.RandomState(args.seed)
+    try:
+        timings = {p: [] for p in presets}
+        dices_reference = {p: [] for p in presets}
+        dices_truth = {p: [] for p in presets}
+        for i in range(args.patients):
+            fixed, moving, label = generate_phantom_pair(args.size, rng)
+            fixed_fn, moving_fn, label_fn = [os.path.join(working_folder, '{}_{}.nii.gz'.format(x, i))
+                                             for x in ['fixed', 'moving', 'label']]
+            for fn, data in zip([fixed_fn, moving_fn, label_fn], [fixed, moving, label]):
+                nib.save(nib.Nifti1Image(data, np.eye(4)), fn)
+            # Annotation of the fixed phantom, which a perfect registration would recover.
+            truth = fixed > 325.
+
+            reference = None
+            for preset in presets:
+                runner = ANTsRegistration(registration_folder=os.path.join(working_folder, '{}_{}'.format(preset, i)))
+                start = time.perf_counter()
+                runner.compute_registration(moving=moving_fn, fixed=fixed_fn, registration_method=preset)
+                warped_fn = runner.apply_registration_transforms(moving=[label_fn], fixed=fixed_fn,
+                                                                 interpolations=['nearestNeighbor'])[0]
+                timings[preset].append(time.perf_counter() - start)
+                warped = nib.load(warped_fn).get_fdata()
+                if reference is None:
+                    reference = warped
+                dices_reference[preset].append(compute_dice(warped, reference))
+                dices_truth[preset].append(compute_dice(warped, truth))
+                runner.clear_cache()
+            print('Patient {}/{} done.'.format(i + 1, args.patients))
+
+        print('{:<12}{:>16}{:>20}{:>20}'.format('Preset', 'Wall time (s)', 'Dice vs syn-full', 'Dice vs truth'))
+        for preset in presets:
+            print('{:<12}{:>16.2f}{:>20.4f}{:>20.4f}'.format(preset, np.mean(timings[preset]),
+                                                              np.mean(dices_reference[preset]),
+                                                              np.mean(dices_truth[preset])))
+    finally:
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
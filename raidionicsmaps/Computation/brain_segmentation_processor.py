@@ -0,0 +1,272 @@
+import os
+import glob
+import shutil
+import logging
+import traceback
+import configparser
+from typing import List
+import numpy as np
+from tqdm import tqdm
+
+from ..Utils.resources import SharedResources
+from ..Utils.staging import stage_file
+
+
+class BrainSegmentationProcessor:
+    """
+    Cohort-level brain segmentation, performed before the registration for all patients without a brain mask.
+    Instead of a one-patient segmentation inside the registration pipeline of each patient, the MRI_Brain model is
+    loaded once and run on CPU over batches of pre-processed patients, the batch size bounding the memory footprint.
+    The brain mask of each patient is saved inside its output folder, as input_brain_mask.nii.gz, where the
+    registration picks it up. Patients whose batch could not be segmented are left to the registration pipeline.
+    """
+    _cohort = None  # Placeholder for all loaded patients belonging to the cohort of interest
+    _batch_size = 4  # Number of patients segmented together
+    _model_name = "MRI_Brain"  # Segmentation model, inside the models folder
+    _scratch_folder = None  # Folder holding the inputs and outputs of the segmentation of each patient
+    # Runtime options given by raidionics_rads to raidionics_seg for the brain segmentation inside the registration
+    # pipeline, from the configuration filled in the RegistrationStep (rads defaults for the unspecified options).
+    _runtime_parameters = {'batch_size': '1', 'overlapping_ratio': '0.0', 'reconstruction_method': 'thresholding',
+                           'reconstruction_order': 'resample_first', 'use_preprocessed_data': 'False',
+                           'folds_ensembling': 'False', 'ensembling_strategy': 'average',
+                           'test_time_augmentation_iteration': '0', 'test_time_augmentation_fusion_mode': 'average'}
+
+    def __init__(self, batch_size: int = None):
+        self.__reset()
+        self._batch_size = batch_size if batch_size is not None else SharedResources.getInstance().maps_brain_segmentation_batch_size
+        self._scratch_folder = os.path.join(SharedResources.getInstance().maps_output_folder, '.scratch',
+                                            'brain_segmentation')
+
+    @property
+    def cohort(self):
+        return self._cohort
+
+    @cohort.setter
+    def cohort(self, input_cohort) -> None:
+        self._cohort = input_cohort
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cohort = None
+        self._batch_size = 4
+        self._model_name = "MRI_Brain"
+        self._scratch_folder = None
+
+    def setup(self, cohort) -> None:
+        """
+        :param cohort: Container for all loaded patients.
+        :return: None
+        """
+        self.cohort = cohort
+
+    def run(self) -> None:
+        """
+        Segments the brain of all patients still to be registered and without a brain mask, whose volume passed the
+        preflight check if performed. The mask filepath of each segmented patient is updated inside the cohort.
+        :return: None
+        """
+        patients = []
+        for p in self.cohort.patients:
+            pat = self.cohort.patients[p]
+            if pat.mask_filepath is not None and not self.cohort.is_file_validated(pat.mask_filepath):
+                # Unusable provided mask, according to the preflight check.
+                pat.mask_filepath = None
+            if pat.mask_filepath is not None or not self.cohort.is_file_validated(pat.volume_filepath):
+                continue
+            if len(pat.registrations.keys()) != 0 and pat.registered_label_filepath is not None:
+                continue
+            if os.path.exists(get_brain_mask_filepath(pat)):
+                pat.mask_filepath = get_brain_mask_filepath(pat)
+                continue
+            patients.append(p)
+        if len(patients) == 0:
+            return
+
+        model_folder = os.path.join(SharedResources.getInstance().system_models_folder, self._model_name)
+        if not os.path.exists(model_folder):
+            logging.warning("[BrainSegmentationProcessor] Model {} not found on disk, the brain segmentation is left "
+                            "to the registration pipeline.".format(self._model_name))
+            return
+
+        import onnxruntime as rt
+        options = rt.SessionOptions()
+        options.intra_op_num_threads = SharedResources.getInstance().get_jobs_budget(1)[1]
+        # Same fold selection as raidionics_seg, where all folds are only used when ensembling them.
+        models_path = sorted(glob.glob(os.path.join(model_folder, "**", "*")),
+                             key=lambda x: os.path.basename(os.path.dirname(x)))
+        if self._runtime_parameters['folds_ensembling'].lower() != 'true':
+            models_path = [models_path[0]]
+        models = [rt.InferenceSession(m, sess_options=options, providers=["CPUExecutionProvider"])
+                  for m in models_path]
+
+        segmented = 0
+        batches = [patients[i:i + self.batch_size] for i in range(0, len(patients), self.batch_size)]
+        for batch in tqdm(batches):
+            try:
+                segmented = segmented + self.__segment_batch([self.cohort.patients[p] for p in batch], models,
+                                                             models_path, model_folder)
+            except Exception as e:
+                logging.warning("[BrainSegmentationProcessor] Brain segmentation failed for patients {}, left to the "
+                                "registration pipeline, with: {}".format(
+                    [self.cohort.patients[p].patient_id for p in batch], traceback.format_exc()))
+            finally:
+                shutil.rmtree(self._scratch_folder, ignore_errors=True)
+        if os.path.exists(os.path.dirname(self._scratch_folder)) and \
+                len(os.listdir(os.path.dirname(self._scratch_folder))) == 0:
+            os.rmdir(os.path.dirname(self._scratch_folder))
+        logging.info("Brain segmentation of {} patients: {} segmented.".format(len(patients), segmented))
+
+    def __segment_batch(self, patients: List, models: List, models_path: List[str], model_folder: str) -> int:
+        """
+        Pre-processes all patients of the batch, runs each model fold once over the whole batch when the model works
+        on the full volume, and reconstructs each brain mask in its patient space.
+        :param patients: PatientStructure instances to segment.
+        :param models: Loaded ONNX inference session for each model fold in use.
+        :param models_path: Filepath of each model fold in use.
+        :param model_folder: Folder of the segmentation model, holding its pre_processing.ini.
+        :return: Number of patients of the batch successfully segmented.
+        """
+        from raidionicsseg.Utils.configuration_parser import ConfigResources
+        from raidionicsseg.PreProcessing.pre_processing import prepare_pre_processing
+        from raidionicsseg.Inference.predictions import run_predictions
+        from raidionicsseg.Inference.predictions_reconstruction import reconstruct_post_predictions
+        from raidionicsseg.Utils.io import dump_predictions
+
+        samples = []
+        for pat in patients:
+            folder = os.path.join(self._scratch_folder, pat.patient_id)
+            os.makedirs(os.path.join(folder, 'inputs'), exist_ok=True)
+            os.makedirs(os.path.join(folder, 'outputs'), exist_ok=True)
+            stage_file(pat.volume_filepath, os.path.join(folder, 'inputs', 'input0.nii.gz'))
+            # Same runtime parameters as for the segmentation inside the registration pipeline.
+            seg_config = configparser.ConfigParser()
+            seg_config.add_section('System')
+            seg_config.set('System', 'gpu_id', "-1")
+            seg_config.set('System', 'inputs_folder', os.path.join(folder, 'inputs'))
+            seg_config.set('System', 'output_folder', os.path.join(folder, 'outputs'))
+            seg_config.set('System', 'model_folder', model_folder)
+            seg_config.add_section('Runtime')
+            for k in self._runtime_parameters:
+                seg_config.set('Runtime', k, self._runtime_parameters[k])
+            seg_config_filename = os.path.join(folder, 'seg_config.ini')
+            with open(seg_config_filename, 'w') as outfile:
+                seg_config.write(outfile)
+            parameters = ConfigResources()
+            parameters.init_environment(seg_config_filename)
+            try:
+                nib_volume, fg_volume, resampled_volume, data, crop_bbox = prepare_pre_processing(
+                    folder=os.path.join(folder, 'inputs'), pre_processing_parameters=parameters,
+                    storage_path=os.path.join(folder, 'outputs'))
+            except Exception as e:
+                logging.warning("[BrainSegmentationProcessor] Pre-processing failed for patient {} with: {}".format(
+                    pat.patient_id, e))
+                continue
+            samples.append([pat, parameters, nib_volume, fg_volume, resampled_volume, data, crop_bbox, folder])
+        if len(samples) == 0:
+            return 0
+
+        parameters = samples[0][1]
+        if parameters.new_axial_size and len(parameters.new_axial_size) == 3 and \
+                parameters.predictions_test_time_augmentation_iterations == 0:
+            predictions = predict_whole_batch(models, np.concatenate([s[5] for s in samples], axis=0), parameters)
+        else:
+            # Slab or patch-wise models, or test time augmentation, are left to the per-patient inference of
+            # raidionics_seg.
+            predictions = [run_predictions(data=s[5], models_path=models_path, parameters=s[1]) for s in samples]
+
+        segmented = 0
+        for s, pred in zip(samples, predictions):
+            pat, parameters, nib_volume, fg_volume, resampled_volume, _, crop_bbox, folder = s
+            try:
+                final_predictions = reconstruct_post_predictions(predictions=pred, parameters=parameters,
+                                                                 crop_bbox=crop_bbox, nib_volume=nib_volume,
+                                                                 fg_volume=fg_volume,
+                                                                 resampled_volume=resampled_volume)
+                dump_predictions(predictions=final_predictions, parameters=parameters, nib_volume=nib_volume,
+                                 storage_path=os.path.join(folder, 'outputs'))
+                brain_filename = os.path.join(folder, 'outputs', 'labels_Brain.nii.gz')
+                if not os.path.exists(brain_filename):
+                    raise ValueError("No brain segmentation file found on disk.")
+                shutil.move(brain_filename, get_brain_mask_filepath(pat))
+                pat.mask_filepath = get_brain_mask_filepath(pat)
+                segmented = segmented + 1
+            except Exception as e:
+                logging.warning("[BrainSegmentationProcessor] Brain segmentation failed for patient {} with: {}".format(
+                    pat.patient_id, e))
+        return segmented
+
+
+def get_brain_mask_filepath(patient) -> str:
+    """
+    Location where the brain mask of a patient is saved by the cohort-level brain segmentation.
+    :param patient: PatientStructure instance.
+    :return: Filepath inside the patient output folder.
+    """
+    return os.path.join(patient.output_folderpath, 'input_brain_mask.nii.gz')
+
+
+def predict_whole_batch(models: List, data: np.ndarray, parameters) -> List[np.ndarray]:
+    """
+    Runs a full-volume segmentation model over a batch of pre-processed volumes at once, following the inference
+    of raidionics_seg for a single volume, with the same ensembling of the model folds.
+    :param models: Loaded ONNX inference session for each model fold in use.
+    :param data: Pre-processed volumes, stacked along the first (batch) axis.
+    :param parameters: raidionics_seg ConfigResources of the model.
+    :return: Predictions for each volume, as returned by raidionics_seg for the volume alone.
+    """
+    folds_predictions = [predict_whole_batch_fold(model, data, parameters) for model in models]
+    if not parameters.predictions_folds_ensembling:
+        return folds_predictions[0]
+
+    predictions = []
+    for i in range(data.shape[0]):
+        stacked = np.stack([fold[i] for fold in folds_predictions], axis=-1)
+        if parameters.predictions_ensembling_strategy == "maximum":
+            predictions.append(np.amax(stacked, axis=-1).astype("float32"))
+        else:
+            predictions.append(np.average(stacked, axis=-1).astype("float32"))
+    return predictions
+
+
+def predict_whole_batch_fold(model, data: np.ndarray, parameters) -> List[np.ndarray]:
+    """
+    Runs one fold of a full-volume segmentation model over a batch of pre-processed volumes at once.
+    :param model: Loaded ONNX inference session.
+    :param data: Pre-processed volumes, stacked along the first (batch) axis.
+    :param parameters: raidionics_seg ConfigResources of the model.
+    :return: Predictions of the fold for each volume.
+    """
+    if parameters.preprocessing_channels_order == "channels_first":
+        data = np.transpose(data, axes=(0, 4, 1, 2, 3))
+    if parameters.swap_training_input and parameters.preprocessing_channels_order == "channels_first":
+        data = np.transpose(data, axes=(0, 1, 4, 2, 3))
+    elif parameters.swap_training_input and parameters.preprocessing_channels_order == "channels_last":
+        data = np.transpose(data, axes=(0, 3, 1, 2, 4))
+
+    try:
+        predictions = model.run(None, {"input": data})[0]
+    except Exception as e:
+        # Models exported with a fixed batch size of one.
+        predictions = np.concatenate([model.run(None, {"input": data[i:i + 1]})[0] for i in range(data.shape[0])],
+                                     axis=0)
+
+    if parameters.preprocessing_channels_order == "channels_first":
+        predictions = np.transpose(predictions, axes=(0, 2, 3, 4, 1))
+    if parameters.swap_training_input:
+        predictions = np.transpose(predictions, axes=(0, 2, 3, 1, 4))
+
+    if not parameters.training_activation_layer_included:
+        from raidionicsseg.Utils.volume_utilities import final_activation
+        predictions = final_activation(predictions, act_type=parameters.training_activation_layer_type)
+
+    if parameters.training_deep_supervision or parameters.training_backend == "Torch":
+        return [predictions[i] for i in range(predictions.shape[0])]
+    # Otherwise, raidionics_seg keeps the batch axis of the first model output.
+    return [predictions[i:i + 1] for i in range(predictions.shape[0])]
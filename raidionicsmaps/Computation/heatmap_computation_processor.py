@@ -2,19 +2,24 @@ from __future__ import division
 
 import logging
 import traceback
-from typing import List
+from typing import List, Tuple, Union
 import numpy as np
+import json
 import csv
 import sys
 import os
+import shutil
 from copy import deepcopy
-import scipy.ndimage.measurements as smeas
-from scipy.ndimage import measurements
-from skimage.measure import regionprops
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scipy.ndimage import measurements, find_objects
 from tqdm import tqdm
 import nibabel as nib
 
 from ..Utils.resources import SharedResources
+from ..Utils.utils import get_peak_memory_usage, init_worker_threads
+from ..Utils.io import compute_file_fingerprint
+from ..Utils.mask_cache import MaskCache
+from ..Structures.HeatmapStructure import Heatmap, HeatmapShard, get_centroid_cube
 
 
 class HeatmapComputationProcessor:
@@ -26,10 +31,19 @@ class HeatmapComputationProcessor:
     _suffix = ""  # Specific name to append to the generated heatmap files
     _output_directory = None  # Overall directory designating the location where all the computed results are to be stored
     _output_folder = None
+    _workers = 1  # Number of parallel processes used to load the annotation masks and accumulate the heatmaps
+    _low_memory = False  # Whether to use integer accumulators sized to the cohort, and masks in their native dtype
+    _incremental = False  # Whether to persist the accumulators and only process the patients changed since the last run
+    _slab_thickness = None  # Number of atlas slices along the last axis processed at once, if streaming the heatmaps
 
-    def __init__(self, suffix=""):
+    def __init__(self, suffix="", workers: int = None, low_memory: bool = None, incremental: bool = None,
+                 slab_thickness: int = None):
         self.__reset()
         self._suffix = suffix
+        self._workers = workers if workers is not None else SharedResources.getInstance().maps_workers
+        self._low_memory = low_memory if low_memory is not None else SharedResources.getInstance().maps_low_memory
+        self._incremental = incremental if incremental is not None else SharedResources.getInstance().maps_incremental
+        self._slab_thickness = slab_thickness if slab_thickness is not None else SharedResources.getInstance().maps_slab_thickness
         self.output_directory = os.path.join(SharedResources.getInstance().maps_output_folder, 'Heatmaps')
         os.makedirs(self.output_directory, exist_ok=True)
         self.output_folder = os.path.join(self.output_directory, 'Overall')
@@ -67,6 +81,38 @@ class HeatmapComputationProcessor:
     def output_directory(self, s: str) -> None:
         self._output_directory = s
 
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @workers.setter
+    def workers(self, w: int) -> None:
+        self._workers = w
+
+    @property
+    def low_memory(self) -> bool:
+        return self._low_memory
+
+    @low_memory.setter
+    def low_memory(self, state: bool) -> None:
+        self._low_memory = state
+
+    @property
+    def incremental(self) -> bool:
+        return self._incremental
+
+    @incremental.setter
+    def incremental(self, state: bool) -> None:
+        self._incremental = state
+
+    @property
+    def slab_thickness(self) -> int:
+        return self._slab_thickness
+
+    @slab_thickness.setter
+    def slab_thickness(self, thickness: int) -> None:
+        self._slab_thickness = thickness
+
     @property
     def output_folder(self) -> str:
         return self._output_folder
@@ -85,6 +131,10 @@ class HeatmapComputationProcessor:
         self._suffix = ""
         self._output_directory = None
         self._output_folder = None
+        self._workers = 1
+        self._low_memory = False
+        self._incremental = False
+        self._slab_thickness = None
 
     def setup(self, cohort) -> None:
         """
@@ -98,6 +148,10 @@ class HeatmapComputationProcessor:
 
         for p in list(self.cohort.patients.keys()):
             mask_fn = self.cohort.patients[p].registered_label_filepath
+            if not (self.cohort.is_file_validated(self.cohort.patients[p].volume_filepath)
+                    and self.cohort.is_file_validated(mask_fn)):
+                # Already reported by the preflight stage.
+                continue
             if mask_fn is None or not os.path.exists(mask_fn):
                 logging.warning("Registered annotation mask missing for {}".format(self.cohort.patients[p].patient_id))
             else:
@@ -105,37 +159,83 @@ class HeatmapComputationProcessor:
 
     def run(self) -> None:
         """
-
-        :return:
+        Generates the location heatmaps for the complete cohort and for every sub-population defined by the dense and
+        categorical distribution parameters, in a single pass over the patients' annotation masks.
+        :return: None
         """
-        logging.info("Computing location heatmap for the complete cohort!")
-        self.__run()
+        logging.info("Computing location heatmaps for the complete cohort and all sub-populations!")
+        # Only the atlas header is needed, for the shape and affine of the heatmaps.
+        atlas_ni = nib.load(SharedResources.getInstance().mni_atlas_filepath_T1)
+        if self.slab_thickness is not None:
+            if self.incremental:
+                logging.warning("Incremental heatmaps are not supported when streaming, computing from scratch.")
+            thickness = min(self.slab_thickness, atlas_ni.shape[-1])
+            heatmaps = self.__define_populations(shape=(int(np.prod(atlas_ni.shape[:-1])) * thickness,))
+            self.__run_streaming(heatmaps=heatmaps, atlas_ni=atlas_ni)
+            peak_memory = get_peak_memory_usage()
+            if peak_memory is not None:
+                logging.info("Peak memory usage during the heatmaps computation: {:.1f} MB.".format(peak_memory))
+            return
+
+        heatmaps = self.__define_populations(shape=atlas_ni.shape)
+        mask_cache = MaskCache() if SharedResources.getInstance().mask_cache else None
+        if self.incremental:
+            self.__run_incremental(heatmaps=heatmaps, mask_cache=mask_cache)
+        else:
+            self.__run(heatmaps=heatmaps, mask_cache=mask_cache)
+        if mask_cache is not None:
+            mask_cache.evict()
+
+        for heatmap in heatmaps:
+            logging.info("Saving location heatmap for population {}.".format(heatmap.output_folder))
+            heatmap.dump_heatmaps_on_disk(atlas_ni)
+
+        peak_memory = get_peak_memory_usage()
+        if peak_memory is not None:
+            logging.info("Peak memory usage during the heatmaps computation: {:.1f} MB.".format(peak_memory))
+
+    def __define_populations(self, shape) -> List[Heatmap]:
+        """
+        Creates one heatmap accumulator for the complete cohort, and one for each sub-population defined by the dense
+        ranges and categorical values from the distribution parameters.
+        :param shape: Shape of the atlas space in which the heatmaps are computed.
+        :return: List of heatmaps, the first one always being for the complete cohort.
+        """
+        dtype = np.float64
+        pids_dtype = np.uint16
+        if self.low_memory:
+            # The cumulative counters can at most reach the number of patients in the cohort.
+            dtype = np.uint16 if len(self.cohort.patients) <= np.iinfo(np.uint16).max else np.uint32
+            pids_dtype = dtype
+        heatmaps = [Heatmap(uid=self.suffix, output_folder=self.output_folder, shape=shape, dtype=dtype,
+                            pids_dtype=pids_dtype)]
         for d in SharedResources.getInstance().maps_distribution_dense_parameters:
             params = [x.strip() for x in d.split(',')]
             thresholds = [float(x) for x in params[1].split('-')]
             limits = [None, thresholds[0]]
             rparams = [params[0], limits]
-            self._suffix = '_' + params[0] + '<' + str(thresholds[0])
-            self.output_folder = os.path.join(self.output_directory, 'Population' + self._suffix)
-            os.makedirs(self.output_folder, exist_ok=True)
-            logging.info("Computing location heatmap for patients with {} under {}".format(params[0], str(thresholds[0])))
-            self.__run(dense_parameters=rparams)
+            suffix = '_' + params[0] + '<' + str(thresholds[0])
+            logging.info("Including location heatmap for patients with {} under {}".format(params[0], str(thresholds[0])))
+            heatmaps.append(Heatmap(uid=suffix, output_folder=os.path.join(self.output_directory, 'Population' + suffix),
+                                    shape=shape, dense_parameters=rparams, dtype=dtype,
+                                    pids_dtype=pids_dtype))
             for i, thr in enumerate(thresholds[1:-1]):
                 limits = [thresholds[i-1], thr]
                 rparams = [params[0], limits]
-                self._suffix = '_' + params[0] + '_Range' + str(rparams[0]) + '_' + str(rparams[1])
-                self.output_folder = os.path.join(self.output_directory, 'Population' + self._suffix)
-                os.makedirs(self.output_folder, exist_ok=True)
+                suffix = '_' + params[0] + '_Range' + str(rparams[0]) + '_' + str(rparams[1])
                 logging.info(
-                    "Computing location heatmap for patients with {} in the range [{}, {}]".format(params[0], str(rparams[0]), str(rparams[1])))
-                self.__run(dense_parameters=rparams)
+                    "Including location heatmap for patients with {} in the range [{}, {}]".format(params[0], str(rparams[0]), str(rparams[1])))
+                heatmaps.append(Heatmap(uid=suffix,
+                                        output_folder=os.path.join(self.output_directory, 'Population' + suffix),
+                                        shape=shape, dense_parameters=rparams, dtype=dtype,
+                                        pids_dtype=pids_dtype))
             limits = [thresholds[-1], None]
             rparams = [params[0], limits]
-            self._suffix = '_' + params[0] + '>=' + str(thresholds[-1])
-            self.output_folder = os.path.join(self.output_directory, 'Population' + self._suffix)
-            os.makedirs(self.output_folder, exist_ok=True)
-            logging.info("Computing location heatmap for patients with {} over {}".format(params[0], str(thresholds[-1])))
-            self.__run(dense_parameters=rparams)
+            suffix = '_' + params[0] + '>=' + str(thresholds[-1])
+            logging.info("Including location heatmap for patients with {} over {}".format(params[0], str(thresholds[-1])))
+            heatmaps.append(Heatmap(uid=suffix, output_folder=os.path.join(self.output_directory, 'Population' + suffix),
+                                    shape=shape, dense_parameters=rparams, dtype=dtype,
+                                    pids_dtype=pids_dtype))
         for c in SharedResources.getInstance().maps_distribution_categorical_parameters:
             params = [x.strip() for x in c.split(',')]
             if params[1].strip() == '':
@@ -144,15 +244,46 @@ class HeatmapComputationProcessor:
                 cat = [params[1]]
             for cc in cat:
                 rparams = [params[0], cc]
-                self._suffix = '_' + params[0] + '-' + cc
-                self.output_folder = os.path.join(self.output_directory, 'Population' + self._suffix)
-                os.makedirs(self.output_folder, exist_ok=True)
-                logging.info("Computing location heatmap for patients with {} as {}".format(params[0], cc))
-                self.__run(cat_parameters=rparams)
-
-    def __run(self, dense_parameters=None, cat_parameters=None) -> None:
+                suffix = '_' + params[0] + '-' + cc
+                logging.info("Including location heatmap for patients with {} as {}".format(params[0], cc))
+                heatmaps.append(Heatmap(uid=suffix,
+                                        output_folder=os.path.join(self.output_directory, 'Population' + suffix),
+                                        shape=shape, categorical_parameters=rparams, dtype=dtype,
+                                        pids_dtype=pids_dtype))
+        return heatmaps
+
+    def __get_cohort_members(self, heatmaps: List[Heatmap]) -> List[list]:
+        """
+        Identifies all the populations each patient of the cohort belongs to, based on its extra parameters. The
+        memberships are computed for all patients at once, from the patient-indexed extra parameters of the cohort.
+        Patients missing from the extra parameters file only contribute to the overall heatmap, and are reported once.
+        :param heatmaps: List of all population heatmaps being computed.
+        :return: List of [patient, indices of the heatmaps to which the patient must contribute], following the cohort
+        order, for the patients not discarded by the preflight check.
         """
-        Generates the location heatmap for the cohort of interest, whereby six elements are created:
+        patients = [self.cohort.patients[p] for p in self.cohort.patients
+                    if self.cohort.is_file_validated(self.cohort.patients[p].volume_filepath)
+                    and self.cohort.is_file_validated(self.cohort.patients[p].registered_label_filepath)]
+        patient_ids = [x.patient_id for x in patients]
+        membership = np.ones((len(patients), len(heatmaps)), dtype=bool)
+        unmatched = np.zeros(len(patients), dtype=bool)
+        for h, heatmap in enumerate(heatmaps):
+            if heatmap.dense_parameters is None and heatmap.categorical_parameters is None:
+                continue
+            param_name = heatmap.dense_parameters[0] if heatmap.dense_parameters is not None else heatmap.categorical_parameters[0]
+            param_values, missing = self.cohort.get_patients_parameter(param_name, patient_ids)
+            membership[:, h] = heatmap.are_patients_included(param_values) & ~missing
+            unmatched |= missing
+
+        if np.any(unmatched):
+            logging.warning("{} patients missing from the extra parameters file, only included in the overall heatmap: "
+                            "{}".format(np.count_nonzero(unmatched),
+                                        ', '.join([x for x, m in zip(patient_ids, unmatched) if m])))
+        return [[patient, np.flatnonzero(membership[i]).tolist()] for i, patient in enumerate(patients)]
+
+    def __run(self, heatmaps: List[Heatmap], mask_cache: MaskCache = None) -> None:
+        """
+        Accumulates the location heatmaps for all populations of interest, whereby six elements are created for each:
             * heatmap_cumulative.nii.gz: for each voxel, the likelihood is expressed as the total number of patients featuring the object of interest in that location
             * heatmap_percentages.nii.gz: for each voxel, the likelihood is expressed as the percentages of patients featuring the object of interest in that location over the total number of patients in the cohort
             * heatmap_centroids_cumulative.nii.gz: same as the first file, except that only a 3x3x3 pixels centroid is used to represent each object of interest
@@ -160,112 +291,528 @@ class HeatmapComputationProcessor:
             * heatmap_patient_ids.nii.gz: (debug file) where the centroid of each object of interest is marked with the patient id, for an easier identification and correction of outliers
             * patients_ids_lut.csv: (debug file) a look-up-table is provided for mapping each patient internal id with the corresponding patient folder name.
         In the case of centroids generation with multifocal objects of interest, a centroid is created for each foci.
-        :param: dense_parameters
-        :param: cat_parameters
-        :return: Nothing, the appropriate files are saved on disk directly
+        Each annotation mask is loaded, and its foci identified, only once, before updating every population the
+        patient belongs to. If more than one worker is requested, the cohort is split into one contiguous shard of
+        patients per worker, each accumulated into dense partial heatmaps, and the partial heatmaps are merged back
+        following the patients order.
+        :param: heatmaps: Accumulators for all the populations of interest.
+        :param: mask_cache: Cache of compact annotation masks to read from, if any.
+        :return: Nothing, the accumulators are updated in-place
         """
-        atlas_ni = nib.load(SharedResources.getInstance().mni_atlas_filepath_T1)
-        atlas = atlas_ni.get_fdata()[:]
-        heatmap = np.zeros(atlas.shape)
-        heatmap_centroids = np.zeros(atlas.shape)
+        logging.info('Collecting data in memory...')
+        patients = []
+        for patient, members in self.__get_cohort_members(heatmaps=heatmaps):
+            if len(members) != 0:
+                patients.append([patient.registered_label_filepath, members])
+
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1 or len(patients) <= 1:
+            for fl, members in tqdm(patients):
+                contribution = load_patient_contribution(fl, shape=heatmaps[0].heatmap.shape,
+                                                         native_dtype=self.low_memory, mask_cache=mask_cache)
+                if contribution is not None:
+                    for m in members:
+                        heatmaps[m].include_patient(contribution[0], contribution[1])
+            return
+
+        # A single shard per worker, for the number of partial heatmaps held at once to be bounded by the workers.
+        shard_size = int(np.ceil(len(patients) / jobs))
+        shards = [patients[x:x + shard_size] for x in range(0, len(patients), shard_size)]
+        logging.info('Accumulating heatmaps over {} shards with {} workers.'.format(len(shards), jobs))
+        uids = [h.unique_id for h in heatmaps]
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker_threads,
+                                 initargs=(threads,)) as executor:
+            futures = [executor.submit(accumulate_heatmap_shard, patients=x, uids=uids,
+                                       shape=heatmaps[0].heatmap.shape, native_dtype=self.low_memory,
+                                       mask_cache=mask_cache) for x in shards]
+            # Reducing in the patients order, for the patient ids counter to match a serial computation, and
+            # releasing each partial heatmap once merged.
+            for i in tqdm(range(len(futures))):
+                for heatmap, shard in zip(heatmaps, futures[i].result()):
+                    heatmap.merge_shard(shard)
+                futures[i] = None
+
+
+    def __run_incremental(self, heatmaps: List[Heatmap], mask_cache: MaskCache = None) -> None:
+        """
+        Updates the location heatmaps from the accumulators saved during the previous run, by only loading the
+        annotation masks of the patients which are new or changed since then.
+        The voxels featuring the object of interest, and the foci centroids, are saved for each annotation mask inside
+        the Heatmaps/.state folder, such that the contribution of removed or changed patients can be subtracted.
+        The centroid heatmaps and patient ids are rebuilt from the saved centroids, following the patients order, for
+        the results to be identical to a computation from scratch.
+        A saved state is discarded if computed for a different atlas or annotation class.
+        :param: heatmaps: Accumulators for all the populations of interest.
+        :param: mask_cache: Cache of compact annotation masks to read from, if any.
+        :return: Nothing, the accumulators are updated in-place
+        """
+        state_folder = os.path.join(self.output_directory, '.state')
+        contributions_folder = os.path.join(state_folder, 'contributions')
+        os.makedirs(contributions_folder, exist_ok=True)
+        state_filename = os.path.join(state_folder, 'cohort_state.json')
+        atlas_fingerprint = compute_file_fingerprint(SharedResources.getInstance().mni_atlas_filepath_T1)["sha1"]
+        gt_files_suffix = SharedResources.getInstance().maps_gt_files_suffix
+
+        records = {}
+        if os.path.exists(state_filename):
+            try:
+                with open(state_filename, 'r') as infile:
+                    state = json.load(infile)
+                if state["atlas"] == atlas_fingerprint and state["gt_files_suffix"] == gt_files_suffix:
+                    records = state["patients"]
+                else:
+                    logging.warning("Discarding the heatmaps state computed for a different atlas or annotation class.")
+            except Exception as e:
+                logging.warning("Heatmaps state in {} could not be read, and is discarded.".format(state_filename))
 
-        # The pids are a simply ascending counter. Should a look-up-table between counter and patient_id be saved on disk?
-        heatmap_pids = np.zeros(atlas.shape).astype(np.uint16)
+        def contribution_filename(sha1: str) -> str:
+            return os.path.join(contributions_folder, sha1 + '.npy')
 
-        count = 0
-        logging.info('Collecting data in memory...')
-        for i, p in enumerate(tqdm(self.cohort.patients)):
-            patient = self.cohort.patients[p]
-            pid = patient.patient_id
-            if dense_parameters is not None or cat_parameters is not None:
-                if dense_parameters is not None and cat_parameters is None:
-                    param_value = self.cohort.extra_patients_parameters.loc[self.cohort.extra_patients_parameters['Patient'] == pid][dense_parameters[0]].values[0]
-                    param_limits = dense_parameters[1]
-                    if param_limits[0] is None and param_value > param_limits[1]:
-                        continue
-                    elif param_limits[1] is None and param_value <= param_limits[0]:
-                        continue
-                    elif ((param_limits[0] is not None and param_value < param_limits[0]) and
-                          (param_limits[1] is not None and param_value > param_limits[1])):
-                        continue
-                elif dense_parameters is None and cat_parameters is not None:
-                    param_value = self.cohort.extra_patients_parameters.loc[self.cohort.extra_patients_parameters['Patient'] == pid][cat_parameters[0]].values[0]
-                    if param_value != cat_parameters[1]:
-                        continue
+        patients = []
+        current = {}
+        to_load = []
+        for patient, members in self.__get_cohort_members(heatmaps=heatmaps):
+            if len(members) == 0:
+                continue
+            patients.append([patient.patient_id, members])
             fl = patient.registered_label_filepath
-            labels = None
+            previous = records.get(patient.patient_id)
+            if previous is not None and previous["filepath"] != fl:
+                previous = None
             try:
-                labels_ni = nib.load(fl)
-                labels = labels_ni.get_fdata()[:].astype('uint8')
+                record = compute_file_fingerprint(fl, previous)
             except Exception as e:
-                print('Issue loading {}.\n Skipping...'.format(fl))
+                record = {"size": None, "mtime_ns": None, "sha1": None}
+            record["filepath"] = fl
+            if (previous is not None and record["sha1"] is not None and previous["sha1"] == record["sha1"] and
+                    (not previous["included"] or os.path.exists(contribution_filename(record["sha1"])))):
+                record["included"] = previous["included"]
+                record["centroids"] = previous["centroids"]
+            else:
+                to_load.append(patient.patient_id)
+            current[patient.patient_id] = record
+
+        removed = [x for x in records.keys() if x not in current]
+        logging.info("Incremental heatmaps update: {} new, {} changed, {} removed, {} unchanged patients.".format(
+            len([x for x in to_load if x not in records]), len([x for x in to_load if x in records]), len(removed),
+            len(current) - len(to_load)))
+
+        shape = heatmaps[0].heatmap.shape
+        loads = [[current[x]["filepath"], contribution_filename(current[x]["sha1"]) if current[x]["sha1"] is not None
+                  else None] for x in to_load]
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1 or len(loads) <= 1:
+            results = compute_patient_contributions(patients=loads, shape=shape, native_dtype=self.low_memory,
+                                                    mask_cache=mask_cache, progress=True)
+        else:
+            shard_size = max(1, int(np.ceil(len(loads) / (jobs * 4))))
+            shards = [loads[x:x + shard_size] for x in range(0, len(loads), shard_size)]
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker_threads,
+                                 initargs=(threads,)) as executor:
+                futures = [executor.submit(compute_patient_contributions, patients=x, shape=shape,
+                                           native_dtype=self.low_memory, mask_cache=mask_cache) for x in shards]
+                for f in tqdm(as_completed(futures), total=len(futures)):
+                    pass
+                results = [r for f in futures for r in f.result()]
+        for pid, (included, centroids) in zip(to_load, results):
+            current[pid]["included"] = included
+            current[pid]["centroids"] = centroids
+
+        for h, heatmap in enumerate(heatmaps):
+            members = {}
+            for pid, m in patients:
+                if h in m and current[pid]["included"]:
+                    members[pid] = current[pid]["sha1"]
+            previous_members = heatmap.load_state(atlas_fingerprint=atlas_fingerprint, gt_files_suffix=gt_files_suffix)
+            if previous_members is not None and not all([os.path.exists(contribution_filename(x)) for x in
+                                                         previous_members.values()]):
+                logging.warning("Discarding the heatmap state in {}, with missing patient contributions.".format(
+                    heatmap.output_folder))
+                heatmap.reset_accumulators()
+                previous_members = None
+            if previous_members is None:
+                previous_members = {}
+
+            for pid, sha1 in previous_members.items():
+                if members.get(pid) != sha1:
+                    heatmap.exclude_voxels(np.load(contribution_filename(sha1), mmap_mode='r'))
+            for pid, sha1 in members.items():
+                if previous_members.get(pid) != sha1:
+                    heatmap.include_voxels(np.load(contribution_filename(sha1), mmap_mode='r'))
+            heatmap.rebuild_centroids([current[pid]["centroids"] for pid in members.keys()])
+            heatmap.save_state(patients=members, atlas_fingerprint=atlas_fingerprint, gt_files_suffix=gt_files_suffix)
+
+        # Only the contributions of the current patients are kept on disk.
+        used_contributions = [x["sha1"] + '.npy' for x in current.values() if x["included"]]
+        for fn in os.listdir(contributions_folder):
+            if fn not in used_contributions:
+                os.remove(os.path.join(contributions_folder, fn))
+        with open(state_filename, 'w') as outfile:
+            json.dump({"atlas": atlas_fingerprint, "gt_files_suffix": gt_files_suffix, "patients": current}, outfile,
+                      indent=4)
+
+
+    def __run_streaming(self, heatmaps: List[Heatmap], atlas_ni: nib.Nifti1Image) -> None:
+        """
+        Computes and saves the location heatmaps slab after slab along the last axis of the atlas, such that the memory
+        footprint is bounded by the slab size rather than by the atlas size.
+        A first pass over the annotation masks, also read slab after slab, identifies the foci centroids and saves the
+        voxels featuring the object of interest. The second pass accumulates every slab of the heatmaps from those
+        voxels, before appending it to the heatmaps files. The results are identical to the whole-volume computation.
+        :param: heatmaps: Slab accumulators for all the populations of interest.
+        :param: atlas_ni: Loaded atlas defining the space in which the heatmaps are computed.
+        :return: None
+        """
+        shape = atlas_ni.shape
+        plane = int(np.prod(shape[:-1]))
+        thickness = heatmaps[0].heatmap.size // plane
+        streaming_folder = os.path.join(self.output_directory, '.streaming')
+        os.makedirs(streaming_folder, exist_ok=True)
+
+        patients = []
+        for patient, members in self.__get_cohort_members(heatmaps=heatmaps):
+            if len(members) != 0:
+                patients.append([patient.registered_label_filepath,
+                                 os.path.join(streaming_folder, str(len(patients)) + '.npy'), members])
+
+        logging.info('Identifying the foci over {} slabs of {} slices.'.format(int(np.ceil(shape[-1] / thickness)),
+                                                                               thickness))
+        loads = [x[:2] for x in patients]
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1:
+            results = stream_patient_contributions(patients=loads, shape=shape, thickness=thickness,
+                                                   native_dtype=self.low_memory, progress=True)
+        else:
+            shard_size = max(1, int(np.ceil(len(loads) / (jobs * 4))))
+            shards = [loads[x:x + shard_size] for x in range(0, len(loads), shard_size)]
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker_threads,
+                                 initargs=(threads,)) as executor:
+                futures = [executor.submit(stream_patient_contributions, patients=x, shape=shape, thickness=thickness,
+                                           native_dtype=self.low_memory) for x in shards]
+                for f in tqdm(as_completed(futures), total=len(futures)):
+                    pass
+                results = [r for f in futures for r in f.result()]
+
+        # Centroid cubes of each foci as Fortran-ordered flat indices, matching the slabs layout, and patient ids
+        # following the patients order for every population, as for the whole-volume computation. The voxels of each
+        # patient are mapped once, with the bounds of every slab inside them.
+        slabs = list(range(0, shape[-1], thickness))
+        slabs_bounds = np.asarray(slabs + [shape[-1]], dtype=np.int64) * plane
+        included = []
+        counts = [0] * len(heatmaps)
+        for (fl, voxels_fl, members), (state, centroids) in zip(patients, results):
+            if not state:
                 continue
+            cubes = []
+            pids = {}
+            if centroids is not None:
+                cubes = [np.ravel_multi_index(np.unravel_index(get_centroid_cube(com, shape), shape), shape, order='F')
+                         for com in centroids]
+                for m in members:
+                    counts[m] += 1
+                    pids[m] = counts[m]
+            voxels = np.load(voxels_fl, mmap_mode='r')
+            included.append([voxels, np.searchsorted(voxels, slabs_bounds), members, cubes, pids])
+
+        for heatmap, count in zip(heatmaps, counts):
+            heatmap.open_streams(atlas_ni, count=count)
+
+        logging.info('Accumulating and saving the heatmaps slab after slab.')
+        for s in tqdm(range(len(slabs))):
+            start = slabs_bounds[s]
+            end = slabs_bounds[s + 1]
+            for voxels, bounds, members, cubes, pids in included:
+                voxels_slab = voxels[bounds[s]:bounds[s + 1]] - start
+                cubes_slab = [c[(c >= start) & (c < end)] - start for c in cubes]
+                for m in members:
+                    heatmaps[m].heatmap[voxels_slab] += 1
+                    if m in pids:
+                        for cube in cubes_slab:
+                            heatmaps[m].stamp_centroid(cube, pids[m])
+            for heatmap in heatmaps:
+                heatmap.write_slab(int(end - start))
+        # Releasing the mapped voxels before their removal.
+        included = None
+
+        for heatmap in heatmaps:
+            logging.info("Saved location heatmap for population {}.".format(heatmap.output_folder))
+            heatmap.close_streams()
+        shutil.rmtree(streaming_folder)
+
+
+def accumulate_heatmap_shard(patients: List[list], uids: List[str], shape: Tuple[int, ...],
+                             native_dtype: bool = False, mask_cache: MaskCache = None) -> List[HeatmapShard]:
+    """
+    Computes the partial heatmap accumulators for every population over a subset of the cohort.
+    :param patients: List of [registered annotation mask filepath, indices of the populations the patient belongs to].
+    :param uids: Identifiers of all the populations.
+    :param shape: Shape of the atlas space.
+    :param native_dtype: Whether to read the masks in their on-disk dtype, rather than through a float64 conversion.
+    :param mask_cache: Cache of compact annotation masks to read from, if any.
+    :return: One partial accumulator per population, in the same order as uids.
+    """
+    shards = [HeatmapShard(uid=u, shape=shape, size=len(patients)) for u in uids]
+    for fl, members in patients:
+        contribution = load_patient_contribution(fl, shape=shape, native_dtype=native_dtype, mask_cache=mask_cache)
+        if contribution is not None:
+            for m in members:
+                shards[m].include_patient(contribution[0], contribution[1])
+    return shards
 
-            if labels is not None and labels.shape == heatmap.shape and np.count_nonzero(labels) != 0:
-                # heatmap[labels == 1] += 1
-                heatmap[labels != 0] += 1
-
-                try:
-                    # If multifocal, computing the center of mass for each foci rather than overall, excluding object smaller than 0.1ml
-                    tumor_clusters = measurements.label(labels)[0]
-                    tumor_clusters_labels = regionprops(tumor_clusters)
-                    # Sorting by cluster size to get the parameters of the main component.
-                    tumor_clusters_labels = sorted(tumor_clusters_labels, key=lambda r: r.area, reverse=True)
-
-                    for clus in tumor_clusters_labels:
-                        clus_volume = clus.area * np.prod(labels_ni.header.get_zooms())
-                        clus_volume_ml = clus_volume * 1e-3
-                        if clus_volume_ml >= 0.1:
-                            clus_lab = np.zeros(labels.shape)
-                            clus_lab[tumor_clusters == clus.label] = 1
-                            com = smeas.center_of_mass(clus_lab)
-                            heatmap_centroids[int(com[0]) - 3:int(com[0]) + 3, int(com[1]) - 3:int(com[1]) + 3,
-                            int(com[2]) - 3:int(com[2]) + 3] += 1
-                            heatmap_pids[int(com[0]) - 3:int(com[0]) + 3, int(com[1]) - 3:int(com[1]) + 3,
-                            int(com[2]) - 3:int(com[2]) + 3] = (count + 1)
-                    count += 1
-                except Exception as e:
-                    print('Could not compute center of mass for {}.'.format(fl))
-                    print('Collected: {}'.format(traceback.format_exc()))
-
-        heatmap_perc = np.zeros(atlas.shape)
-        heatmap_perc = heatmap / count
-        heatmap_centroids_perc = heatmap_centroids / count
-
-        logging.info('Writing heatmaps to disk')
-        dtype = np.uint16
-        output_filename_heatmap = os.path.join(self.output_folder,
-                                               'heatmap_cumulative' + self.suffix + '.nii.gz')
-        heatmap_ni = nib.Nifti1Image(heatmap.astype(dtype), atlas_ni.affine, atlas_ni.header)
-        heatmap_ni.set_data_dtype(dtype)
-        nib.save(heatmap_ni, filename=output_filename_heatmap)
-
-        dtype = np.float32
-        output_filename_heatmap_perc = os.path.join(self.output_folder,
-                                                    'heatmap_percentages' + self.suffix + '.nii.gz')
-        heatmap_perc_ni = nib.Nifti1Image(heatmap_perc.astype(dtype), atlas_ni.affine, atlas_ni.header)
-        heatmap_ni.set_data_dtype(dtype)
-        nib.save(heatmap_perc_ni, filename=output_filename_heatmap_perc)
-
-        dtype = np.uint16
-        output_filename_heatmap_centroids = os.path.join(self.output_folder,
-                                                         'heatmap_centroids_cumulative' + self.suffix + '.nii.gz')
-        heatmap_com_ni = nib.Nifti1Image(heatmap_centroids.astype(dtype), atlas_ni.affine, atlas_ni.header)
-        heatmap_ni.set_data_dtype(dtype)
-        nib.save(heatmap_com_ni, filename=output_filename_heatmap_centroids)
-
-        dtype = np.float32
-        output_filename_heatmap_com_perc = os.path.join(self.output_folder,
-                                                        'heatmap_centroids_percentages' + self.suffix + '.nii.gz')
-        heatmap_com_perc_ni = nib.Nifti1Image(heatmap_centroids_perc.astype(dtype), atlas_ni.affine, atlas_ni.header)
-        heatmap_ni.set_data_dtype(dtype)
-        nib.save(heatmap_com_perc_ni, filename=output_filename_heatmap_com_perc)
-
-        dtype = np.uint16
-        output_filename_heatmap_pids = os.path.join(self.output_folder,
-                                                    'heatmap_patient_ids' + self.suffix + '.nii.gz')
-        heatmap_pids_ni = nib.Nifti1Image(heatmap_pids.astype(dtype), atlas_ni.affine, atlas_ni.header)
-        heatmap_ni.set_data_dtype(dtype)
-        nib.save(heatmap_pids_ni, filename=output_filename_heatmap_pids)
-
-        logging.info('Computed heatmap location with {} samples.'.format(count))
+
+def compute_patient_contributions(patients: List[list], shape: Tuple[int, ...], native_dtype: bool = False,
+                                  mask_cache: MaskCache = None, progress: bool = False) -> List[Tuple[bool, Union[None, List[List[float]]]]]:
+    """
+    Computes the contribution of each patient to the heatmaps, and saves the voxels featuring the object of interest
+    on disk, for the incremental update of the heatmaps.
+    :param patients: List of [registered annotation mask filepath, destination filepath for the voxels indices].
+    :param shape: Shape of the atlas space.
+    :param native_dtype: Whether to read the masks in their on-disk dtype, rather than through a float64 conversion.
+    :param mask_cache: Cache of compact annotation masks to read from, if any.
+    :param progress: Whether to display a progress bar over the patients.
+    :return: For each patient, whether the annotation mask can be included in the heatmaps, and its foci centroids.
+    """
+    results = []
+    for fl, dest_fl in (tqdm(patients) if progress else patients):
+        contribution = None
+        if dest_fl is not None:
+            contribution = load_patient_contribution(fl, shape=shape, native_dtype=native_dtype, mask_cache=mask_cache)
+        if contribution is None:
+            results.append((False, None))
+            continue
+        np.save(dest_fl, contribution[0].astype(np.uint32))
+        centroids = [[float(x) for x in c] for c in contribution[1]] if contribution[1] is not None else None
+        results.append((True, centroids))
+    return results
+
+
+def load_patient_contribution(fl: str, shape: Tuple[int, ...],
+                              native_dtype: bool = False,
+                              mask_cache: MaskCache = None) -> Union[None, Tuple[np.ndarray, Union[None, List[tuple]]]]:
+    """
+    Loads a registered annotation mask and identifies the voxels and foci centroids of the object of interest.
+    Through the mask cache, only the bounding-box crop of the object is loaded and processed.
+    :param fl: Registered annotation mask filepath.
+    :param shape: Shape of the atlas space.
+    :param native_dtype: Whether to read the mask in its on-disk dtype, rather than through a float64 conversion.
+    :param mask_cache: Cache of compact annotation masks to read from, if any, in which case native_dtype is ignored.
+    :return: Flat indices of the voxels featuring the object of interest, and the foci centroids (None if they could
+    not be computed), or None if the annotation mask cannot be used.
+    """
+    labels = None
+    offset = (0, 0, 0)
+    try:
+        if mask_cache is not None:
+            labels, offset, labels_shape, _, zooms = mask_cache.load_crop(fl)
+        else:
+            labels_ni = nib.load(fl)
+            zooms = labels_ni.header.get_zooms()
+            if native_dtype:
+                labels = np.asanyarray(labels_ni.dataobj).astype('uint8', copy=False)
+            else:
+                labels = labels_ni.get_fdata()[:].astype('uint8')
+            labels_shape = labels.shape
+    except Exception as e:
+        print('Issue loading {}.\n Skipping...'.format(fl))
+        return None
+
+    if labels is None or labels_shape != shape or np.count_nonzero(labels) == 0:
+        return None
+
+    centroids = None
+    try:
+        centroids = compute_foci_centroids(labels, voxel_volume=np.prod(zooms), offset=offset)
+    except Exception as e:
+        print('Could not compute center of mass for {}.'.format(fl))
+        print('Collected: {}'.format(traceback.format_exc()))
+    if mask_cache is not None:
+        # The C-ordered nonzero coordinates of the crop follow the order of the flat indices in the full mask.
+        return np.ravel_multi_index(tuple([c + o for c, o in zip(np.nonzero(labels), offset)]), shape), centroids
+    return np.flatnonzero(labels), centroids
+
+
+def stream_patient_contributions(patients: List[list], shape: Tuple[int, ...], thickness: int,
+                                 native_dtype: bool = False,
+                                 progress: bool = False) -> List[Tuple[bool, Union[None, List[tuple]]]]:
+    """
+    Reads each annotation mask slab after slab along the last axis, for identifying its foci centroids and saving the
+    voxels featuring the object of interest, without ever loading the full mask in memory.
+    Foci are labelled within each slab, and merged with the foci they touch in the previous slab, such that foci
+    spanning over several slabs get the same centroid as from a whole-volume labelling.
+    :param patients: List of [registered annotation mask filepath, destination filepath for the voxels indices].
+    :param shape: Shape of the atlas space.
+    :param thickness: Number of slices along the last axis read at once.
+    :param native_dtype: Whether to read the masks in their on-disk dtype, rather than through a float64 conversion.
+    :param progress: Whether to display a progress bar over the patients.
+    :return: For each patient, whether the annotation mask can be included in the heatmaps, and its foci centroids
+    (None if they could not be computed). The voxels are saved as sorted Fortran-ordered flat indices.
+    """
+    results = []
+    for fl, voxels_fl in (tqdm(patients) if progress else patients):
+        try:
+            labels_ni = nib.load(fl, keep_file_open=True)
+        except Exception as e:
+            print('Issue loading {}.\n Skipping...'.format(fl))
+            results.append((False, None))
+            continue
+        if labels_ni.shape != shape:
+            results.append((False, None))
+            continue
+
+        plane = int(np.prod(shape[:-1]))
+        voxels = []
+        foci = FociUnion()
+        previous_slice = None
+        try:
+            for z in range(0, shape[-1], thickness):
+                if native_dtype:
+                    labels = np.asanyarray(labels_ni.dataobj[..., z:z + thickness]).astype('uint8', copy=False)
+                else:
+                    labels = np.asarray(labels_ni.dataobj[..., z:z + thickness], dtype=np.float64).astype('uint8')
+                voxels.append(np.flatnonzero(labels.ravel(order='F')) + z * plane)
+                previous_slice = foci.include_slab(labels, z, shape, previous_slice)
+        except Exception as e:
+            print('Issue loading {}.\n Skipping...'.format(fl))
+            results.append((False, None))
+            continue
+
+        voxels = np.concatenate(voxels)
+        if voxels.size == 0:
+            results.append((False, None))
+            continue
+        np.save(voxels_fl, voxels.astype(np.min_scalar_type(int(np.prod(shape)))))
+
+        centroids = None
+        try:
+            centroids = foci.compute_centroids(voxel_volume=np.prod(labels_ni.header.get_zooms()))
+        except Exception as e:
+            print('Could not compute center of mass for {}.'.format(fl))
+            print('Collected: {}'.format(traceback.format_exc()))
+        results.append((True, centroids))
+    return results
+
+
+class FociUnion:
+    """
+    Union-find over the foci labelled independently in consecutive slabs of an annotation mask, accumulating the
+    statistics needed for the foci centroids.
+    """
+    _parents = []  # Union-find parent of each slab-wise foci
+    _areas = []  # Number of voxels of each slab-wise foci
+    _sums = []  # Sum of the integer coordinates of the voxels along each axis, for each slab-wise foci
+    _firsts = []  # Flat C-ordered index of the first voxel of each slab-wise foci, in atlas space
+
+    def __init__(self) -> None:
+        self.__reset()
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._parents = []
+        self._areas = []
+        self._sums = []
+        self._firsts = []
+
+    def __find(self, x: int) -> int:
+        while self._parents[x] != x:
+            self._parents[x] = self._parents[self._parents[x]]
+            x = self._parents[x]
+        return x
+
+    def include_slab(self, labels: np.ndarray, z: int, shape: Tuple[int, ...],
+                     previous_slice: Union[None, np.ndarray]) -> Union[None, np.ndarray]:
+        """
+        Labels the foci of a slab, and merges them with the foci of the previous slab they are connected to.
+        :param labels: Slab of the annotation mask.
+        :param z: Index of the first slice of the slab, along the last axis.
+        :param shape: Shape of the full annotation mask.
+        :param previous_slice: Foci identifiers on the last slice of the previous slab, returned by the previous call.
+        :return: Foci identifiers (shifted by one) on the last slice of the slab, 0 denoting the background.
+        """
+        tumor_clusters, nb_clusters = measurements.label(labels)
+        if nb_clusters == 0:
+            return None
+
+        offset = len(self._parents)
+        coords = np.nonzero(tumor_clusters)
+        ids = tumor_clusters[coords]
+        self._parents.extend(range(offset, offset + nb_clusters))
+        self._areas.extend(np.bincount(ids, minlength=nb_clusters + 1)[1:].tolist())
+        sums = [np.bincount(ids, weights=coords[a], minlength=nb_clusters + 1)[1:] for a in range(3)]
+        sums[-1] += z * np.asarray(self._areas[offset:])
+        self._sums.extend([[int(sums[a][c]) for a in range(3)] for c in range(nb_clusters)])
+        # The nonzero coordinates follow the C-order, the first occurrence of each foci being its first voxel.
+        _, firsts = np.unique(ids, return_index=True)
+        firsts = np.ravel_multi_index(tuple([coords[a][firsts] for a in range(2)] + [coords[2][firsts] + z]), shape)
+        self._firsts.extend(firsts.tolist())
+
+        # The default labelling structure only connects voxels sharing a face across the slabs boundary.
+        if previous_slice is not None:
+            current_slice = tumor_clusters[..., 0]
+            connected = (previous_slice != 0) & (current_slice != 0)
+            for a, b in set(zip(previous_slice[connected].tolist(), (current_slice[connected] + offset).tolist())):
+                root_a, root_b = self.__find(a - 1), self.__find(b - 1)
+                if root_a != root_b:
+                    self._parents[max(root_a, root_b)] = min(root_a, root_b)
+        return np.where(tumor_clusters[..., -1] != 0, tumor_clusters[..., -1] + offset, 0)
+
+    def compute_centroids(self, voxel_volume: float) -> List[tuple]:
+        """
+        Computes the center of mass of each foci, excluding objects smaller than 0.1ml, as compute_foci_centroids.
+        :param voxel_volume: Volume of one voxel, in mm3.
+        :return: Center of mass for each foci, sorted by decreasing foci size.
+        """
+        foci = {}
+        for c in range(len(self._parents)):
+            root = self.__find(c)
+            if root not in foci:
+                foci[root] = [0, [0, 0, 0], self._firsts[c]]
+            foci[root][0] += self._areas[c]
+            foci[root][1] = [foci[root][1][a] + self._sums[c][a] for a in range(3)]
+            foci[root][2] = min(foci[root][2], self._firsts[c])
+
+        # Same ordering as the whole-volume labelling, where foci are numbered following their first voxel.
+        clusters = sorted(foci.values(), key=lambda f: f[2])
+        clusters = sorted(clusters, key=lambda f: f[0], reverse=True)
+        centroids = []
+        for area, sums, _ in clusters:
+            clus_volume = area * voxel_volume
+            clus_volume_ml = clus_volume * 1e-3
+            if clus_volume_ml >= 0.1:
+                centroids.append(tuple(np.float64(sums[a]) / area for a in range(3)))
+        return centroids
+
+
+def compute_foci_centroids(labels: np.ndarray, voxel_volume: float,
+                           offset: Tuple[int, ...] = (0, 0, 0)) -> List[tuple]:
+    """
+    Computes the center of mass of each foci of the object of interest, rather than overall, excluding objects smaller
+    than 0.1ml.
+    All foci are identified in a single labelling pass, and each center of mass is then computed only within the
+    bounding box of its foci.
+    :param labels: Annotation mask, in atlas space, or a crop of it containing the whole object.
+    :param voxel_volume: Volume of one voxel, in mm3.
+    :param offset: Position of the crop inside the annotation mask, for the centers of mass to be expressed in atlas
+    space.
+    :return: Center of mass for each foci, sorted by decreasing foci size.
+    """
+    tumor_clusters, nb_clusters = measurements.label(labels)
+    clusters_bboxes = find_objects(tumor_clusters)
+    clusters_coords = [np.nonzero(tumor_clusters[bbox] == (c + 1)) for c, bbox in enumerate(clusters_bboxes)]
+    clusters_areas = [coords[0].size for coords in clusters_coords]
+    # Sorting by cluster size to get the parameters of the main component.
+    clusters_order = sorted(range(nb_clusters), key=lambda c: clusters_areas[c], reverse=True)
+
+    centroids = []
+    for c in clusters_order:
+        clus_volume = clusters_areas[c] * voxel_volume
+        clus_volume_ml = clus_volume * 1e-3
+        if clus_volume_ml >= 0.1:
+            # Summing the integer coordinates before dividing, to obtain the exact same value as a full-volume center
+            # of mass computation.
+            centroids.append(tuple(np.float64(clusters_coords[c][a].sum() +
+                                              clusters_areas[c] * (bbox.start + offset[a])) / clusters_areas[c]
+                                   for a, bbox in enumerate(clusters_bboxes[c])))
+    return centroids
@@ -12,27 +12,38 @@ import pandas as pd
 from ..Utils.utils import *
 from ..Utils.resources import SharedResources
 from ..Utils.ants_registration import *
+from ..Utils.location_metrics import compute_location_report
+from ..Utils.staging import stage_file
+from ..Utils.rads_session import RadsSession
 from ..Structures.MetricsStructure import Metrics
+from ..Structures.VolumeContextStructure import VolumeContext
 
 
 class LocationComputationStep():
     _patient_parameters = None  # Placeholder for all patient related data
     _step_input_folder = None
     _step_output_folder = None
+    _scratch_folder = None  # Folder holding all temporary files, which must be specific to each step running in parallel
+    _volume_context = None  # In-memory registered volumes of the patient, shared with the other metrics steps
 
-    def __init__(self):
+    def __init__(self, scratch_folder: str = None):
+        """
+        :param scratch_folder: Folder where all temporary files are stored (the output folder by default). Steps
+        running in parallel must each be given their own scratch folder.
+        """
         self.__reset()
-        self._step_input_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                            'pipeline_input'))
-        os.makedirs(self._step_input_folder)
-        self._step_output_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                             'pipeline_output'))
-        os.makedirs(self._step_output_folder)
+        self._scratch_folder = scratch_folder if scratch_folder is not None else SharedResources.getInstance().maps_output_folder
+        self._step_input_folder = os.path.join(self._scratch_folder, 'pipeline_input')
+        os.makedirs(self._step_input_folder, exist_ok=True)
+        self._step_output_folder = os.path.join(self._scratch_folder, 'pipeline_output')
+        os.makedirs(self._step_output_folder, exist_ok=True)
 
     def __reset(self):
         self._patient_parameters = None
         self._step_input_folder = None
         self._step_output_folder = None
+        self._scratch_folder = None
+        self._volume_context = None
 
     @property
     def patient_parameters(self) -> str:
@@ -42,17 +53,27 @@ class LocationComputationStep():
     def patient_parameters(self, pat_params) -> None:
         self._patient_parameters = pat_params
 
-    def setup(self, patient_parameters):
+    def setup(self, patient_parameters, volume_context: VolumeContext = None):
         """
-
+        :param patient_parameters: PatientStructure instance, registered to the MNI space.
+        :param volume_context: Registered volumes of the patient already in memory, shared with the other metrics
+        steps (loaded for this step only if None).
         """
         self.patient_parameters = patient_parameters
         try:
-            reg_input_filepath = os.path.join(SharedResources.getInstance().maps_output_folder,
-                                              self.patient_parameters.patient_id, "input_reg_mni.nii.gz")
-            mask_reg_input_filepath = os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                   self.patient_parameters.patient_id,
-                                                   "input_reg_mni_" + SharedResources.getInstance().maps_gt_files_suffix)
+            self._volume_context = volume_context if volume_context is not None else \
+                VolumeContext(self.patient_parameters.patient_id)
+            reg_input_filepath = self._volume_context.volume_filepath
+            mask_reg_input_filepath = self._volume_context.mask_filepath
+            if SharedResources.getInstance().metrics_location_engine not in ['native', 'rads']:
+                raise ValueError("Unknown location engine {}, to sample from [native, rads].".format(
+                    SharedResources.getInstance().metrics_location_engine))
+            if SharedResources.getInstance().metrics_location_engine == 'native':
+                # The mask is directly used from the volume context when computing the location, nothing to stage.
+                return
+            # The mask is handed over to raidionicsrads as a file, and only checked to be readable beforehand, through
+            # the volume context, also holding it for the other steps.
+            self._volume_context.mask
             ts_path = os.path.join(self._step_input_folder, "T0")
             os.makedirs(ts_path)
 
@@ -64,10 +85,8 @@ class LocationComputationStep():
             if SharedResources.getInstance().maps_sequence_type == "T1-CE":
                 dest_base_mask_reg_fn = 't1gd_' + os.path.basename(mask_reg_input_filepath)
 
-            shutil.copyfile(src=reg_input_filepath,
-                            dst=os.path.join(ts_path, dest_base_reg_fn))
-            shutil.copyfile(src=mask_reg_input_filepath,
-                            dst=os.path.join(ts_path, dest_base_mask_reg_fn))
+            stage_file(src=reg_input_filepath, dst=os.path.join(ts_path, dest_base_reg_fn))
+            stage_file(src=mask_reg_input_filepath, dst=os.path.join(ts_path, dest_base_mask_reg_fn))
         except Exception as e:
             logging.error("[LocationComputationStep] Setting up process failed with {}".format(traceback.format_exc()))
             if os.path.exists(self._step_input_folder):
@@ -98,6 +117,67 @@ class LocationComputationStep():
         return self._patient_parameters
 
     def __compute_location(self):
+        if SharedResources.getInstance().metrics_location_engine == 'native':
+            computation_df = self.__compute_location_native()
+        else:
+            computation_df = self.__compute_location_rads()
+
+        try:
+            non_available_uid = True
+            metrics_uid = None
+            while non_available_uid:
+                metrics_uid = 'M' + str(np.random.randint(0, 10000))
+                if metrics_uid not in list(self.patient_parameters.metrics.keys()):
+                    non_available_uid = False
+
+            target_class = SharedResources.getInstance().maps_gt_files_suffix.split('.')[0].split('label_')[-1]
+            if self.patient_parameters.is_metrics_for_class(target_class):
+                metrics = self.patient_parameters.get_metrics_for_class(target_class)
+            else:
+                metrics = Metrics(uid=metrics_uid, input_folder=self.patient_parameters.output_folderpath)
+
+            if SharedResources.getInstance().metrics_brain_location:
+                metrics.fill_brain_location_from_report(computation_df)
+            if SharedResources.getInstance().metrics_multifocality:
+                metrics.fill_multifocality_metrics_from_report(computation_df)
+            metrics.fill_cortical_location_from_report(computation_df)
+            metrics.fill_subcortical_location_from_report(computation_df)
+
+            self.patient_parameters.include_metrics(target_class, metrics)
+            metrics.dump_metrics_file_on_disk()
+
+        except Exception:
+            if os.path.exists(self._step_input_folder):
+                shutil.rmtree(self._step_input_folder)
+            if os.path.exists(self._step_output_folder):
+                shutil.rmtree(self._step_output_folder)
+            raise ValueError("Location computation failed on patient during results parsing.")
+
+    def __compute_location_native(self) -> dict:
+        """
+        Computes the location metrics in-process, from the annotation mask in MNI space against the atlases.
+        :return: Report laid out as the raidionics_rads neuro_clinical_report.json.
+        """
+        cortical = []
+        if not self.patient_parameters.metrics[get_metrics_target_class()].cortical_structures_location_metrics_exist():
+            cortical = SharedResources.getInstance().metrics_cortical_features_location
+        subcortical = []
+        if not self.patient_parameters.metrics[get_metrics_target_class()].subcortical_structures_location_metrics_exist():
+            subcortical = SharedResources.getInstance().metrics_subcortical_features_location
+        try:
+            return compute_location_report(tumor=self._volume_context.refined_mask,
+                                           spacing=self._volume_context.spacing, cortical=cortical,
+                                           subcortical=subcortical)
+        except Exception:
+            logging.error("[LocationComputationStep] Native location computation failed with: {}".format(
+                traceback.format_exc()))
+            raise ValueError("Location computation failed on patient.")
+
+    def __compute_location_rads(self) -> pd.DataFrame:
+        """
+        Computes the location metrics through the raidionics_rads neuro_diagnosis pipeline.
+        :return: Content of the neuro_clinical_report.json.
+        """
         rads_config = configparser.ConfigParser()
         rads_config.add_section('Default')
         rads_config.set('Default', 'task', 'neuro_diagnosis')
@@ -123,8 +203,7 @@ class LocationComputationStep():
             rads_config.write(outfile)
 
         try:
-            from raidionicsrads.compute import run_rads
-            run_rads(rads_config_filename)
+            RadsSession.getInstance().run(rads_config_filename)
         except Exception:
             if os.path.exists(self._step_input_folder):
                 shutil.rmtree(self._step_input_folder)
@@ -136,38 +215,7 @@ class LocationComputationStep():
         if not os.path.exists(location_results_filename):
             logging.error("No location computation file found on disk.\n")
             raise ValueError("No location computation file found on disk.\n")
-
-        try:
-            non_available_uid = True
-            metrics_uid = None
-            while non_available_uid:
-                metrics_uid = 'M' + str(np.random.randint(0, 10000))
-                if metrics_uid not in list(self.patient_parameters.metrics.keys()):
-                    non_available_uid = False
-
-            computation_df = pd.read_json(location_results_filename)
-            target_class = SharedResources.getInstance().maps_gt_files_suffix.split('.')[0].split('label_')[-1]
-            if self.patient_parameters.is_metrics_for_class(target_class):
-                metrics = self.patient_parameters.get_metrics_for_class(target_class)
-            else:
-                metrics = Metrics(uid=metrics_uid, input_folder=self.patient_parameters.output_folderpath)
-
-            if SharedResources.getInstance().metrics_brain_location:
-                metrics.fill_brain_location_from_report(computation_df)
-            if SharedResources.getInstance().metrics_multifocality:
-                metrics.fill_multifocality_metrics_from_report(computation_df)
-            metrics.fill_cortical_location_from_report(computation_df)
-            metrics.fill_subcortical_location_from_report(computation_df)
-
-            self.patient_parameters.include_metrics(target_class, metrics)
-            metrics.dump_metrics_file_on_disk()
-
-        except Exception:
-            if os.path.exists(self._step_input_folder):
-                shutil.rmtree(self._step_input_folder)
-            if os.path.exists(self._step_output_folder):
-                shutil.rmtree(self._step_output_folder)
-            raise ValueError("Location computation failed on patient during results parsing.")
+        return pd.read_json(location_results_filename)
 
     def __generate_registration_pipeline(self):
         timestamp_order = 0
@@ -2,12 +2,16 @@ from __future__ import division
 
 import logging
 import traceback
-from typing import List
+from typing import List, Tuple, Union
 import numpy as np
 import csv
 import sys
 import os
+import time
+import shutil
+import tempfile
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
 from tqdm import tqdm
@@ -16,16 +20,28 @@ from ..Computation.location_computation_step import LocationComputationStep
 from ..Computation.size_computation_step import SizeComputationStep
 from ..Utils.resources import SharedResources
 from ..Utils.utils import get_metrics_target_class
+from ..Utils.mask_cache import MaskCache
+from ..Utils.atlas_index import get_atlas_index
+from ..Structures.VolumeContextStructure import VolumeContext
 
 
 class MetricsComputationProcessor:
     """
-
+    Computation of the size and location metrics for all patients of the cohort, with one SizeComputationStep and one
+    LocationComputationStep per patient.
+    Patients are distributed over a pool of worker processes, each patient being processed inside its own scratch
+    folder such that the temporary files of different patients cannot collide. The per-patient metrics are merged
+    into the cohort-level all_metrics_<class>.csv once all patients are processed.
     """
     _cohort = None  # Placeholder for all loaded patients belonging to the cohort of interest
+    _workers = 1  # Number of parallel processes used to compute the metrics
+    _scratch_folder = None  # Folder holding the per-patient scratch folders
+    _report = None  # Outcome of the metrics computation for each patient
 
-    def __init__(self):
+    def __init__(self, workers: int = None):
         self.__reset()
+        self._workers = workers if workers is not None else SharedResources.getInstance().metrics_workers
+        self._scratch_folder = os.path.join(SharedResources.getInstance().maps_output_folder, '.scratch')
 
     @property
     def cohort(self):
@@ -35,12 +51,27 @@ class MetricsComputationProcessor:
     def cohort(self, input_cohort) -> None:
         self._cohort = input_cohort
 
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @workers.setter
+    def workers(self, w: int) -> None:
+        self._workers = w
+
+    @property
+    def report(self) -> pd.DataFrame:
+        return self._report
+
     def __reset(self) -> None:
         """
         All objects share class or static variables.
         An instance or non-static variables are different for different objects (every object has a copy).
         """
         self.cohort = None
+        self._workers = 1
+        self._scratch_folder = None
+        self._report = None
 
     def setup(self, cohort) -> None:
         """
@@ -54,45 +85,137 @@ class MetricsComputationProcessor:
 
     def run(self) -> None:
         """
-
-        :return:
+        Computes the metrics of all patients whose volume and registered annotation were not discarded by the preflight
+        check, and exports them for the whole cohort into all_metrics_<class>.csv inside the output folder.
+        :return: None
         """
         logging.info("Computing metrics for the complete cohort!")
-        try:
-            for p in tqdm(list(self.cohort.patients.keys())):
-                pat = self.cohort.patients[p]
-                if SharedResources.getInstance().metrics_tumor_size:
-                    processor = SizeComputationStep()
-                    processor.setup(pat)
-                    pat = processor.execute()
-
-                if (SharedResources.getInstance().metrics_brain_location or
-                    SharedResources.getInstance().metrics_multifocality or
-                        len(SharedResources.getInstance().metrics_cortical_features_location) != 0 or
-                        len(SharedResources.getInstance().metrics_subcortical_features_location) != 0):
-                    processor = LocationComputationStep()
-                    processor.setup(pat)
-                    pat = processor.execute()
-
+        patients = [p for p in self.cohort.patients.keys()
+                    if self.cohort.is_file_validated(self.cohort.patients[p].volume_filepath)
+                    and self.cohort.is_file_validated(self.cohort.patients[p].registered_label_filepath)]
+
+        if SharedResources.getInstance().metrics_location_engine == 'native' and len(patients) != 0:
+            # Built once, if needed, before the workers open it.
+            try:
+                get_atlas_index()
+            except Exception as e:
+                logging.error("Atlas index could not be opened with: {}".format(traceback.format_exc()))
+
+        os.makedirs(self._scratch_folder, exist_ok=True)
+        results = []
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1 or len(patients) <= 1:
+            for p in tqdm(patients):
+                results.append([p] + list(compute_patient_metrics(self.cohort.patients[p], self._scratch_folder)))
+        else:
+            logging.info("Computing metrics for {} patients with {} workers of {} threads.".format(len(patients), jobs,
+                                                                                                  threads))
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_metrics_worker,
+                                     initargs=(SharedResources.getInstance().config_filename, threads)) as executor:
+                futures = {executor.submit(compute_patient_metrics, self.cohort.patients[p], self._scratch_folder): p
+                           for p in patients}
+                for f in tqdm(as_completed(futures), total=len(futures)):
+                    p = futures[f]
+                    try:
+                        results.append([p] + list(f.result()))
+                    except Exception as e:
+                        # Only happening if the worker process itself died (e.g., out of memory).
+                        logging.error("Metrics worker for patient {} terminated with: {}".format(
+                            self.cohort.patients[p].patient_id, e))
+                        results.append([p, None, 0., "Worker process terminated abruptly ({})".format(e)])
+
+        rows = []
+        for p, pat, elapsed, error in results:
+            if pat is not None:
                 self.cohort.patients[p] = pat
-        except Exception as e:
-            logging.error("Detected problem during metrics computation over the whole cohort.\n {}".format(traceback.format_exc()))
-
-        # Global metrics export for all patients into a single file
+            rows.append([self.cohort.patients[p].patient_id, "failed" if error is not None else "done", elapsed,
+                         error if error is not None else ""])
+        self._report = pd.DataFrame(rows, columns=["Patient", "Status", "Elapsed (s)", "Error"])
+        if os.path.exists(self._scratch_folder) and len(os.listdir(self._scratch_folder)) == 0:
+            os.rmdir(self._scratch_folder)
+
+        if SharedResources.getInstance().mask_cache:
+            MaskCache().evict()
+
+        self.__export_cohort_metrics(patients)
+        failures = self._report.loc[self._report["Status"] == "failed"]
+        if len(failures) != 0:
+            print("Metrics computation of {} patients: {} failed.".format(len(self._report), len(failures)))
+            for _, row in failures.iterrows():
+                print("  {}: {}".format(row["Patient"], row["Error"]))
+
+    def __export_cohort_metrics(self, patients: List) -> None:
+        """
+        Global metrics export for all patients into a single file, following the cohort order. Patients without
+        metrics on disk are left out, and the columns missing for some patients are left empty. The file is written
+        under a temporary name first, such that an existing export is never left half-written.
+        """
         cohort_metrics_filename = os.path.join(SharedResources.getInstance().maps_output_folder,
                                                "all_metrics_" + get_metrics_target_class() + ".csv")
         all_metrics = []
-        all_metrics_columns = None
-        for p in list(self.cohort.patients.keys()):
+        for p in patients:
             pat = self.cohort.patients[p]
             pat_metrics_fn = os.path.join(pat.output_folderpath,
                                           "computed_metrics_" + get_metrics_target_class() + ".csv")
-            pat_metrics_df = pd.read_csv(pat_metrics_fn)
-            all_metrics.append([pat.patient_id] + list(pat_metrics_df.values[0]))
-            if all_metrics_columns is None:
-                all_metrics_columns = ["Patient_ID"] + list(pat_metrics_df.columns)
-
-        all_metrics_df = pd.DataFrame(all_metrics, columns=all_metrics_columns)
-        all_metrics_df.to_csv(cohort_metrics_filename, index=False)
+            if not os.path.exists(pat_metrics_fn):
+                logging.warning("No metrics found on disk for patient {}.".format(pat.patient_id))
+                continue
+            pat_metrics_df = pd.read_csv(pat_metrics_fn).iloc[[0]]
+            pat_metrics_df.insert(0, "Patient_ID", pat.patient_id)
+            all_metrics.append(pat_metrics_df)
+
+        all_metrics_df = pd.concat(all_metrics, ignore_index=True, sort=False) if len(all_metrics) != 0 else \
+            pd.DataFrame(columns=["Patient_ID"])
+        tmp_filename = cohort_metrics_filename + '.{}.tmp'.format(os.getpid())
+        all_metrics_df.to_csv(tmp_filename, index=False)
+        os.replace(tmp_filename, cohort_metrics_filename)
 
         # @TODO. The metrics file could be fused with the extra_parameters file in addition?
+
+
+def init_metrics_worker(config_filename: str, threads: int) -> None:
+    """
+    Sets up the runtime parameters inside a worker process, when not inherited from the parent process, and
+    constrains the number of threads the worker uses.
+    :param config_filename: Filepath to the *.ini with the user-specific runtime parameters.
+    :param threads: Number of threads for the worker.
+    :return: None
+    """
+    if SharedResources.getInstance().config_filename is None and config_filename is not None:
+        SharedResources.getInstance().set_environment(config_filename=config_filename)
+    SharedResources.getInstance().set_job_threads(threads)
+
+
+def compute_patient_metrics(patient, scratch_root: str) -> Tuple[Union[None, object], float, Union[None, str]]:
+    """
+    Computes the requested metrics for one patient, inside a dedicated scratch folder removed afterwards. The
+    registered volumes of the patient are decoded once and shared by all metrics steps, until the patient is done. The
+    metrics are saved inside the patient output folder.
+    :param patient: PatientStructure instance, registered to the atlas space.
+    :param scratch_root: Folder where the patient-specific scratch folder is created.
+    :return: Updated patient (None if the computation failed), elapsed time in seconds, and error message if any.
+    """
+    start = time.time()
+    scratch_folder = tempfile.mkdtemp(prefix=patient.patient_id + '_', dir=scratch_root)
+    volume_context = VolumeContext(patient.patient_id)
+    try:
+        if SharedResources.getInstance().metrics_tumor_size:
+            processor = SizeComputationStep(scratch_folder=scratch_folder)
+            processor.setup(patient, volume_context=volume_context)
+            patient = processor.execute()
+
+        if (SharedResources.getInstance().metrics_brain_location or
+            SharedResources.getInstance().metrics_multifocality or
+                len(SharedResources.getInstance().metrics_cortical_features_location) != 0 or
+                len(SharedResources.getInstance().metrics_subcortical_features_location) != 0):
+            processor = LocationComputationStep(scratch_folder=scratch_folder)
+            processor.setup(patient, volume_context=volume_context)
+            patient = processor.execute()
+        return patient, time.time() - start, None
+    except Exception as e:
+        logging.error("Metrics computation failed for patient {} with: \n{}".format(patient.patient_id,
+                                                                                    traceback.format_exc()))
+        return None, time.time() - start, str(e)
+    finally:
+        volume_context.release()
+        shutil.rmtree(scratch_folder, ignore_errors=True)
@@ -0,0 +1,187 @@
+import os
+import logging
+import traceback
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from concurrent.futures import ThreadPoolExecutor
+
+from ..Utils.resources import SharedResources
+
+
+class PreflightProcessor:
+    """
+    Fast sanity check of the atlas and of all the files found for every patient of the cohort, only reading the NIfTI
+    headers, before running any of the heavy computation stages.
+    For each file, the shape, affine, voxel size, data type, and dimensionality are collected and compared with the
+    other files of the patient and with the atlas. Issues either prevent the patient from being used (errors), or are
+    only reported (warnings). The patients without errors are handed over to the following stages through the cohort.
+    """
+    _cohort = None  # Placeholder for all loaded patients belonging to the cohort of interest
+    _fail_fast = False  # Whether to stop the computation if any patient cannot be used
+    _report = None  # Collected header information and issues, one row per file
+    _affine_tolerance = 1e-3  # Maximum absolute difference between the affine matrices of files in the same space
+
+    def __init__(self, fail_fast: bool = None):
+        self.__reset()
+        self._fail_fast = fail_fast if fail_fast is not None else SharedResources.getInstance().preflight_fail_fast
+
+    @property
+    def cohort(self):
+        return self._cohort
+
+    @cohort.setter
+    def cohort(self, input_cohort) -> None:
+        self._cohort = input_cohort
+
+    @property
+    def fail_fast(self) -> bool:
+        return self._fail_fast
+
+    @fail_fast.setter
+    def fail_fast(self, state: bool) -> None:
+        self._fail_fast = state
+
+    @property
+    def report(self) -> pd.DataFrame:
+        return self._report
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cohort = None
+        self._fail_fast = False
+        self._report = None
+
+    def setup(self, cohort) -> None:
+        """
+        :param cohort: Container for all loaded patients.
+        :return: None
+        """
+        self.cohort = cohort
+
+    def run(self) -> None:
+        """
+        Collects the headers of all files in parallel, prints and saves the report (preflight_report.csv inside the
+        output folder), and stores the list of rejected files inside the cohort.
+        :return: None
+        """
+        atlas_fn = SharedResources.getInstance().mni_atlas_filepath_T1
+        atlas_header = read_nifti_header(atlas_fn)
+        if atlas_header[0] is None:
+            raise ValueError("[PreflightProcessor] The atlas could not be read from {}.".format(atlas_fn))
+
+        files = []
+        for p in self.cohort.patients:
+            patient = self.cohort.patients[p]
+            for kind, fn in [["volume", patient.volume_filepath], ["label", patient.label_filepath],
+                             ["mask", patient.mask_filepath], ["registered_volume", patient.registered_volume_filepath],
+                             ["registered_label", patient.registered_label_filepath]]:
+                if fn is not None:
+                    files.append([patient.patient_id, kind, fn])
+
+        with ThreadPoolExecutor() as executor:
+            headers = list(executor.map(read_nifti_header, [x[2] for x in files]))
+
+        rows = []
+        patient_headers = {}
+        for (pid, kind, fn), header in zip(files, headers):
+            patient_headers.setdefault(pid, {})[kind] = header
+            rows.append([pid, kind, fn] + self.__format_header(header))
+        report = pd.DataFrame(rows, columns=["Patient", "Type", "Filepath", "Shape", "Zooms", "Dtype", "Status",
+                                             "Issues"])
+
+        for idx in range(len(report)):
+            if report.loc[idx, "Status"] == "error":
+                continue
+            pid, kind = report.loc[idx, "Patient"], report.loc[idx, "Type"]
+            errors, warnings = self.__check_file(kind, patient_headers[pid], atlas_header)
+            report.loc[idx, "Status"] = "error" if len(errors) != 0 else ("warning" if len(warnings) != 0 else "ok")
+            report.loc[idx, "Issues"] = '; '.join(errors + warnings)
+        self._report = report
+
+        invalid_patients = list(np.unique(report.loc[report["Status"] == "error"]["Patient"].values))
+        # All files of a patient with errors are rejected, the files produced by the later stages being usable.
+        self.cohort.rejected_files = set(report.loc[report["Patient"].isin(invalid_patients)]["Filepath"].values)
+        report_fn = os.path.join(SharedResources.getInstance().maps_output_folder, 'preflight_report.csv')
+        report.to_csv(report_fn, index=False)
+
+        print("Preflight check over {} files for {} patients: {} with errors, {} with warnings.".format(
+            len(report), len(patient_headers), len(invalid_patients),
+            len(np.unique(report.loc[report["Status"] == "warning"]["Patient"].values))))
+        for _, row in report.loc[report["Status"] != "ok"].iterrows():
+            print("  [{}] {} ({}): {}".format(row["Status"], row["Patient"], row["Type"], row["Issues"]))
+        print("Full preflight report saved in {}.".format(report_fn))
+
+        if self.fail_fast and len(invalid_patients) != 0:
+            raise ValueError("[PreflightProcessor] {} patients cannot be used, stopping as requested.".format(
+                len(invalid_patients)))
+
+    def __format_header(self, header: Tuple) -> List:
+        """
+        Formats the collected header information for the report, files which could not be read being flagged.
+        """
+        shape, affine, zooms, dtype, issue = header
+        if shape is None:
+            return ['', '', '', "error", issue]
+        return ['x'.join([str(x) for x in shape]), 'x'.join(['{:.3f}'.format(x) for x in zooms]), str(dtype), "", ""]
+
+    def __check_file(self, kind: str, headers: dict, atlas_header: Tuple) -> Tuple[List[str], List[str]]:
+        """
+        Compares the header of one file against the atlas, and against the other files of the patient in the same
+        space.
+        :param kind: Type of the file, to sample from [volume, label, mask, registered_volume, registered_label].
+        :param headers: Collected header information for all files of the patient, indexed by type.
+        :param atlas_header: Header information of the atlas.
+        :return: Lists of errors and warnings for the file.
+        """
+        errors = []
+        warnings = []
+        shape, affine, zooms, dtype, _ = headers[kind]
+        if len(shape) < 3:
+            errors.append("{}D {}".format(len(shape), kind.replace('_', ' ')))
+        elif len(shape) > 3:
+            # The 4D and DWI volumes are reduced to their first 3D volume by load_nifti_volume, but not the annotations.
+            if kind in ["volume", "registered_volume"]:
+                warnings.append("{}D volume, only the first 3D volume is used".format(len(shape)))
+            else:
+                errors.append("{}D annotation".format(len(shape)))
+
+        if kind in ["label", "mask", "registered_label"] and not np.issubdtype(dtype, np.integer):
+            warnings.append("non-integer data type {}".format(dtype))
+
+        if kind in ["label", "mask"] and "volume" in headers and headers["volume"][0] is not None:
+            reference = headers["volume"]
+            if shape[:3] != reference[0][:3]:
+                errors.append("shape differs from the volume ({})".format('x'.join([str(x) for x in reference[0]])))
+            elif not np.allclose(affine, reference[1], atol=self._affine_tolerance):
+                warnings.append("affine differs from the volume")
+        elif kind in ["registered_volume", "registered_label"]:
+            if shape[:3] != atlas_header[0][:3]:
+                errors.append("shape differs from the atlas ({})".format('x'.join([str(x) for x in atlas_header[0]])))
+            else:
+                if not np.allclose(affine, atlas_header[1], atol=self._affine_tolerance):
+                    warnings.append("affine differs from the atlas")
+                if not np.allclose(zooms[:3], atlas_header[2][:3], atol=self._affine_tolerance):
+                    warnings.append("voxel size differs from the atlas")
+        return errors, warnings
+
+
+def read_nifti_header(filepath: str) -> Tuple:
+    """
+    Reads the header of a NIfTI file, without loading its content.
+    :param filepath: Location on disk of the NIfTI file.
+    :return: Shape, affine, voxel size, on-disk data type, and the issue met if the header could not be read.
+    """
+    try:
+        if not os.path.exists(filepath):
+            return None, None, None, None, "missing file"
+        image_ni = nib.load(filepath)
+        return (tuple(image_ni.shape), image_ni.affine, tuple([float(x) for x in image_ni.header.get_zooms()]),
+                image_ni.get_data_dtype(), None)
+    except Exception as e:
+        logging.debug("Header of {} could not be read with: {}".format(filepath, traceback.format_exc()))
+        return None, None, None, None, "unreadable header"
@@ -0,0 +1,163 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import traceback
+from typing import Tuple, Union
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from ..Computation.registration_step import RegistrationStep
+from ..Utils.resources import SharedResources
+
+
+class RegistrationComputationProcessor:
+    """
+    Registration of all patients of the cohort to the atlas space, with one RegistrationStep per patient.
+    Patients are distributed over a pool of worker processes, each step running inside its own scratch folder such
+    that the temporary files of different patients cannot collide. A failure is confined to the patient it occurred
+    for, which is reported and left aside while the rest of the cohort proceeds.
+    """
+    _cohort = None  # Placeholder for all loaded patients belonging to the cohort of interest
+    _workers = 1  # Number of parallel processes used to register the patients
+    _scratch_folder = None  # Folder holding the per-patient scratch folders
+    _report = None  # Outcome of the registration for each patient
+
+    def __init__(self, workers: int = None):
+        self.__reset()
+        self._workers = workers if workers is not None else SharedResources.getInstance().maps_registration_workers
+        self._scratch_folder = os.path.join(SharedResources.getInstance().maps_output_folder, '.scratch')
+
+    @property
+    def cohort(self):
+        return self._cohort
+
+    @cohort.setter
+    def cohort(self, input_cohort) -> None:
+        self._cohort = input_cohort
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @workers.setter
+    def workers(self, w: int) -> None:
+        self._workers = w
+
+    @property
+    def report(self) -> pd.DataFrame:
+        return self._report
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cohort = None
+        self._workers = 1
+        self._scratch_folder = None
+        self._report = None
+
+    def setup(self, cohort) -> None:
+        """
+        :param cohort: Container for all loaded patients.
+        :return: None
+        """
+        self.cohort = cohort
+
+    def run(self) -> None:
+        """
+        Registers all patients not yet registered, whose volume and annotation passed the preflight check if performed.
+        The registered patients are updated inside the cohort, and the outcome for each patient is saved in
+        registration_report.csv inside the output folder.
+        :return: None
+        """
+        patients = []
+        for p in self.cohort.patients:
+            pat = self.cohort.patients[p]
+            if not (self.cohort.is_file_validated(pat.volume_filepath)
+                    and self.cohort.is_file_validated(pat.label_filepath)):
+                continue
+            if len(pat.registrations.keys()) != 0 and pat.registered_label_filepath is not None:
+                continue
+            if pat.mask_filepath is not None and not self.cohort.is_file_validated(pat.mask_filepath):
+                logging.warning("Brain mask of patient {} discarded by the preflight check, the brain is segmented "
+                                "instead.".format(pat.patient_id))
+                pat.mask_filepath = None
+            patients.append(p)
+
+        os.makedirs(self._scratch_folder, exist_ok=True)
+        results = []
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1 or len(patients) <= 1:
+            for p in tqdm(patients):
+                results.append([p] + list(register_patient(self.cohort.patients[p], self._scratch_folder)))
+        else:
+            logging.info("Registering {} patients with {} workers of {} threads.".format(len(patients), jobs, threads))
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_registration_worker,
+                                     initargs=(SharedResources.getInstance().config_filename, threads)) as executor:
+                futures = {executor.submit(register_patient, self.cohort.patients[p], self._scratch_folder): p
+                           for p in patients}
+                for f in tqdm(as_completed(futures), total=len(futures)):
+                    p = futures[f]
+                    try:
+                        results.append([p] + list(f.result()))
+                    except Exception as e:
+                        # Only happening if the worker process itself died (e.g., out of memory).
+                        logging.error("Registration worker for patient {} terminated with: {}".format(
+                            self.cohort.patients[p].patient_id, e))
+                        results.append([p, None, 0., "Worker process terminated abruptly ({})".format(e)])
+
+        rows = []
+        for p, pat, elapsed, error in results:
+            if pat is not None:
+                self.cohort.patients[p] = pat
+            rows.append([self.cohort.patients[p].patient_id, "failed" if error is not None else "done", elapsed,
+                         error if error is not None else ""])
+        self._report = pd.DataFrame(rows, columns=["Patient", "Status", "Elapsed (s)", "Error"])
+        self._report.to_csv(os.path.join(SharedResources.getInstance().maps_output_folder,
+                                         'registration_report.csv'), index=False)
+        if os.path.exists(self._scratch_folder) and len(os.listdir(self._scratch_folder)) == 0:
+            os.rmdir(self._scratch_folder)
+
+        failures = self._report.loc[self._report["Status"] == "failed"]
+        print("Registration of {} patients: {} failed.".format(len(self._report), len(failures)))
+        for _, row in failures.iterrows():
+            print("  {}: {}".format(row["Patient"], row["Error"]))
+
+
+def init_registration_worker(config_filename: str, threads: int) -> None:
+    """
+    Sets up the runtime parameters inside a worker process, when not inherited from the parent process, and
+    constrains the number of threads the worker uses.
+    :param config_filename: Filepath to the *.ini with the user-specific runtime parameters.
+    :param threads: Number of threads for the worker.
+    :return: None
+    """
+    if SharedResources.getInstance().config_filename is None and config_filename is not None:
+        SharedResources.getInstance().set_environment(config_filename=config_filename)
+    SharedResources.getInstance().set_job_threads(threads)
+
+
+def register_patient(patient, scratch_root: str) -> Tuple[Union[None, object], float, Union[None, str]]:
+    """
+    Registers one patient to the atlas space, inside a dedicated scratch folder removed afterwards.
+    :param patient: PatientStructure instance to register.
+    :param scratch_root: Folder where the patient-specific scratch folder is created.
+    :return: Updated patient (None if the registration failed), elapsed time in seconds, and error message if any.
+    """
+    start = time.time()
+    scratch_folder = tempfile.mkdtemp(prefix=patient.patient_id + '_', dir=scratch_root)
+    try:
+        processor = RegistrationStep(scratch_folder=scratch_folder)
+        processor.setup(patient)
+        patient = processor.execute()
+        return patient, time.time() - start, None
+    except Exception as e:
+        logging.error("Registration failed for patient {} with: \n{}".format(patient.patient_id,
+                                                                             traceback.format_exc()))
+        return None, time.time() - start, str(e)
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
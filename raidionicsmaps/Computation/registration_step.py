@@ -6,9 +6,13 @@ import logging
 import configparser
 import json
 import traceback
+from typing import List
 from ..Utils.resources import SharedResources
 from ..Utils.io import load_nifti_volume
+from ..Utils.staging import stage_file
+from ..Utils.rads_session import RadsSession
 from ..Utils.ants_registration import *
+from ..Utils.registration_cache import RegistrationCache, get_registration_settings
 from ..Structures.RegistrationStructure import Registration
 
 
@@ -24,16 +28,23 @@ class RegistrationStep():
     _registration_runner = None
     _step_input_folder = None
     _step_output_folder = None
+    _scratch_folder = None  # Folder holding all temporary files, which must be specific to each step running in parallel
+    _registration_cache = None  # Global cache of registrations shared across runs, if enabled
+    _cache_key = None  # Identifier of the registration inside the cache
 
-    def __init__(self):
+    def __init__(self, scratch_folder: str = None):
+        """
+        :param scratch_folder: Folder where all temporary files are stored (the output folder by default). Steps
+        running in parallel must each be given their own scratch folder.
+        """
         self.__reset()
-        self._registration_runner = ANTsRegistration()
-        self._step_input_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                             'pipeline_input'))
-        os.makedirs(self._step_input_folder)
-        self._step_output_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                        'pipeline_output'))
-        os.makedirs(self._step_output_folder)
+        self._scratch_folder = scratch_folder if scratch_folder is not None else SharedResources.getInstance().maps_output_folder
+        self._registration_runner = ANTsRegistration(registration_folder=os.path.join(self._scratch_folder,
+                                                                                      'registration'))
+        self._step_input_folder = os.path.join(self._scratch_folder, 'pipeline_input')
+        os.makedirs(self._step_input_folder, exist_ok=True)
+        self._step_output_folder = os.path.join(self._scratch_folder, 'pipeline_output')
+        os.makedirs(self._step_output_folder, exist_ok=True)
 
     def __reset(self):
         self._patient_parameters = None
@@ -47,6 +58,9 @@ class RegistrationStep():
         self._fixed_mask_filepath = None
         self._step_input_folder = None
         self._step_output_folder = None
+        self._scratch_folder = None
+        self._registration_cache = None
+        self._cache_key = None
 
     @property
     def patient_parameters(self) -> str:
@@ -65,18 +79,33 @@ class RegistrationStep():
             self._moving_volume_filepath = self.patient_parameters.volume_filepath
             self._fixed_volume_filepath = SharedResources.getInstance().mni_atlas_filepath_T1
 
+            # Logs and timings of the ANTs executables kept with the patient results.
+            self._registration_runner.log_folder = self.patient_parameters.output_folderpath
+
             ts_path = os.path.join(self._step_input_folder, "T0")
-            os.makedirs(ts_path)
+            os.makedirs(ts_path, exist_ok=True)
 
             dest_basename = SharedResources.getInstance().maps_sequence_type + '_' + os.path.basename(self._moving_volume_filepath)
             if SharedResources.getInstance().maps_sequence_type == "T1-CE":
                 dest_basename = "T1gd" + '_' + os.path.basename(self._moving_volume_filepath)
-            shutil.copyfile(src=self._moving_volume_filepath,
-                            dst=os.path.join(ts_path, dest_basename))
+            stage_file(src=self._moving_volume_filepath, dst=os.path.join(ts_path, dest_basename))
             if self.patient_parameters.mask_filepath is not None:
-                shutil.copyfile(src=self.patient_parameters.mask_filepath,
-                                dst=os.path.join(ts_path, dest_basename))
+                # Named as a brain annotation of the volume, for raidionics_rads to use it instead of segmenting it.
+                mask_basename = dest_basename.split('.')[0] + '_label_Brain.' + \
+                                '.'.join(os.path.basename(self.patient_parameters.mask_filepath).split('.')[1:])
+                stage_file(src=self.patient_parameters.mask_filepath, dst=os.path.join(ts_path, mask_basename))
 
+            if SharedResources.getInstance().registration_cache:
+                try:
+                    self._registration_cache = RegistrationCache()
+                    self._cache_key = self._registration_cache.get_entry_key(moving=self._moving_volume_filepath,
+                                                                             fixed=self._fixed_volume_filepath,
+                                                                             settings=get_registration_settings(),
+                                                                             mask=self.patient_parameters.mask_filepath)
+                except Exception as e:
+                    logging.warning("[RegistrationStep] Registration cache disabled for patient {}, with: {}".format(
+                        self.patient_parameters.patient_id, e))
+                    self._registration_cache = None
         except Exception as e:
             logging.error("[RegistrationStep] Setting up process failed with {}".format(traceback.format_exc()))
             raise ValueError("[RegistrationStep] Setting up process failed.")
@@ -85,13 +114,16 @@ class RegistrationStep():
         try:
             # Flag for skipping registration if transform files already exist
             if len(self.patient_parameters.registrations.keys()) == 0:
-                self.__registration()
+                if not self.__restore_registration_from_cache():
+                    self.__registration()
 
             # Flag for skipping applying registration to annotation files if they exist already
             if self.patient_parameters.registered_label_filepath is None:
                 self.__apply_registration()
 
             self._registration_runner.clear_cache()
+            if self._registration_cache is not None:
+                self._registration_cache.evict()
 
             if os.path.exists(self._step_input_folder):
                 shutil.rmtree(self._step_input_folder)
@@ -109,6 +141,10 @@ class RegistrationStep():
         return self._patient_parameters
 
     def __registration(self):
+        if SharedResources.getInstance().maps_registration_preset is not None:
+            self.__preset_registration(SharedResources.getInstance().maps_registration_preset)
+            return
+
         # Setting up the runtime configuration file, mandatory for the raidionics_rads_lib to run.
         rads_config = configparser.ConfigParser()
         rads_config.add_section('Default')
@@ -137,8 +173,7 @@ class RegistrationStep():
             rads_config.write(outfile)
 
         try:
-            from raidionicsrads.compute import run_rads
-            run_rads(rads_config_filename)
+            RadsSession.getInstance().run(rads_config_filename)
         except Exception:
             if os.path.exists(self._step_input_folder):
                 shutil.rmtree(self._step_input_folder)
@@ -162,6 +197,108 @@ class RegistrationStep():
                 elif 'inverse' in f:
                     reg_transform_inverse.append(os.path.join(transform_folder[0], f))
             break
+        self.__include_registration(reg_transform_forward, reg_transform_inverse)
+        if self._registration_cache is not None:
+            self._registration_cache.store_transforms(self._cache_key, forward=reg_transform_forward,
+                                                      inverse=reg_transform_inverse,
+                                                      description={"patient": self.patient_parameters.patient_id,
+                                                                   "moving": self._moving_volume_filepath,
+                                                                   "fixed": self._fixed_volume_filepath,
+                                                                   "settings": get_registration_settings()})
+
+    def __preset_registration(self, preset: str) -> None:
+        """
+        Registration directly performed with ANTs following one of the speed/accuracy presets, instead of through the
+        raidionics_rads pipeline. If a brain mask is provided, both the patient volume and the atlas are brain-masked
+        beforehand.
+        :param preset: Name of the registration preset, from REGISTRATION_PRESETS.
+        """
+        if preset not in REGISTRATION_PRESETS:
+            raise ValueError("Unknown registration preset {}, to sample from [{}].".format(
+                preset, ', '.join(REGISTRATION_PRESETS.keys())))
+
+        moving_filepath = self._moving_volume_filepath
+        fixed_filepath = self._fixed_volume_filepath
+        if self.patient_parameters.mask_filepath is not None and \
+                os.path.exists(SharedResources.getInstance().mni_atlas_brain_mask_filepath):
+            moving_filepath = self.__apply_brain_mask(moving_filepath, self.patient_parameters.mask_filepath,
+                                                      os.path.join(self._step_input_folder, 'moving_masked.nii.gz'))
+            fixed_filepath = self.__apply_brain_mask(fixed_filepath,
+                                                     SharedResources.getInstance().mni_atlas_brain_mask_filepath,
+                                                     os.path.join(self._step_input_folder, 'fixed_masked.nii.gz'))
+
+        self._registration_runner.compute_registration(moving=moving_filepath, fixed=fixed_filepath,
+                                                       registration_method=preset)
+        # Named as by the raidionics_rads pipeline, for the transforms to be identified when loading the patient.
+        transform_folder = os.path.join(self._step_output_folder, "Transforms", preset)
+        os.makedirs(transform_folder, exist_ok=True)
+        reg_transform_forward = []
+        reg_transform_inverse = []
+        for kind, transforms, dest_list in [["forward", self._registration_runner.reg_transform['fwdtransforms'],
+                                             reg_transform_forward],
+                                            ["inverse", self._registration_runner.reg_transform['invtransforms'],
+                                             reg_transform_inverse]]:
+            for fp in transforms:
+                dest_list.append(os.path.join(transform_folder, kind + '_' + os.path.basename(fp)))
+                stage_file(fp, dest_list[-1], allow_symlink=False)
+        self._registration_runner.clear_cache()
+        # The inverse transforms are already in ANTs order, while __include_registration expects them reversed.
+        reg_transform_inverse = reg_transform_inverse[::-1]
+        self.__include_registration(reg_transform_forward, reg_transform_inverse)
+        if self._registration_cache is not None:
+            self._registration_cache.store_transforms(self._cache_key, forward=reg_transform_forward,
+                                                      inverse=reg_transform_inverse,
+                                                      description={"patient": self.patient_parameters.patient_id,
+                                                                   "moving": self._moving_volume_filepath,
+                                                                   "fixed": self._fixed_volume_filepath,
+                                                                   "settings": get_registration_settings()})
+
+    def __apply_brain_mask(self, volume_filepath: str, mask_filepath: str, output_filepath: str) -> str:
+        """
+        Zeroes the volume intensities outside of the brain mask.
+        """
+        volume_ni = load_nifti_volume(volume_filepath)
+        volume = volume_ni.get_fdata()[:]
+        mask = load_nifti_volume(mask_filepath).get_fdata()[:]
+        volume[mask == 0] = 0
+        nib.save(nib.Nifti1Image(volume.astype('float32'), volume_ni.affine), output_filepath)
+        return output_filepath
+
+    def __restore_registration_from_cache(self) -> bool:
+        """
+        Retrieves the transforms from the registration cache, copied inside the scratch folder as if just computed.
+        :return: True if the registration was found in the cache, False otherwise.
+        """
+        if self._registration_cache is None:
+            return False
+        entry = self._registration_cache.lookup(self._cache_key)
+        if entry is None:
+            return False
+        try:
+            reg_transform_forward = []
+            reg_transform_inverse = []
+            for kind, filepaths, dest_list in [["forward", entry["forward"], reg_transform_forward],
+                                               ["inverse", entry["inverse"], reg_transform_inverse]]:
+                dest_folder = os.path.join(self._step_output_folder, "Transforms", "cache", kind)
+                os.makedirs(dest_folder, exist_ok=True)
+                for fp in filepaths:
+                    dest_list.append(os.path.join(dest_folder, os.path.basename(fp)))
+                    # Not symlinked, as the cache entry might be evicted while still in use.
+                    stage_file(fp, dest_list[-1], allow_symlink=False)
+        except Exception as e:
+            # The entry might have been concurrently evicted by another process.
+            logging.warning("[RegistrationStep] Cached registration could not be restored for patient {}.".format(
+                self.patient_parameters.patient_id))
+            return False
+        logging.info("[RegistrationStep] Registration restored from the cache for patient {}.".format(
+            self.patient_parameters.patient_id))
+        self.__include_registration(reg_transform_forward, reg_transform_inverse)
+        return True
+
+    def __include_registration(self, reg_transform_forward: List[str], reg_transform_inverse: List[str]) -> None:
+        """
+        Saves the transforms inside the patient folder, and sets them up for applying the registration.
+        """
         non_available_uid = True
         reg_uid = None
         while non_available_uid:
@@ -180,14 +317,7 @@ class RegistrationStep():
         self._registration_runner.inverse_transform_names = reg_transform_inverse[::-1]
         self._registration_runner.reg_transform['fwdtransforms'] = reg_transform_forward
         self._registration_runner.reg_transform['invtransforms'] = reg_transform_inverse[::-1]
-
-        #@TODO. Should include the brain mask also if computed during this step, or we don't care?
-        if self.patient_parameters.mask_filepath is None:
-            brain_mask_filename = None
-            for _, _, files in os.walk(os.path.join(self._step_output_folder, "T0")):
-                for f in files:
-                    brain_mask_filename = (os.path.join(self._step_output_folder, "T0", f))
-                break
+        self._registration_runner.composite_folder = registration.output_folder
 
     def __generate_registration_pipeline(self):
         timestamp_order = 0
@@ -203,21 +333,23 @@ class RegistrationStep():
         # pip[pip_num]["model"] = "MRI_Sequence_Classifier"
         # pip[pip_num]["description"] = "Classification of the MRI sequence type for all input scans."
 
-        pip_num_int = pip_num_int + 1
-        pip_num = str(pip_num_int)
-        pip[pip_num] = {}
-        pip[pip_num]["task"] = 'Segmentation'
-        pip[pip_num]["inputs"] = {}
-        pip[pip_num]["inputs"]["0"] = {}
-        pip[pip_num]["inputs"]["0"]["timestamp"] = timestamp_order
-        pip[pip_num]["inputs"]["0"]["sequence"] = im_seq
-        pip[pip_num]["inputs"]["0"]["labels"] = None
-        pip[pip_num]["inputs"]["0"]["space"] = {}
-        pip[pip_num]["inputs"]["0"]["space"]["timestamp"] = timestamp_order
-        pip[pip_num]["inputs"]["0"]["space"]["sequence"] = im_seq
-        pip[pip_num]["target"] = ['Brain']
-        pip[pip_num]["model"] = "MRI_Brain"
-        pip[pip_num]["description"] = "Brain segmentation in " + im_seq + " (T" + str(timestamp_order) + ")"
+        # A provided brain mask is staged as the brain annotation of the volume, and directly used by the registration.
+        if self.patient_parameters.mask_filepath is None:
+            pip_num_int = pip_num_int + 1
+            pip_num = str(pip_num_int)
+            pip[pip_num] = {}
+            pip[pip_num]["task"] = 'Segmentation'
+            pip[pip_num]["inputs"] = {}
+            pip[pip_num]["inputs"]["0"] = {}
+            pip[pip_num]["inputs"]["0"]["timestamp"] = timestamp_order
+            pip[pip_num]["inputs"]["0"]["sequence"] = im_seq
+            pip[pip_num]["inputs"]["0"]["labels"] = None
+            pip[pip_num]["inputs"]["0"]["space"] = {}
+            pip[pip_num]["inputs"]["0"]["space"]["timestamp"] = timestamp_order
+            pip[pip_num]["inputs"]["0"]["space"]["sequence"] = im_seq
+            pip[pip_num]["target"] = ['Brain']
+            pip[pip_num]["model"] = "MRI_Brain"
+            pip[pip_num]["description"] = "Brain segmentation in " + im_seq + " (T" + str(timestamp_order) + ")"
 
         pip_num_int = pip_num_int + 1
         pip_num = str(pip_num_int)
@@ -234,21 +366,51 @@ class RegistrationStep():
         return pip
 
     def __apply_registration(self):
+        """
+        Warps the volume and the annotation of the patient to the atlas space, in a single batched call sharing the
+        loaded atlas, unless already available in the registration cache.
+        """
         try:
-            reg_input_fn = self._registration_runner.apply_registration_transform(fixed=self._fixed_volume_filepath,
-                                                                                  moving=self._moving_volume_filepath,
-                                                                                  interpolation='linear')
-            shutil.move(reg_input_fn, os.path.join(self.patient_parameters.output_folderpath, 'input_reg_mni.nii.gz'))
-            self.patient_parameters.registered_volume_filepaths = os.path.join(self.patient_parameters.output_folderpath,
-                                                                               'input_reg_mni.nii.gz')
+            reg_volume_fn = os.path.join(self.patient_parameters.output_folderpath, 'input_reg_mni.nii.gz')
             moving_filepath = self.patient_parameters.label_filepath
-            reg_anno_fn = self._registration_runner.apply_registration_transform(fixed=self._fixed_volume_filepath,
-                                                                                 moving=moving_filepath)
             reg_base_name = 'input_reg_mni_' + SharedResources.getInstance().maps_gt_files_suffix
-            shutil.move(reg_anno_fn, os.path.join(self.patient_parameters.output_folderpath, reg_base_name))
-            self.patient_parameters.registered_label_filepath = os.path.join(self.patient_parameters.output_folderpath,
-                                                                              reg_base_name)
+            reg_label_fn = os.path.join(self.patient_parameters.output_folderpath, reg_base_name)
+            label_name = None
+            if self._registration_cache is not None:
+                label_name = 'label_' + self._registration_cache.get_file_hash(moving_filepath)
+
+            # Each entry holds the moving image, interpolation, destination, and name inside the registration cache.
+            warps = [[self._moving_volume_filepath, 'linear', reg_volume_fn, 'volume'],
+                     [moving_filepath, 'nearestNeighbor', reg_label_fn, label_name]]
+            warps = [w for w in warps if not self.__restore_warped_from_cache(w[3], w[2])]
+            if len(warps) != 0:
+                warped_fns = self._registration_runner.apply_registration_transforms(
+                    moving=[w[0] for w in warps], fixed=self._fixed_volume_filepath,
+                    interpolations=[w[1] for w in warps])
+                for w, warped_fn in zip(warps, warped_fns):
+                    shutil.move(warped_fn, w[2])
+                    self.__store_warped_in_cache(w[3], w[2])
+            self.patient_parameters.registered_volume_filepaths = reg_volume_fn
+            self.patient_parameters.registered_label_filepath = reg_label_fn
         except Exception as e:
             logging.error("[RegistrationStep] Apply registration failed with: {}.".format(traceback.format_exc()))
             self._registration_runner.clear_cache()
             raise ValueError("[RegistrationStep] Apply registration failed.")
+
+    def __restore_warped_from_cache(self, name: str, destination: str) -> bool:
+        """
+        :param name: Identifier of the warped image inside the registration cache entry.
+        :param destination: Filepath where the warped image should be copied.
+        :return: True if the warped image was found in the registration cache, False otherwise.
+        """
+        if self._registration_cache is None:
+            return False
+        return self._registration_cache.restore_warped(self._cache_key, name, destination)
+
+    def __store_warped_in_cache(self, name: str, filepath: str) -> None:
+        """
+        :param name: Identifier of the warped image inside the registration cache entry.
+        :param filepath: Location on disk of the warped image.
+        """
+        if self._registration_cache is not None:
+            self._registration_cache.store_warped(self._cache_key, name, filepath)
@@ -5,34 +5,41 @@ import nibabel as nib
 import logging
 import traceback
 import pandas as pd
-from scipy.ndimage import measurements
 from skimage.measure import regionprops
 
 from ..Utils.resources import SharedResources
 from ..Utils.utils import *
 from ..Structures.MetricsStructure import Metrics
+from ..Structures.VolumeContextStructure import VolumeContext
 
 
 class SizeComputationStep():
     _patient_parameters = None  # Placeholder for all patient related data
     _step_input_folder = None
     _step_output_folder = None
+    _scratch_folder = None  # Folder holding all temporary files, which must be specific to each step running in parallel
     _registered_volume_filepath = None
+    _volume_context = None  # In-memory registered volumes of the patient, shared with the other metrics steps
 
-    def __init__(self):
+    def __init__(self, scratch_folder: str = None):
+        """
+        :param scratch_folder: Folder where all temporary files are stored (the output folder by default). Steps
+        running in parallel must each be given their own scratch folder.
+        """
         self.__reset()
-        self._step_input_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                            'pipeline_input'))
-        os.makedirs(self._step_input_folder)
-        self._step_output_folder = os.path.join(os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                             'pipeline_output'))
-        os.makedirs(self._step_output_folder)
+        self._scratch_folder = scratch_folder if scratch_folder is not None else SharedResources.getInstance().maps_output_folder
+        self._step_input_folder = os.path.join(self._scratch_folder, 'pipeline_input')
+        os.makedirs(self._step_input_folder, exist_ok=True)
+        self._step_output_folder = os.path.join(self._scratch_folder, 'pipeline_output')
+        os.makedirs(self._step_output_folder, exist_ok=True)
 
     def __reset(self):
         self._patient_parameters = None
         self._step_input_folder = None
         self._step_output_folder = None
+        self._scratch_folder = None
         self._registered_volume_filepath = None
+        self._volume_context = None
 
     @property
     def patient_parameters(self) -> str:
@@ -50,15 +57,17 @@ class SizeComputationStep():
     def registered_volume_filepath(self, fp: str) -> None:
         self._registered_volume_filepath = fp
 
-    def setup(self, patient_parameters):
+    def setup(self, patient_parameters, volume_context: VolumeContext = None):
         """
-
+        :param patient_parameters: PatientStructure instance, registered to the MNI space.
+        :param volume_context: Registered volumes of the patient already in memory, shared with the other metrics
+        steps (loaded for this step only if None).
         """
         self.patient_parameters = patient_parameters
         try:
-            self.registered_volume_filepath = os.path.join(SharedResources.getInstance().maps_output_folder,
-                                                           self.patient_parameters.patient_id,
-                                                           "input_reg_mni_" + SharedResources.getInstance().maps_gt_files_suffix)
+            self._volume_context = volume_context if volume_context is not None else \
+                VolumeContext(self.patient_parameters.patient_id)
+            self.registered_volume_filepath = self._volume_context.mask_filepath
             if not os.path.exists(self.registered_volume_filepath):
                 raise ValueError("No registered volume in MNI space can be found for computing size-related metrics.")
         except Exception as e:
@@ -93,28 +102,29 @@ class SizeComputationStep():
     def __compute_size(self):
         try:
             size_metrics = []
-            labels_ni = nib.load(self.registered_volume_filepath)
-            labels = labels_ni.get_fdata().astype('uint8')
-            voxel_size = np.prod(labels_ni.header.get_zooms()[0:3])
+            labels = self._volume_context.mask
+            voxel_size = np.prod(self._volume_context.spacing[0:3])
             volume_pixels = np.count_nonzero(labels != 0)  # Might be more than one label, but not considering it yet
             volume_mmcube = voxel_size * volume_pixels
             volume_ml = volume_mmcube * 1e-3
 
-            # Computing some other parameters for the main tumor component, not for other foci
-            if len(labels.shape) == 4:  # Still some cases with a fourth dimension...
-                labels = labels[..., 0]
-            tumor_clusters = measurements.label(labels)[0]
-            tumor_clusters_labels = regionprops(tumor_clusters)
-            # Sorting by cluster size to get the parameters of the main component.
-            tumor_clusters_labels = sorted(tumor_clusters_labels, key=lambda r: r.area, reverse=True)
-
             long_axis_mm = -1
             short_axis_mm = -1
             diameter_x = -1
             diameter_y = -1
             diameter_z = -1
 
-            if volume_pixels > 0:
+            if volume_pixels == 0:
+                logging.warning("Empty annotation mask for patient {}, the volume is left to zero and all diameters "
+                                "to -1.".format(self.patient_parameters.patient_id))
+            else:
+                # Computing some other parameters for the main tumor component, not for other foci, within the
+                # bounding box of the annotation (the axis lengths and diameters being identical to the whole volume
+                # ones).
+                tumor_clusters = self._volume_context.components[0]
+                tumor_clusters_labels = regionprops(tumor_clusters)
+                # Sorting by cluster size to get the parameters of the main component.
+                tumor_clusters_labels = sorted(tumor_clusters_labels, key=lambda r: r.area, reverse=True)
                 long_axis_mm = tumor_clusters_labels[0].major_axis_length
                 short_axis_mm = tumor_clusters_labels[0].minor_axis_length
                 diameter_x = (tumor_clusters_labels[0].bbox[3] - tumor_clusters_labels[0].bbox[0]) * voxel_size
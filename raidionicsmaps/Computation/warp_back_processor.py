@@ -0,0 +1,245 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+import traceback
+from typing import List, Tuple, Union
+import numpy as np
+import nibabel as nib
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+
+from ..Utils.resources import SharedResources
+from ..Utils.ants_registration import ANTsRegistration
+
+# Atlas-space sources loaded inside the current (worker) process, indexed by filepath, with their interpolation and
+# output voxel type.
+_warp_back_sources = {}
+
+
+class WarpBackProcessor:
+    """
+    Projection of atlas-space images (e.g., a population heatmap or atlas regions) into the native space of every
+    registered patient, through the inverse transforms saved inside each patient folder.
+    Each source is loaded once per process, and each patient volume, used as reference, once for all sources. Patients
+    are distributed over a pool of worker processes. The native-space images are saved compressed inside each patient
+    output folder, as native_<source name>.nii.gz, and only computed again if the source or the transforms changed.
+    """
+    _cohort = None  # Placeholder for all loaded patients belonging to the cohort of interest
+    _sources = []  # Atlas-space images to project into the native space of each patient
+    _workers = 1  # Number of parallel processes used to warp the patients
+    _scratch_folder = None  # Folder holding the per-patient scratch folders
+    _report = None  # Outcome of the warp back for each patient
+
+    def __init__(self, sources: List[str] = None, workers: int = None):
+        self.__reset()
+        self._sources = sources if sources is not None else SharedResources.getInstance().maps_warp_back_sources
+        self._workers = workers if workers is not None else SharedResources.getInstance().maps_warp_back_workers
+        self._scratch_folder = os.path.join(SharedResources.getInstance().maps_output_folder, '.scratch')
+
+    @property
+    def cohort(self):
+        return self._cohort
+
+    @cohort.setter
+    def cohort(self, input_cohort) -> None:
+        self._cohort = input_cohort
+
+    @property
+    def sources(self) -> List[str]:
+        return self._sources
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def report(self) -> pd.DataFrame:
+        return self._report
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cohort = None
+        self._sources = []
+        self._workers = 1
+        self._scratch_folder = None
+        self._report = None
+
+    def setup(self, cohort) -> None:
+        """
+        :param cohort: Container for all loaded patients.
+        :return: None
+        """
+        self.cohort = cohort
+        for fp in self.sources:
+            if not os.path.exists(fp):
+                raise ValueError("Warp back source {} not found on disk.".format(fp))
+
+    def run(self) -> None:
+        """
+        Warps all the sources into the native space of each registered patient, whose volume passed the preflight
+        check if performed. The outcome for each patient is saved in warp_back_report.csv inside the output folder.
+        :return: None
+        """
+        if len(self.sources) == 0:
+            logging.warning("No source specified for the warp back, please fill in the warp_back_sources parameter.")
+            return
+
+        patients = []
+        for p in self.cohort.patients:
+            pat = self.cohort.patients[p]
+            if not self.cohort.is_file_validated(pat.volume_filepath):
+                continue
+            if len(pat.registrations.keys()) == 0:
+                logging.warning("Patient {} not registered to the atlas space, skipped from the warp back.".format(
+                    pat.patient_id))
+                continue
+            patients.append(p)
+
+        os.makedirs(self._scratch_folder, exist_ok=True)
+        results = []
+        jobs, threads = SharedResources.getInstance().get_jobs_budget(self.workers)
+        if jobs <= 1 or len(patients) <= 1:
+            load_warp_back_sources(self.sources)
+            for p in tqdm(patients):
+                results.append(warp_back_patient(self.cohort.patients[p], self.sources, self._scratch_folder))
+        else:
+            logging.info("Warping back {} patients with {} workers of {} threads.".format(len(patients), jobs,
+                                                                                         threads))
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_warp_back_worker,
+                                     initargs=(SharedResources.getInstance().config_filename, threads,
+                                               self.sources)) as executor:
+                futures = {executor.submit(warp_back_patient, self.cohort.patients[p], self.sources,
+                                           self._scratch_folder): p for p in patients}
+                for f in tqdm(as_completed(futures), total=len(futures)):
+                    p = futures[f]
+                    try:
+                        results.append(f.result())
+                    except Exception as e:
+                        # Only happening if the worker process itself died (e.g., out of memory).
+                        logging.error("Warp back worker for patient {} terminated with: {}".format(
+                            self.cohort.patients[p].patient_id, e))
+                        results.append([self.cohort.patients[p].patient_id, 0, 0., "Worker process terminated "
+                                                                                  "abruptly ({})".format(e)])
+
+        rows = [[pid, "failed" if error is not None else "done", warped, elapsed, error if error is not None else ""]
+                for pid, warped, elapsed, error in results]
+        self._report = pd.DataFrame(rows, columns=["Patient", "Status", "Warped", "Elapsed (s)", "Error"])
+        self._report.to_csv(os.path.join(SharedResources.getInstance().maps_output_folder, 'warp_back_report.csv'),
+                            index=False)
+        if os.path.exists(self._scratch_folder) and len(os.listdir(self._scratch_folder)) == 0:
+            os.rmdir(self._scratch_folder)
+
+        failures = self._report.loc[self._report["Status"] == "failed"]
+        print("Warp back of {} sources for {} patients: {} failed.".format(len(self.sources), len(self._report),
+                                                                           len(failures)))
+        for _, row in failures.iterrows():
+            print("  {}: {}".format(row["Patient"], row["Error"]))
+
+
+def get_native_filepath(patient, source: str) -> str:
+    """
+    Location where an atlas-space source is saved once warped into the native space of a patient.
+    :param patient: PatientStructure instance.
+    :param source: Filepath of the atlas-space source.
+    :return: Filepath inside the patient output folder.
+    """
+    return os.path.join(patient.output_folderpath, 'native_' + os.path.basename(source).split('.')[0] + '.nii.gz')
+
+
+def get_inverse_transforms(registration) -> List[str]:
+    """
+    Inverse transforms of a registration saved on disk, in the order expected by ANTs for mapping the atlas space back
+    onto the patient space: the affine matrix, to be inverted, followed by the inverse warp field.
+    :param registration: Registration instance, whose transforms are saved inside its output folder.
+    :return: List of transform filepaths.
+    """
+    transforms = [os.path.join(registration.output_folder, f) for f in sorted(os.listdir(registration.output_folder))
+                  if 'inverse' in f]
+    if len(transforms) == 0:
+        raise ValueError("No inverse transform found in {}.".format(registration.output_folder))
+    return sorted(transforms, key=lambda x: not x.endswith('.mat'))
+
+
+def load_warp_back_sources(sources: List[str]) -> None:
+    """
+    Loads the atlas-space sources inside the current process, if not already loaded. Integer-valued sources (e.g.,
+    atlas regions) are warped with a nearest neighbor interpolation, and the others (e.g., heatmaps) linearly.
+    :param sources: Filepaths of the atlas-space sources.
+    :return: None
+    """
+    for fp in sources:
+        if fp in _warp_back_sources:
+            continue
+        source_ni = nib.load(fp)
+        image = fp
+        if SharedResources.getInstance().system_ants_backend == 'python':
+            import ants
+            image = ants.image_read(fp, dimension=3)
+        if np.issubdtype(source_ni.get_data_dtype(), np.integer):
+            max_value = np.max(np.asanyarray(source_ni.dataobj))
+            _warp_back_sources[fp] = [image, 'nearestNeighbor', 'uchar' if 0 <= max_value <= 255 else 'uint']
+        else:
+            _warp_back_sources[fp] = [image, 'linear', 'float']
+
+
+def init_warp_back_worker(config_filename: str, threads: int, sources: List[str]) -> None:
+    """
+    Sets up the runtime parameters inside a worker process, when not inherited from the parent process, constrains the
+    number of threads the worker uses, and loads the atlas-space sources.
+    :param config_filename: Filepath to the *.ini with the user-specific runtime parameters.
+    :param threads: Number of threads for the worker.
+    :param sources: Filepaths of the atlas-space sources.
+    :return: None
+    """
+    if SharedResources.getInstance().config_filename is None and config_filename is not None:
+        SharedResources.getInstance().set_environment(config_filename=config_filename)
+    SharedResources.getInstance().set_job_threads(threads)
+    load_warp_back_sources(sources)
+
+
+def warp_back_patient(patient, sources: List[str], scratch_root: str) -> Tuple[str, int, float, Union[None, str]]:
+    """
+    Warps the atlas-space sources into the native space of one patient, skipping those already warped since the last
+    change of the source or of the transforms.
+    :param patient: PatientStructure instance, already registered to the atlas space.
+    :param sources: Filepaths of the atlas-space sources, loaded inside the current process.
+    :param scratch_root: Folder where the patient-specific scratch folder is created.
+    :return: Patient identifier, number of sources warped, elapsed time in seconds, and error message if any.
+    """
+    start = time.time()
+    scratch_folder = tempfile.mkdtemp(prefix=patient.patient_id + '_', dir=scratch_root)
+    try:
+        registration = list(patient.registrations.values())[0]
+        transforms = get_inverse_transforms(registration)
+        latest_change = max([os.path.getmtime(x) for x in transforms])
+        todo = []
+        for fp in sources:
+            native_fn = get_native_filepath(patient, fp)
+            if os.path.exists(native_fn) and os.path.getmtime(native_fn) >= max(latest_change, os.path.getmtime(fp)):
+                continue
+            todo.append(fp)
+        if len(todo) == 0:
+            return patient.patient_id, 0, time.time() - start, None
+
+        runner = ANTsRegistration(registration_folder=os.path.join(scratch_folder, 'registration'))
+        runner.reg_transform['invtransforms'] = transforms
+        runner.composite_folder = registration.output_folder
+        runner.log_folder = patient.output_folderpath
+        runner.apply_registration_inverse_transforms(moving=[_warp_back_sources[fp][0] for fp in todo],
+                                                     fixed=patient.volume_filepath,
+                                                     interpolations=[_warp_back_sources[fp][1] for fp in todo],
+                                                     output_filepaths=[get_native_filepath(patient, fp)
+                                                                       for fp in todo],
+                                                     pixel_types=[_warp_back_sources[fp][2] for fp in todo])
+        return patient.patient_id, len(todo), time.time() - start, None
+    except Exception as e:
+        logging.error("Warp back failed for patient {} with: \n{}".format(patient.patient_id, traceback.format_exc()))
+        return patient.patient_id, 0, time.time() - start, str(e)
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
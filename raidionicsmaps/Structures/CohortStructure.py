@@ -1,6 +1,6 @@
 import os
 import numpy as np
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Union, Set, Tuple
 import traceback
 import pandas as pd
 from .PatientStructure import Patient
@@ -16,6 +16,8 @@ class Cohort:
     _output_folderpath = None  # Path where the computed results will be stored
     _patients = {}  # Dictionary holding all patients belonging to the cohort, as PatientStructure objects
     _extra_patients_parameters = None  #
+    _indexed_patients_parameters = None  # Extra parameters indexed by patient identifier, built once when needed
+    _rejected_files = None  # Filepaths discarded by the preflight check, None if the check was not performed
 
     def __init__(self, id: str, input_folder: str, output_folder: str) -> None:
         """
@@ -42,6 +44,8 @@ class Cohort:
         self._output_folderpath = None
         self._patients = {}
         self._extra_patients_parameters = None
+        self._indexed_patients_parameters = None
+        self._rejected_files = None
 
     @property
     def unique_id(self) -> str:
@@ -58,11 +62,53 @@ class Cohort:
     @extra_patients_parameters.setter
     def extra_patients_parameters(self, df: pd.DataFrame) -> None:
         self._extra_patients_parameters = df
+        self._indexed_patients_parameters = None
+
+    @property
+    def indexed_patients_parameters(self) -> Union[None, pd.DataFrame]:
+        """
+        Extra parameters indexed by patient identifier, only keeping the first row for duplicated identifiers.
+        """
+        if self._indexed_patients_parameters is None and self._extra_patients_parameters is not None:
+            self._indexed_patients_parameters = self._extra_patients_parameters.drop_duplicates(
+                subset='Patient', keep='first').set_index('Patient')
+        return self._indexed_patients_parameters
+
+    def get_patients_parameter(self, param_name: str, patient_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Looks up the value of one extra parameter for several patients at once.
+        :param param_name: Name of the parameter, as featured in the extra parameters file.
+        :param patient_ids: Patient identifiers, as featured in the Patient column of the extra parameters file.
+        :return: Parameter values for each patient (NaN for patients missing from the file), and a boolean mask of
+        the patients missing from the file.
+        """
+        if self.indexed_patients_parameters is None:
+            return np.full(len(patient_ids), np.nan), np.ones(len(patient_ids), dtype=bool)
+        missing = ~pd.Index(patient_ids).isin(self.indexed_patients_parameters.index)
+        values = self.indexed_patients_parameters[param_name].reindex(patient_ids).values
+        return values, missing
 
     @property
     def patients(self) -> Dict[str, Patient]:
         return self._patients
 
+    @property
+    def rejected_files(self) -> Union[None, Set[str]]:
+        return self._rejected_files
+
+    @rejected_files.setter
+    def rejected_files(self, files: Set[str]) -> None:
+        self._rejected_files = files
+
+    def is_file_validated(self, filepath: str) -> bool:
+        """
+        Assesses whether a file can be used, according to the preflight check. Only the files discarded by the check
+        are rejected, such that the files produced afterwards (e.g., brain mask, registered annotation) can be used.
+        :param filepath: Location on disk of the file.
+        :return: False if the file was discarded by the preflight check, True otherwise.
+        """
+        return self._rejected_files is None or filepath not in self._rejected_files
+
     def __init_from_disk(self) -> None:
         """
         Parses the input folder to identify all patients belonging to the cohort.
@@ -92,6 +138,7 @@ class Cohort:
                 print('{}'.format(traceback.format_exc()))
 
         if SharedResources.getInstance().maps_extra_parameters_filename is not None and os.path.exists(SharedResources.getInstance().maps_extra_parameters_filename):
-            self.extra_patients_parameters = pd.read_csv(SharedResources.getInstance().maps_extra_parameters_filename)
+            extra_patients_parameters = pd.read_csv(SharedResources.getInstance().maps_extra_parameters_filename)
             # Casting the Patient identifiers column as string type
-            self.extra_patients_parameters['Patient'] = self.extra_patients_parameters['Patient'].astype(str)
+            extra_patients_parameters['Patient'] = extra_patients_parameters['Patient'].astype(str)
+            self.extra_patients_parameters = extra_patients_parameters
@@ -0,0 +1,454 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from typing import List, Tuple, Union
+
+from ..Utils.io import NiftiSlabWriter
+
+
+class Heatmap:
+    """
+    Structure for holding the accumulators of the location heatmap computed over one population of the cohort (i.e.,
+    the overall cohort, or a subset defined by a dense range or a categorical value from the extra parameters).
+    """
+    _unique_id = ""  # Internal unique identifier for the population, also used as suffix for the generated files
+    _output_folder = None  # Folder where the computed heatmaps for the population are to be stored
+    _dense_parameters = None  # Parameter name and [lower, upper] limits, when defining the population by a dense range
+    _categorical_parameters = None  # Parameter name and category, when defining the population by a categorical value
+    _heatmap = None  # Cumulative number of patients featuring the object of interest, for each voxel
+    _heatmap_centroids = None  # Cumulative number of object centroids, for each voxel
+    _heatmap_pids = None  # Internal patient counter of the last centroid stamped, for each voxel
+    _count = 0  # Number of patients included in the population, used as ascending counter for the patient ids
+    _streams = []  # Writers of the heatmaps files, when streamed slab after slab
+
+    def __init__(self, uid: str, output_folder: str, shape: Tuple[int, ...], dense_parameters: List = None,
+                 categorical_parameters: List = None, dtype=np.float64, pids_dtype=np.uint16) -> None:
+        """
+        :param dtype: Type of the cumulative accumulators, integer types being saved on disk as such.
+        :param pids_dtype: Type of the patient ids accumulator.
+        """
+        self.__reset()
+        self._unique_id = uid
+        self._output_folder = output_folder
+        self._dense_parameters = dense_parameters
+        self._categorical_parameters = categorical_parameters
+        self._heatmap = np.zeros(shape, dtype=dtype)
+        self._heatmap_centroids = np.zeros(shape, dtype=dtype)
+        # The pids are a simply ascending counter. Should a look-up-table between counter and patient_id be saved on disk?
+        self._heatmap_pids = np.zeros(shape, dtype=pids_dtype)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._unique_id = ""
+        self._output_folder = None
+        self._dense_parameters = None
+        self._categorical_parameters = None
+        self._heatmap = None
+        self._heatmap_centroids = None
+        self._heatmap_pids = None
+        self._count = 0
+        self._streams = []
+
+    @property
+    def unique_id(self) -> str:
+        return self._unique_id
+
+    @property
+    def output_folder(self) -> str:
+        return self._output_folder
+
+    @property
+    def dense_parameters(self) -> Union[None, List]:
+        return self._dense_parameters
+
+    @property
+    def categorical_parameters(self) -> Union[None, List]:
+        return self._categorical_parameters
+
+    @property
+    def heatmap(self) -> np.ndarray:
+        return self._heatmap
+
+    @property
+    def heatmap_centroids(self) -> np.ndarray:
+        return self._heatmap_centroids
+
+    @property
+    def heatmap_pids(self) -> np.ndarray:
+        return self._heatmap_pids
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def are_patients_included(self, param_values: np.ndarray) -> np.ndarray:
+        """
+        Assesses, for several patients at once, whether they belong to the population, based on their value for the
+        parameter defining it.
+        :param param_values: Patients values for the dense or categorical parameter defining the population, unused
+        for the overall cohort.
+        :return: Boolean mask of the patients which should contribute to the heatmap.
+        """
+        param_values = pd.Series(param_values)
+        if self.dense_parameters is not None and self.categorical_parameters is None:
+            param_limits = self.dense_parameters[1]
+            if param_limits[0] is None:
+                return ~(param_values > param_limits[1]).values
+            elif param_limits[1] is None:
+                return ~(param_values <= param_limits[0]).values
+            return ~((param_values < param_limits[0]) & (param_values > param_limits[1])).values
+        elif self.dense_parameters is None and self.categorical_parameters is not None:
+            return ~(param_values != self.categorical_parameters[1]).values
+        return np.ones(len(param_values), dtype=bool)
+
+    def merge_shard(self, shard: "HeatmapShard") -> None:
+        """
+        Reduces the partial accumulators computed over a shard of the cohort into the heatmap.
+        Shards must be merged following the patients order, for the patient ids to match a serial computation.
+        :param shard: Partial accumulators for the population, computed over a contiguous subset of patients.
+        :return: None
+        """
+        self._heatmap += shard.heatmap
+        for cube, pid in zip(shard.centroids, shard.pids):
+            self.stamp_centroid(cube, self._count + pid)
+        self._count += shard.count
+
+    def include_patient(self, voxels: Union[None, np.ndarray],
+                        centroids: Union[None, List[Tuple[float, ...]]]) -> None:
+        """
+        Adds the contribution of one patient to the heatmap.
+        :param voxels: Flat indices of the voxels featuring the object of interest, in atlas space, or None to only
+        account for the centroids.
+        :param centroids: Center of mass for each foci of the object of interest, sorted by decreasing size, or None
+        if the centroids could not be computed (the patient is then not counted in the population).
+        :return: None
+        """
+        if voxels is not None:
+            self.include_voxels(voxels)
+        if centroids is None:
+            return
+        self._count += 1
+        for com in centroids:
+            self.stamp_centroid(get_centroid_cube(com, self._heatmap.shape), self._count)
+
+    def include_voxels(self, voxels: np.ndarray) -> None:
+        """
+        Adds one patient to the cumulative heatmap.
+        :param voxels: Flat indices of the voxels featuring the object of interest, in atlas space.
+        :return: None
+        """
+        self._heatmap.reshape(-1)[voxels] += 1
+
+    def exclude_voxels(self, voxels: np.ndarray) -> None:
+        """
+        Removes the contribution of one patient, previously included, from the cumulative heatmap.
+        :param voxels: Flat indices of the voxels featuring the object of interest, in atlas space.
+        :return: None
+        """
+        self._heatmap.reshape(-1)[voxels] -= 1
+
+    def rebuild_centroids(self, patients_centroids: List[Union[None, List[Tuple[float, ...]]]]) -> None:
+        """
+        Recomputes the centroid-based accumulators and the patient ids from the foci centroids of every patient of
+        the population, following the patients order.
+        :param patients_centroids: Foci centroids for each patient of the population, or None if the centroids could not
+        be computed.
+        :return: None
+        """
+        self._heatmap_centroids[:] = 0
+        self._heatmap_pids[:] = 0
+        self._count = 0
+        for centroids in patients_centroids:
+            self.include_patient(None, centroids)
+
+    def load_state(self, atlas_fingerprint: str, gt_files_suffix: str) -> Union[None, dict]:
+        """
+        Restores the raw accumulators saved by a previous run, if they were computed for the same population, atlas,
+        and annotation class. The accumulators are only replaced once the whole state has been read and validated, and
+        are otherwise left empty, such that a partially read state is never accumulated onto.
+        :param atlas_fingerprint: Hash of the atlas file the heatmaps are computed for.
+        :param gt_files_suffix: Suffix of the annotation files the heatmaps are computed for.
+        :return: The patients previously contributing to the population, with the hash of their annotation file, or
+        None if no valid state can be found.
+        """
+        state_filename = os.path.join(self.output_folder, 'heatmap_state.json')
+        arrays_filename = os.path.join(self.output_folder, 'heatmap_state.npz')
+        if not os.path.exists(state_filename) or not os.path.exists(arrays_filename):
+            self.reset_accumulators()
+            return None
+
+        try:
+            with open(state_filename, 'r') as infile:
+                state = json.load(infile)
+            if (state["atlas"] != atlas_fingerprint or state["gt_files_suffix"] != gt_files_suffix or
+                    state["dense_parameters"] != self.dense_parameters or
+                    state["categorical_parameters"] != self.categorical_parameters or
+                    tuple(state["shape"]) != self._heatmap.shape):
+                logging.warning("Discarding the outdated heatmap state in {}.".format(self.output_folder))
+                self.reset_accumulators()
+                return None
+            with np.load(arrays_filename) as arrays:
+                heatmap = arrays["heatmap"]
+                heatmap_centroids = arrays["heatmap_centroids"]
+                heatmap_pids = arrays["heatmap_pids"]
+            count = int(state["count"])
+            patients = dict(state["patients"])
+            for array in [heatmap, heatmap_centroids, heatmap_pids]:
+                if array.shape != self._heatmap.shape:
+                    raise ValueError("Heatmap state array of shape {} instead of {}.".format(array.shape,
+                                                                                         self._heatmap.shape))
+        except Exception as e:
+            logging.warning("Heatmap state in {} could not be read, and is discarded.".format(self.output_folder))
+            self.reset_accumulators()
+            return None
+
+        self._heatmap[:] = heatmap
+        # The centroids might have been saved with an increased capacity, for overlapping foci.
+        self._heatmap_centroids = heatmap_centroids.astype(np.promote_types(self._heatmap_centroids.dtype,
+                                                                            heatmap_centroids.dtype))
+        self._heatmap_pids[:] = heatmap_pids
+        self._count = count
+        return patients
+
+    def reset_accumulators(self) -> None:
+        """
+        Resets all the accumulators and the patients counter, for computing the heatmap from scratch.
+        """
+        self._heatmap[:] = 0
+        self._heatmap_centroids[:] = 0
+        self._heatmap_pids[:] = 0
+        self._count = 0
+
+    def save_state(self, patients: dict, atlas_fingerprint: str, gt_files_suffix: str) -> None:
+        """
+        Saves the raw accumulators and the definition of the population inside its output folder, for later updates.
+        :param patients: Patients contributing to the population, with the hash of their annotation file.
+        :param atlas_fingerprint: Hash of the atlas file the heatmaps are computed for.
+        :param gt_files_suffix: Suffix of the annotation files the heatmaps are computed for.
+        :return: None
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        np.savez_compressed(os.path.join(self.output_folder, 'heatmap_state.npz'), heatmap=self._heatmap,
+                            heatmap_centroids=self._heatmap_centroids, heatmap_pids=self._heatmap_pids)
+        state = {"uid": self.unique_id, "atlas": atlas_fingerprint, "gt_files_suffix": gt_files_suffix,
+                 "dense_parameters": self.dense_parameters, "categorical_parameters": self.categorical_parameters,
+                 "shape": list(self._heatmap.shape), "count": self._count, "patients": patients}
+        with open(os.path.join(self.output_folder, 'heatmap_state.json'), 'w') as outfile:
+            json.dump(state, outfile, indent=4)
+
+    def stamp_centroid(self, cube: np.ndarray, pid: int) -> None:
+        """
+        Adds one centroid cube to the centroid accumulators, stamped with the given patient id. The accumulators are
+        widened beforehand if the cube would exceed their capacity.
+        :param cube: Flat indices of the centroid cube, without duplicates, in the accumulators layout.
+        :param pid: Patient id stamped over the cube.
+        :return: None
+        """
+        heatmap_centroids = self._heatmap_centroids.reshape(-1)
+        if (np.issubdtype(heatmap_centroids.dtype, np.integer) and cube.size != 0 and
+                int(heatmap_centroids[cube].max()) >= np.iinfo(heatmap_centroids.dtype).max):
+            # Overlapping foci from the same patients can exceed the capacity sized on the number of patients.
+            self._heatmap_centroids = self._heatmap_centroids.astype(np.uint64)
+            heatmap_centroids = self._heatmap_centroids.reshape(-1)
+        heatmap_centroids[cube] += 1
+        self._heatmap_pids.reshape(-1)[cube] = pid
+
+    def dump_heatmaps_on_disk(self, atlas_ni: nib.Nifti1Image) -> None:
+        """
+        Saves the heatmaps of the population inside its output folder, using the atlas affine and header.
+        :param atlas_ni: Loaded atlas defining the space in which the heatmaps have been computed.
+        :return: None
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+
+        logging.info('Writing heatmaps to disk')
+        dtype = self._heatmap.dtype if np.issubdtype(self._heatmap.dtype, np.integer) else np.uint16
+        output_filename_heatmap = os.path.join(self.output_folder,
+                                               'heatmap_cumulative' + self.unique_id + '.nii.gz')
+        heatmap_ni = nib.Nifti1Image(self._heatmap.astype(dtype), atlas_ni.affine, atlas_ni.header)
+        heatmap_ni.set_data_dtype(dtype)
+        nib.save(heatmap_ni, filename=output_filename_heatmap)
+
+        dtype = np.float32
+        output_filename_heatmap_perc = os.path.join(self.output_folder,
+                                                    'heatmap_percentages' + self.unique_id + '.nii.gz')
+        # Directly divided in single precision, identical to a double precision division rounded afterwards, for only
+        # allocating one percentages volume at a time.
+        heatmap_perc_ni = nib.Nifti1Image(self._heatmap.astype(dtype) / dtype(self._count), atlas_ni.affine,
+                                          atlas_ni.header)
+        heatmap_ni.set_data_dtype(dtype)
+        nib.save(heatmap_perc_ni, filename=output_filename_heatmap_perc)
+
+        dtype = self._heatmap_centroids.dtype if np.issubdtype(self._heatmap_centroids.dtype, np.integer) else np.uint16
+        output_filename_heatmap_centroids = os.path.join(self.output_folder,
+                                                         'heatmap_centroids_cumulative' + self.unique_id + '.nii.gz')
+        heatmap_com_ni = nib.Nifti1Image(self._heatmap_centroids.astype(dtype), atlas_ni.affine, atlas_ni.header)
+        heatmap_ni.set_data_dtype(dtype)
+        nib.save(heatmap_com_ni, filename=output_filename_heatmap_centroids)
+
+        dtype = np.float32
+        output_filename_heatmap_com_perc = os.path.join(self.output_folder,
+                                                        'heatmap_centroids_percentages' + self.unique_id + '.nii.gz')
+        heatmap_com_perc_ni = nib.Nifti1Image(self._heatmap_centroids.astype(dtype) / dtype(self._count),
+                                              atlas_ni.affine, atlas_ni.header)
+        heatmap_ni.set_data_dtype(dtype)
+        nib.save(heatmap_com_perc_ni, filename=output_filename_heatmap_com_perc)
+
+        dtype = self._heatmap_pids.dtype
+        output_filename_heatmap_pids = os.path.join(self.output_folder,
+                                                    'heatmap_patient_ids' + self.unique_id + '.nii.gz')
+        heatmap_pids_ni = nib.Nifti1Image(self._heatmap_pids.astype(dtype), atlas_ni.affine, atlas_ni.header)
+        heatmap_ni.set_data_dtype(dtype)
+        nib.save(heatmap_pids_ni, filename=output_filename_heatmap_pids)
+
+        logging.info('Computed heatmap location with {} samples.'.format(self._count))
+
+
+    def open_streams(self, atlas_ni: nib.Nifti1Image, count: int) -> None:
+        """
+        Prepares the writing of the heatmaps of the population slab after slab, in which case the accumulators only
+        hold the current slab, as Fortran-ordered flat arrays. The files are identical to the ones from
+        dump_heatmaps_on_disk.
+        :param atlas_ni: Loaded atlas defining the space in which the heatmaps are computed.
+        :param count: Number of patients included in the population, known beforehand for the percentages.
+        :return: None
+        """
+        os.makedirs(self.output_folder, exist_ok=True)
+        self._count = count
+        dtype = self._heatmap.dtype if np.issubdtype(self._heatmap.dtype, np.integer) else np.uint16
+        dtype_centroids = self._heatmap_centroids.dtype if np.issubdtype(self._heatmap_centroids.dtype, np.integer) else np.uint16
+        self._streams = [
+            NiftiSlabWriter(os.path.join(self.output_folder, 'heatmap_cumulative' + self.unique_id + '.nii.gz'),
+                            atlas_ni, dtype, set_data_dtype=True),
+            NiftiSlabWriter(os.path.join(self.output_folder, 'heatmap_percentages' + self.unique_id + '.nii.gz'),
+                            atlas_ni, np.float32),
+            NiftiSlabWriter(os.path.join(self.output_folder,
+                                         'heatmap_centroids_cumulative' + self.unique_id + '.nii.gz'),
+                            atlas_ni, dtype_centroids),
+            NiftiSlabWriter(os.path.join(self.output_folder,
+                                         'heatmap_centroids_percentages' + self.unique_id + '.nii.gz'),
+                            atlas_ni, np.float32),
+            NiftiSlabWriter(os.path.join(self.output_folder, 'heatmap_patient_ids' + self.unique_id + '.nii.gz'),
+                            atlas_ni, self._heatmap_pids.dtype)]
+
+    def write_slab(self, size: int) -> None:
+        """
+        Appends the current slab of the accumulators to the heatmaps files, and resets them for the next slab.
+        :param size: Number of voxels of the current slab, smaller than the accumulators for the last slab.
+        :return: None
+        """
+        heatmap = self._heatmap[:size]
+        heatmap_centroids = self._heatmap_centroids[:size]
+        self._streams[0].write_slab(heatmap.astype(self._streams[0].dtype))
+        self._streams[1].write_slab((heatmap / self._count).astype(np.float32))
+        # The centroid accumulators might have been widened, for overlapping foci.
+        self._streams[2].write_slab(heatmap_centroids.astype(np.promote_types(self._streams[2].dtype,
+                                                                              heatmap_centroids.dtype)))
+        self._streams[3].write_slab((heatmap_centroids / self._count).astype(np.float32))
+        self._streams[4].write_slab(self._heatmap_pids[:size])
+        self._heatmap[:] = 0
+        self._heatmap_centroids[:] = 0
+        self._heatmap_pids[:] = 0
+
+    def close_streams(self) -> None:
+        """
+        Finalizes the heatmaps files written slab after slab.
+        :return: None
+        """
+        for stream in self._streams:
+            stream.close()
+        self._streams = []
+        logging.info('Computed heatmap location with {} samples.'.format(self._count))
+
+
+class HeatmapShard:
+    """
+    Partial accumulators of a population heatmap, computed over a contiguous subset of the cohort, before being merged
+    into the final Heatmap. The voxels featuring the object of interest are accumulated into a dense counter sized to
+    the number of patients in the shard, such that the memory footprint does not grow with the cohort, while the few
+    centroid cubes are kept as flat voxel indices (C-order, in atlas space) for being stamped in the patients order.
+    """
+    _unique_id = ""  # Identifier of the population the shard contributes to
+    _shape = None  # Shape of the atlas space
+    _heatmap = None  # Number of patients of the shard featuring the object of interest, for each voxel
+    _centroids = []  # Flat indices of the centroid cubes, one array per foci, in stamping order
+    _pids = []  # Shard-local patient counter stamped for each entry of _centroids
+    _count = 0  # Number of patients counted in the shard
+
+    def __init__(self, uid: str, shape: Tuple[int, ...], size: int) -> None:
+        """
+        :param size: Number of patients in the shard, bounding the values of the accumulator.
+        """
+        self.__reset()
+        self._unique_id = uid
+        self._shape = shape
+        self._heatmap = np.zeros(shape, dtype=np.uint16 if size <= np.iinfo(np.uint16).max else np.uint32)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._unique_id = ""
+        self._shape = None
+        self._heatmap = None
+        self._centroids = []
+        self._pids = []
+        self._count = 0
+
+    @property
+    def unique_id(self) -> str:
+        return self._unique_id
+
+    @property
+    def heatmap(self) -> np.ndarray:
+        return self._heatmap
+
+    @property
+    def centroids(self) -> List[np.ndarray]:
+        return self._centroids
+
+    @property
+    def pids(self) -> List[int]:
+        return self._pids
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def include_patient(self, voxels: Union[None, np.ndarray],
+                        centroids: Union[None, List[Tuple[float, ...]]]) -> None:
+        """
+        Adds the contribution of one patient to the partial accumulators.
+        :param voxels: Flat indices of the voxels featuring the object of interest, in atlas space, or None to only
+        account for the centroids.
+        :param centroids: Center of mass for each foci of the object of interest, sorted by decreasing size, or None
+        if the centroids could not be computed (the patient is then not counted in the population).
+        :return: None
+        """
+        if voxels is not None:
+            self._heatmap.reshape(-1)[voxels] += 1
+        if centroids is None:
+            return
+        for com in centroids:
+            self._centroids.append(get_centroid_cube(com, self._shape))
+            self._pids.append(self._count + 1)
+        self._count += 1
+
+
+def get_centroid_cube(com: Tuple[float, ...], shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Flat indices (C-order) of the 6x6x6 voxels cube stamped around a foci centroid, mimicking the slicing of the
+    accumulators around the centroid, with identical behaviour at the borders.
+    :param com: Center of mass of the foci.
+    :param shape: Shape of the atlas space.
+    :return: Flat indices of the cube voxels.
+    """
+    ranges = [np.arange(shape[a])[int(com[a]) - 3:int(com[a]) + 3] for a in range(3)]
+    return np.ravel_multi_index(np.meshgrid(*ranges, indexing='ij'), shape).reshape(-1)
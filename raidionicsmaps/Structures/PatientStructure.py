@@ -165,30 +165,23 @@ class Patient:
         self.label_filepath = os.path.join(self.input_folderpath, label_files[0])
         if len(mask_files) != 0:
             self.mask_filepath = os.path.join(self.input_folderpath, mask_files[0])
+        elif os.path.exists(os.path.join(self.output_folderpath, 'input_brain_mask.nii.gz')):
+            # Brain mask from a previous cohort-level brain segmentation.
+            self.mask_filepath = os.path.join(self.output_folderpath, 'input_brain_mask.nii.gz')
 
         res_patient_folder = os.path.join(SharedResources.getInstance().maps_output_folder, self.patient_id)
         if os.path.exists(res_patient_folder):
-            reg_folder = None
-            contents = []
-            for _, dirs, _ in os.walk(res_patient_folder):
-                for d in dirs:
-                    contents.append(d)
-                break
-
-            if len(contents) != 0:
-                reg_folder = os.path.join(res_patient_folder, contents[0])
-                reg_folder = os.path.join(reg_folder, 'Pat-to-MNI')
-                if not os.path.exists(reg_folder):
-                    return
-
+            # Other folders (e.g., the logs) can sit next to the transforms folder.
+            reg_folder = os.path.join(res_patient_folder, 'Transforms', 'Pat-to-MNI')
+            if os.path.exists(reg_folder):
                 transform_contents = []
                 inverse_transform_contents = []
                 for _, _, files in os.walk(reg_folder):
                     for f in files:
                         if 'forward' in f:
-                            transform_contents.append(f)
+                            transform_contents.append(os.path.join(reg_folder, f))
                         elif 'inverse' in f:
-                            inverse_transform_contents.append(f)
+                            inverse_transform_contents.append(os.path.join(reg_folder, f))
                     break
 
                 non_available_uid = True
@@ -1,7 +1,7 @@
 import os
-import shutil
 from typing import List
 from ..Utils.resources import SharedResources
+from ..Utils.staging import stage_file
 
 
 class Registration:
@@ -31,11 +31,11 @@ class Registration:
 
             for elem in fwd_paths:
                 dest_name = os.path.join(self._output_folder, os.path.basename(elem))
-                shutil.copyfile(elem, dest_name)
+                stage_file(elem, dest_name, allow_symlink=False)
                 self._forward_filepaths.append(dest_name)
             for elem in inv_paths:
                 dest_name = os.path.join(self._output_folder, os.path.basename(elem))
-                shutil.copyfile(elem, dest_name)
+                stage_file(elem, dest_name, allow_symlink=False)
                 self._inverse_filepaths.append(dest_name)
 
     def __reset(self):
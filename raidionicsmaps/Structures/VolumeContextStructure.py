@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import nibabel as nib
+from typing import Tuple
+from scipy import ndimage
+
+from ..Utils.resources import SharedResources
+from ..Utils.mask_cache import load_mask_volume
+from ..Utils.location_metrics import refine_mask
+
+
+class VolumeContext:
+    """
+    In-memory content of the volume and annotation mask of one patient registered to the MNI space, shared by all the
+    metrics computation steps of the patient.
+    Each volume is only decoded from disk when first used, and the arrays derived from the annotation mask (e.g.,
+    bounding box, connected components, refined mask) are computed once and kept until released.
+    """
+    _volume_filepath = None  # Volume registered to the MNI space
+    _mask_filepath = None  # Annotation mask registered to the MNI space
+    _volume = None  # Content of the registered volume, as float
+    _mask = None  # Content of the registered annotation mask, as uint8
+    _affine = None  # Affine matrix of the registered annotation mask
+    _spacing = None  # Voxel size of the registered annotation mask
+    _bbox = None  # Bounding box of the non-zero content of the annotation mask
+    _components = None  # Connected components of the annotation mask, within its bounding box
+    _refined_mask = None  # Annotation mask without its small and noisy areas, as used for the location metrics
+
+    def __init__(self, patient_id: str) -> None:
+        """
+        :param patient_id: Identifier of the patient, whose registered files are inside the output folder.
+        """
+        self.__reset()
+        self._volume_filepath = os.path.join(SharedResources.getInstance().maps_output_folder, patient_id,
+                                             "input_reg_mni.nii.gz")
+        self._mask_filepath = os.path.join(SharedResources.getInstance().maps_output_folder, patient_id,
+                                           "input_reg_mni_" + SharedResources.getInstance().maps_gt_files_suffix)
+
+    def __reset(self):
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._volume_filepath = None
+        self._mask_filepath = None
+        self._volume = None
+        self._mask = None
+        self._affine = None
+        self._spacing = None
+        self._bbox = None
+        self._components = None
+        self._refined_mask = None
+
+    @property
+    def volume_filepath(self) -> str:
+        return self._volume_filepath
+
+    @property
+    def mask_filepath(self) -> str:
+        return self._mask_filepath
+
+    @property
+    def volume(self) -> np.ndarray:
+        if self._volume is None:
+            self._volume = nib.load(self._volume_filepath).get_fdata()[:]
+        return self._volume
+
+    @property
+    def mask(self) -> np.ndarray:
+        if self._mask is None:
+            self._mask, self._affine, self._spacing = load_mask_volume(self._mask_filepath)
+        return self._mask
+
+    @property
+    def affine(self) -> np.ndarray:
+        if self._affine is None:
+            self.mask
+        return self._affine
+
+    @property
+    def spacing(self) -> Tuple[float, ...]:
+        if self._spacing is None:
+            self.mask
+        return self._spacing
+
+    @property
+    def bbox(self) -> Tuple[slice, ...]:
+        """
+        Bounding box of the non-zero content of the annotation mask, over its first three dimensions (None if empty).
+        """
+        if self._bbox is None:
+            objects = ndimage.find_objects((self.__get_mask_3d() != 0).astype('uint8'))
+            self._bbox = objects[0] if len(objects) != 0 else ()
+        return self._bbox if len(self._bbox) != 0 else None
+
+    @property
+    def components(self) -> Tuple[np.ndarray, int]:
+        """
+        Connected components of the annotation mask, within its bounding box, and their number.
+        An empty mask has no bounding box, and is given a single background voxel without any component instead.
+        """
+        if self._components is None:
+            if self.bbox is None:
+                self._components = (np.zeros((1, 1, 1), dtype='int32'), 0)
+            else:
+                self._components = ndimage.label(self.__get_mask_3d()[self.bbox])
+        return self._components
+
+    @property
+    def refined_mask(self) -> np.ndarray:
+        if self._refined_mask is None:
+            self._refined_mask = refine_mask(self.mask)
+        return self._refined_mask
+
+    def release(self) -> None:
+        """
+        Frees all the arrays held in memory, which are decoded again from disk if used afterwards.
+        :return: None
+        """
+        self._volume = None
+        self._mask = None
+        self._affine = None
+        self._spacing = None
+        self._bbox = None
+        self._components = None
+        self._refined_mask = None
+
+    def __get_mask_3d(self) -> np.ndarray:
+        # Still some cases with a fourth dimension...
+        return self.mask[..., 0] if len(self.mask.shape) == 4 else self.mask
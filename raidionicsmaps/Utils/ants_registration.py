@@ -1,36 +1,78 @@
 from __future__ import division
-import platform
 import logging
 import os
 import time
 import datetime
 import calendar
 import numpy as np
-import subprocess
 import shutil
 import zipfile
 import gzip
+import json
 import traceback
+from typing import List, Tuple
 from .resources import SharedResources
+from .subprocess_runner import SubprocessRunner
 # from ..Processing.brain_processing import *
 
+# Registration presets, from the fastest to the most accurate. For each, the antspy registration parameters, the ANTs
+# script and transform type for the cpp backend, and the downsampling factor applied to both images beforehand.
+REGISTRATION_PRESETS = {
+    'rigid': {'python': {'type_of_transform': 'Rigid'}, 'script': 'antsRegistrationSyNQuick.sh', 'transform': 'r',
+              'shrink': 1},
+    'affine': {'python': {'type_of_transform': 'Affine'}, 'script': 'antsRegistrationSyNQuick.sh', 'transform': 'a',
+               'shrink': 1},
+    'syn-quick': {'python': {'type_of_transform': 'SyN', 'aff_iterations': (1000, 500, 250, 0),
+                             'reg_iterations': (20, 10, 0)},
+                  'script': 'antsRegistrationSyNQuick.sh', 'transform': 's', 'shrink': 1},
+    'syn-lowres': {'python': {'type_of_transform': 'SyN'}, 'script': 'antsRegistrationSyNQuick.sh', 'transform': 's',
+                   'shrink': 2},
+    'syn-full': {'python': {'type_of_transform': 'SyN'}, 'script': 'antsRegistrationSyN.sh', 'transform': 's',
+                 'shrink': 1},
+}
+
 
 class ANTsRegistration:
     """
     Class for all registration-based processes, using ANTs as a backend.
     By default the python implementation is used because easily deployable. The c++ implementation can be used if a
     locally compiled/installed ANTs is available (must be manually specified).
+    The fixed images (e.g., the atlas) are only read once per process, and shared by all instances.
+    Optionally, the chain of transforms (e.g., affine and warp field) can be collapsed into a single composite
+    displacement field for each direction, built on first use and kept inside the composite folder, such that any
+    following warp only requires one interpolation pass and one transform read.
     """
-    def __init__(self):
+    _fixed_images = {}  # Process-level cache of the loaded fixed images, indexed by filepath, modification time and size
+    _fixed_images_limit = 4  # Maximum number of fixed images kept in memory
+
+    def __init__(self, registration_folder: str = None):
+        """
+        :param registration_folder: Folder where the registration files are temporarily stored, which must be specific
+        to each registration running in parallel (inside the output folder by default).
+        """
         self.ants_reg_dir = SharedResources.getInstance().ants_reg_dir
         self.ants_apply_dir = SharedResources.getInstance().ants_apply_dir
-        self.registration_folder = os.path.join(SharedResources.getInstance().maps_output_folder, 'registration/')
+        if registration_folder is None:
+            registration_folder = os.path.join(SharedResources.getInstance().maps_output_folder, 'registration')
+        # Trailing separator kept, the folder being used as output prefix by the ANTs scripts.
+        self.registration_folder = os.path.join(registration_folder, '')
         os.makedirs(self.registration_folder, exist_ok=True)
         self.reg_transform = {}
         self.transform_names = []
         self.inverse_transform_names = []
         self.registration_computed = False
         self.backend = SharedResources.getInstance().system_ants_backend
+        # Threads for the ANTs executables, as budgeted for the current job.
+        self.threads = SharedResources.getInstance().system_job_threads
+        if self.threads is None:
+            self.threads = SharedResources.getInstance().get_jobs_budget(1)[1]
+        self.composite_warp = SharedResources.getInstance().maps_registration_composite_warp
+        # Persistent folder for the composite displacement fields (e.g., the patient transforms folder).
+        self.composite_folder = None
+        # Folder for the logs and timings of the ANTs executables (e.g., the patient output folder), the registration
+        # folder by default.
+        self.log_folder = None
+        self.timeout = SharedResources.getInstance().system_ants_timeout
 
     def clear_cache(self):
         # In Python, registration files are stored in the temporary folder and must be removed.
@@ -46,6 +88,98 @@ class ANTsRegistration:
         if os.path.exists(self.registration_folder):
             shutil.rmtree(self.registration_folder)
 
+    @classmethod
+    def load_fixed_image(cls, filepath: str):
+        """
+        Loads a fixed or reference image with the python backend, through the process-level cache. Only the most
+        recently used images are kept in memory, references differing for each patient when warping back.
+        :param filepath: Location on disk of the image.
+        :return: ANTsImage, to be used read-only.
+        """
+        import ants
+        stat = os.stat(filepath)
+        key = (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        if key in cls._fixed_images:
+            # Re-inserted for the dictionary order to follow the most recent use.
+            cls._fixed_images[key] = cls._fixed_images.pop(key)
+            return cls._fixed_images[key]
+        for k in [x for x in cls._fixed_images if x[0] == key[0]]:
+            del cls._fixed_images[k]
+        while len(cls._fixed_images) >= cls._fixed_images_limit:
+            del cls._fixed_images[next(iter(cls._fixed_images))]
+        cls._fixed_images[key] = ants.image_read(filepath, dimension=3)
+        return cls._fixed_images[key]
+
+    def get_transform_chain(self, inverse: bool = False) -> List[Tuple[str, bool]]:
+        """
+        Transforms to apply, in the order expected by antsApplyTransforms, with a flag indicating whether each must be
+        inverted.
+        :param inverse: Whether to map from the fixed space back to the moving space.
+        :return: List of transform filepaths and inversion flags.
+        """
+        if not inverse:
+            return [(x, False) for x in self.reg_transform['fwdtransforms']]
+        transforms = self.reg_transform['invtransforms']
+        if self.backend == 'python':
+            return list(zip(transforms, [True, False]))
+        # Warp fields are stored already inverted, only the affine matrices must be inverted.
+        return [(x, x.endswith('.mat')) for x in transforms]
+
+    def get_composite_transform(self, fixed: str, inverse: bool = False) -> str:
+        """
+        Composite displacement field equivalent to the chain of transforms, computed over the grid of the reference
+        image. The field is reused as long as the reference image and the transforms are unchanged.
+        :param fixed: Filepath of the reference image, defining the grid of the displacement field.
+        :param inverse: Whether to map from the fixed space back to the moving space.
+        :return: Filepath of the composite displacement field.
+        """
+        chain = self.get_transform_chain(inverse=inverse)
+        folder = self.composite_folder if self.composite_folder is not None else self.registration_folder
+        os.makedirs(folder, exist_ok=True)
+        composite_filename = os.path.join(folder, 'composite_to_{}.nii.gz'.format('moving' if inverse else 'fixed'))
+        description_filename = composite_filename.replace('.nii.gz', '.json')
+        fixed_stat = os.stat(fixed)
+        description = {"reference": [os.path.abspath(fixed), fixed_stat.st_size, fixed_stat.st_mtime_ns],
+                       "transforms": [[os.path.basename(x), os.path.getsize(x), flag] for x, flag in chain]}
+        if os.path.exists(composite_filename) and os.path.exists(description_filename):
+            try:
+                with open(description_filename, 'r') as infile:
+                    if json.load(infile) == description:
+                        return composite_filename
+            except Exception as e:
+                logging.warning("Composite transform description {} could not be read.".format(description_filename))
+
+        logging.info("Building the composite transform {}.".format(composite_filename))
+        tmp_prefix = os.path.join(folder, 'tmp{}_'.format(os.getpid()))
+        if self.backend == 'python':
+            import ants
+            fixed_ants = self.load_fixed_image(fixed)
+            tmp_filename = ants.apply_transforms(fixed=fixed_ants, moving=fixed_ants,
+                                                 transformlist=[x[0] for x in chain],
+                                                 whichtoinvert=[x[1] for x in chain], compose=tmp_prefix)
+        else:
+            tmp_filename = tmp_prefix + 'comptx.nii.gz'
+            args = [os.path.join(self.ants_apply_dir, 'antsApplyTransforms'), "-d", "3", '-r', fixed, '-i', fixed]
+            for x, flag in chain:
+                args += ['-t', '[{}, 1]'.format(x) if flag else x]
+            args += ['-o', '[{}, 1]'.format(tmp_filename)]
+            self.get_subprocess_runner().run(args, name='ants_composite_to_{}'.format('moving' if inverse else 'fixed'),
+                                             env=self.__get_job_env())
+        if tmp_filename is None or not os.path.exists(tmp_filename):
+            raise ValueError('Composite transform could not be computed.')
+        # Composed in double precision by ANTs, stored as float32 like the registration warp fields, for twice faster
+        # reads and half the size on disk.
+        import nibabel as nib
+        composite_ni = nib.load(tmp_filename)
+        composite_ni = nib.Nifti1Image(np.asarray(composite_ni.dataobj, dtype='float32'), composite_ni.affine,
+                                       composite_ni.header)
+        composite_ni.set_data_dtype('float32')
+        nib.save(composite_ni, tmp_filename)
+        os.replace(tmp_filename, composite_filename)
+        with open(description_filename, 'w') as outfile:
+            json.dump(description, outfile)
+        return composite_filename
+
     def clear_output_folder(self):
         if os.path.exists(self.registration_folder):
             shutil.rmtree(self.registration_folder)
@@ -64,7 +198,8 @@ class ANTsRegistration:
         fixed : str
             Filepath of the fixed image (to register to).
         registration_method : str
-            ANTs tag to specify which registration method to use (e.g., SyN).
+            ANTs tag to specify which registration method to use (e.g., SyN), or name of one of the
+            REGISTRATION_PRESETS (e.g., affine, syn-quick).
         Returns
         -------
         None
@@ -72,6 +207,11 @@ class ANTsRegistration:
         if len(self.transform_names) != 0 and len(self.inverse_transform_names) != 0:
             return
         os.makedirs(self.registration_folder, exist_ok=True)
+        if registration_method in REGISTRATION_PRESETS and REGISTRATION_PRESETS[registration_method]['shrink'] > 1:
+            # The transforms are expressed in physical space, hence valid for the full resolution images.
+            factor = REGISTRATION_PRESETS[registration_method]['shrink']
+            moving = downsample_volume(moving, factor, os.path.join(self.registration_folder, 'moving_lowres.nii.gz'))
+            fixed = downsample_volume(fixed, factor, os.path.join(self.registration_folder, 'fixed_lowres.nii.gz'))
         if self.backend == 'python':
             self.compute_registration_python(moving, fixed, registration_method)
         elif self.backend == 'cpp':
@@ -86,41 +226,30 @@ class ANTsRegistration:
         if registration_method == 'SyN':
             registration_method = 'sq'
 
-        if registration_method == 'sq':
+        if registration_method in REGISTRATION_PRESETS:
+            script_path = os.path.join(self.ants_reg_dir, REGISTRATION_PRESETS[registration_method]['script'])
+            registration_method = REGISTRATION_PRESETS[registration_method]['transform']
+        elif registration_method == 'sq':
             script_path = os.path.join(self.ants_reg_dir, 'antsRegistrationSyNQuick.sh')
             registration_method = 's'
         else:
             script_path = os.path.join(self.ants_reg_dir, 'antsRegistrationSyN.sh')
 
+        args = ["{script}".format(script=script_path),
+                '-d{dim}'.format(dim=3),
+                '-f{fixed}'.format(fixed=fixed),
+                '-m{moving}'.format(moving=moving),
+                '-o{output}'.format(output=self.registration_folder),
+                '-t{trans}'.format(trans=registration_method),
+                '-n{cores}'.format(cores=self.threads),
+                #'-p{precision}'.format(precision='f')
+                # '-x[{mask_fixed},{mask_moving}]'.format(
+                #     mask_fixed='',
+                #     mask_moving='')])
+                #'-x{mask}'.format(mask=fixed_mask_filepath)
+                ]
         try:
-            if platform.system() == 'Windows':
-                subprocess.call(["{script}".format(script=script_path),
-                                 '-d{dim}'.format(dim=3),
-                                 '-f{fixed}'.format(fixed=fixed),
-                                 '-m{moving}'.format(moving=moving),
-                                 '-o{output}'.format(output=self.registration_folder),
-                                 '-t{trans}'.format(trans=registration_method),
-                                 '-n{cores}'.format(cores=8),
-                                 #'-p{precision}'.format(precision='f')
-                                 # '-x[{mask_fixed},{mask_moving}]'.format(
-                                 #     mask_fixed='',
-                                 #     mask_moving='')])
-                                 #'-x{mask}'.format(mask=fixed_mask_filepath)
-                                 ], shell=True)
-            else:
-                subprocess.call(["{script}".format(script=script_path),
-                                 '-d{dim}'.format(dim=3),
-                                 '-f{fixed}'.format(fixed=fixed),
-                                 '-m{moving}'.format(moving=moving),
-                                 '-o{output}'.format(output=self.registration_folder),
-                                 '-t{trans}'.format(trans=registration_method),
-                                 '-n{cores}'.format(cores=8),
-                                 #'-p{precision}'.format(precision='f')
-                                 # '-x[{mask_fixed},{mask_moving}]'.format(
-                                 #     mask_fixed='',
-                                 #     mask_moving='')])
-                                 #'-x{mask}'.format(mask=fixed_mask_filepath)
-                                 ])
+            self.get_subprocess_runner().run(args, name='ants_registration', env=self.__get_job_env())
 
             if registration_method == 's':
                 self.reg_transform['fwdtransforms'] = [os.path.join(self.registration_folder, '1Warp.nii.gz'),
@@ -129,8 +258,14 @@ class ANTsRegistration:
                                                        os.path.join(self.registration_folder, '0GenericAffine.mat')]
                 self.transform_names = ['1Warp.nii.gz', '0GenericAffine.mat']
                 self.inverse_transform_names = ['1InverseWarp.nii.gz', '0GenericAffine.mat']
+            elif registration_method in ['r', 'a']:
+                self.reg_transform['fwdtransforms'] = [os.path.join(self.registration_folder, '0GenericAffine.mat')]
+                self.reg_transform['invtransforms'] = [os.path.join(self.registration_folder, '0GenericAffine.mat')]
+                self.transform_names = ['0GenericAffine.mat']
+                self.inverse_transform_names = ['0GenericAffine.mat']
         except Exception as e:
-            print('Exception caught during registration. Error message: {}'.format(e))
+            logging.error('Cpp-based ANTs registration failed with: {}.\n'.format(traceback.format_exc()))
+            raise ValueError('Cpp-based ANTs registration failed.\n')
 
     def compute_registration_python(self, moving, fixed, registration_method):
         """
@@ -141,16 +276,20 @@ class ANTsRegistration:
         try:
             logging.info("starting python-based ANTs registration with method: {}.".format(registration_method))
             moving_ants = ants.image_read(moving, dimension=3)
-            fixed_ants = ants.image_read(fixed, dimension=3)
+            fixed_ants = self.load_fixed_image(fixed)
             if registration_method == 'antsRegistrationSyNQuick[s]' or registration_method == 'antsRegistrationSyN[s]':
                 registration_method = 'SyN'
 
-            self.reg_transform = ants.registration(fixed_ants, moving_ants, registration_method)
+            if registration_method in REGISTRATION_PRESETS:
+                self.reg_transform = ants.registration(fixed_ants, moving_ants,
+                                                       **REGISTRATION_PRESETS[registration_method]['python'])
+            else:
+                self.reg_transform = ants.registration(fixed_ants, moving_ants, registration_method)
             warped_input = ants.apply_transforms(fixed=fixed_ants,
                                                   moving=moving_ants,
                                                   transformlist=self.reg_transform['fwdtransforms'],
                                                   interpolator='linear',
-                                                  whichtoinvert=[False, False])
+                                                  whichtoinvert=[False] * len(self.reg_transform['fwdtransforms']))
             warped_input_filename = os.path.join(self.registration_folder, 'registered_input_volume.nii.gz')
             ants.image_write(warped_input, warped_input_filename)
         except Exception as e:
@@ -164,20 +303,98 @@ class ANTsRegistration:
         elif self.backend == 'cpp':
             return self.apply_registration_transform_cpp(moving, fixed, interpolation)
 
+    def apply_registration_transforms(self, moving: List[str], fixed: str, interpolations: List[str]) -> List[str]:
+        """
+        Apply the registration transform onto several moving images (e.g., a volume and its annotation), all warped
+        against the same reference.
+        With the python backend, the reference image is loaded once and shared by all warps.
+
+        Parameters
+        ----------
+        moving : List[str]
+            Filepaths of the moving images.
+        fixed : str
+            Filepath of the reference image.
+        interpolations : List[str]
+            Interpolation to use for each moving image (e.g., linear for a volume, nearestNeighbor for an annotation).
+        Returns
+        -------
+        List[str]
+            Filepaths of the warped images, in the same order as the moving images.
+        """
+        os.makedirs(self.registration_folder, exist_ok=True)
+        if self.backend == 'python':
+            return self.apply_registration_transforms_python(moving, fixed, interpolations)
+        results = []
+        jobs = []
+        for m, interpolation in zip(moving, interpolations):
+            # Prefixed for all outputs to remain distinct, even with identical basenames.
+            warped_filename = os.path.join(self.registration_folder, 'warped_{}_'.format(len(results)) +
+                                           os.path.basename(m).split('.')[0] + '_reg_atlas.nii.gz')
+            jobs.append((self.get_apply_transform_cpp_args(m, fixed, interpolation, warped_filename),
+                         'ants_apply_{}_{}'.format(len(results), os.path.basename(m).split('.')[0])))
+            results.append(warped_filename)
+        # The warps run concurrently, sharing the threads budgeted for the current job.
+        workers = max(1, min(len(jobs), self.threads))
+        try:
+            with self.get_subprocess_runner(workers=workers) as runner:
+                runner.run_all(jobs, env=self.__get_job_env(max(1, self.threads // workers)))
+        except Exception as e:
+            logging.error('Cpp-based ANTs apply registration failed with: {}.\n'.format(traceback.format_exc()))
+            raise ValueError('Cpp-based ANTs apply registration failed.\n')
+        return results
+
+    def get_subprocess_runner(self, workers: int = 1) -> SubprocessRunner:
+        """
+        Runner for the ANTs executables, saving their logs and timings inside the log folder.
+        :param workers: Number of executables running concurrently.
+        :return: SubprocessRunner instance.
+        """
+        log_folder = self.log_folder if self.log_folder is not None else self.registration_folder
+        return SubprocessRunner(log_folder=log_folder, workers=workers, timeout=self.timeout)
+
+    def __get_job_env(self, threads: int = None) -> dict:
+        """
+        Environment of the ANTs executables, for them to use the number of threads budgeted for the current job.
+        """
+        return {'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': threads if threads is not None else self.threads}
+
     def apply_registration_transform_cpp(self, moving, fixed, interpolation='NearestNeighbor'):
         """
         Apply a registration transform onto the corresponding moving image.
         """
-        optimization_method = 'Linear' if interpolation == 'linear' else 'NearestNeighbor'
         print("Apply registration transform to input volume.")
+        moving_registered_filename = os.path.join(self.registration_folder,
+                                                  os.path.basename(moving).split('.')[0] + '_reg_atlas.nii.gz')
+        args = self.get_apply_transform_cpp_args(moving, fixed, interpolation, moving_registered_filename)
+        try:
+            self.get_subprocess_runner().run(args, name='ants_apply_{}'.format(os.path.basename(moving).split('.')[0]),
+                                             env=self.__get_job_env())
+            return moving_registered_filename
+        except Exception as e:
+            logging.error('Cpp-based ANTs apply registration failed with: {}.\n'.format(traceback.format_exc()))
+            raise ValueError('Cpp-based ANTs apply registration failed.\n')
+
+    def get_apply_transform_cpp_args(self, moving: str, fixed: str, interpolation: str,
+                                     moving_registered_filename: str) -> List[str]:
+        """
+        Arguments of antsApplyTransforms for warping the moving image onto the fixed image.
+        """
+        optimization_method = 'Linear' if interpolation == 'linear' else 'NearestNeighbor'
         script_path = os.path.join(self.ants_apply_dir, 'antsApplyTransforms')
 
         # transform_filenames = [os.path.join(self.registration_folder, x) for x in self.transform_names]
         transform_filenames = self.reg_transform['fwdtransforms']
-        moving_registered_filename = os.path.join(self.registration_folder,
-                                                  os.path.basename(moving).split('.')[0] + '_reg_atlas.nii.gz')
 
-        if len(transform_filenames) == 4:
+        if self.composite_warp:
+            args = ("{script}".format(script=script_path),
+                    "-d", "3",
+                    '-r', '{fixed}'.format(fixed=fixed),
+                    '-i', '{moving}'.format(moving=moving),
+                    '-t', '{transform}'.format(transform=self.get_composite_transform(fixed)),
+                    '-o', '{output}'.format(output=moving_registered_filename),
+                    '-n', '{type}'.format(type=optimization_method))
+        elif len(transform_filenames) == 4:
             args = ("{script}".format(script=script_path),
                     "-d", "3",
                     '-r', '{fixed}'.format(fixed=fixed),
@@ -207,31 +424,19 @@ class ANTsRegistration:
                     '-n', '{type}'.format(type=optimization_method))
         elif len(transform_filenames) == 0:
             raise ValueError('List of transforms is empty.')
-
-        # Or just:
-        # args = "bin/bar -c somefile.xml -d text.txt -r aString -f anotherString".split()
-        try:
-            if platform.system() == 'Windows':
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            else:
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE)
-            popen.wait()
-            output = popen.stdout.read()
-            return moving_registered_filename
-        except Exception as e:
-            logging.error('Cpp-based ANTs apply registration failed with: {}.\n'.format(traceback.format_exc()))
-            raise ValueError('Cpp-based ANTs apply registration failed.\n')
+        return list(args)
 
     def apply_registration_transform_python(self, moving: str, fixed: str, interpolation: str = 'nearestNeighbor') -> str:
         import ants
         try:
             moving_ants = ants.image_read(moving, dimension=3)
-            fixed_ants = ants.image_read(fixed, dimension=3)
+            fixed_ants = self.load_fixed_image(fixed)
+            transform_list, invert_flags = self.__get_python_transforms(fixed)
             warped_input = ants.apply_transforms(fixed=fixed_ants,
                                                  moving=moving_ants,
-                                                 transformlist=self.reg_transform['fwdtransforms'],
+                                                 transformlist=transform_list,
                                                  interpolator=interpolation,
-                                                 whichtoinvert=[False, False])
+                                                 whichtoinvert=invert_flags)
             warped_input_filename = os.path.join(self.registration_folder, 'warped_input_to_output_space.nii.gz')
             ants.image_write(warped_input, warped_input_filename)
             return warped_input_filename
@@ -239,6 +444,38 @@ class ANTsRegistration:
             logging.error('Python-based ANTs apply registration failed with: {}.\n'.format(traceback.format_exc()))
             raise ValueError('Python-based ANTs apply registration failed.\n')
 
+    def apply_registration_transforms_python(self, moving: List[str], fixed: str,
+                                             interpolations: List[str]) -> List[str]:
+        import ants
+        try:
+            fixed_ants = self.load_fixed_image(fixed)
+            transform_list, invert_flags = self.__get_python_transforms(fixed)
+            results = []
+            for m, interpolation in zip(moving, interpolations):
+                warped_input = ants.apply_transforms(fixed=fixed_ants,
+                                                     moving=ants.image_read(m, dimension=3),
+                                                     transformlist=transform_list,
+                                                     interpolator=interpolation,
+                                                     whichtoinvert=invert_flags)
+                warped_input_filename = os.path.join(self.registration_folder,
+                                                     'warped_{}_to_output_space.nii.gz'.format(len(results)))
+                ants.image_write(warped_input, warped_input_filename)
+                results.append(warped_input_filename)
+            return results
+        except Exception as e:
+            logging.error('Python-based ANTs apply registration failed with: {}.\n'.format(traceback.format_exc()))
+            raise ValueError('Python-based ANTs apply registration failed.\n')
+
+    def __get_python_transforms(self, fixed: str, inverse: bool = False) -> Tuple[List[str], List[bool]]:
+        """
+        Transforms list and inversion flags for ants.apply_transforms, collapsed into the composite displacement field
+        if requested.
+        """
+        if self.composite_warp:
+            return [self.get_composite_transform(fixed, inverse=inverse)], [False]
+        chain = self.get_transform_chain(inverse=inverse)
+        return [x[0] for x in chain], [x[1] for x in chain]
+
     def apply_registration_inverse_transform(self, moving, fixed, interpolation='nearestNeighbor', label=''):
         os.makedirs(self.registration_folder, exist_ok=True)
         if self.backend == 'python':
@@ -259,7 +496,15 @@ class ANTsRegistration:
         moving_registered_filename = os.path.join(self.registration_folder, label + '_mask_to_input.nii.gz')
         os.makedirs(os.path.dirname(moving_registered_filename), exist_ok=True)
 
-        if len(transform_filenames) == 4:  # Combined case?
+        if self.composite_warp:
+            args = ("{script}".format(script=script_path),
+                    "-d", "3",
+                    '-r', '{fixed}'.format(fixed=fixed),
+                    '-i', '{moving}'.format(moving=moving),
+                    '-t', '{transform}'.format(transform=self.get_composite_transform(fixed, inverse=True)),
+                    '-o', '{output}'.format(output=moving_registered_filename),
+                    '-n', '{type}'.format(type=optimization_method))
+        elif len(transform_filenames) == 4:  # Combined case?
             args = ("{script}".format(script=script_path),
                     "-d", "3",
                     '-r', '{fixed}'.format(fixed=fixed),
@@ -290,29 +535,26 @@ class ANTsRegistration:
         elif len(transform_filenames) == 0:
             raise ValueError('List of transforms is empty.')
 
-        # Or just:
-        # args = "bin/bar -c somefile.xml -d text.txt -r aString -f anotherString".split()
         try:
-            if platform.system() == 'Windows':
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE, shell=True)
-            else:
-                popen = subprocess.Popen(args, stdout=subprocess.PIPE)
-            popen.wait()
-            output = popen.stdout.read()
+            self.get_subprocess_runner().run(list(args), name='ants_apply_inverse_{}'.format(os.path.basename(label)),
+                                             env=self.__get_job_env())
             return moving_registered_filename
         except Exception as e:
-            print('Failed to apply inverse transforms on input image with {}'.format(e))
+            logging.error('Cpp-based ANTs apply inverse registration failed with: {}.\n'.format(
+                traceback.format_exc()))
+            raise ValueError('Cpp-based ANTs apply inverse registration failed.\n')
 
     def apply_registration_inverse_transform_python(self, moving, fixed, interpolation='nearestNeighbor', label=''):
         import ants
         try:
             moving_ants = ants.image_read(moving, dimension=3)
-            fixed_ants = ants.image_read(fixed, dimension=3)
+            fixed_ants = self.load_fixed_image(fixed)
+            transform_list, invert_flags = self.__get_python_transforms(fixed, inverse=True)
             warped_input = ants.apply_transforms(fixed=fixed_ants,
                                                  moving=moving_ants,
-                                                 transformlist=self.reg_transform['invtransforms'],
+                                                 transformlist=transform_list,
                                                  interpolator=interpolation,
-                                                 whichtoinvert=[True, False])
+                                                 whichtoinvert=invert_flags)
             warped_input_filename = os.path.join(self.registration_folder, label + '_mask.nii.gz')
             # warped_input_filename = os.path.join(ResourcesConfiguration.getInstance().output_folder, 'patient',
             #                                           label + '_mask.nii.gz')
@@ -321,3 +563,104 @@ class ANTsRegistration:
             return warped_input_filename
         except Exception as e:
             print('Exception caught during applying registration inverse transform. Error message: {}'.format(e))
+
+    def apply_registration_inverse_transforms(self, moving: List, fixed: str, interpolations: List[str],
+                                              output_filepaths: List[str], pixel_types: List[str] = None) -> List[str]:
+        """
+        Maps several images from the fixed space back onto the moving space (e.g., a population heatmap and atlas
+        regions onto a patient volume), all warped against the same reference.
+        With the python backend, the reference image is loaded once and shared by all warps, and the moving images can
+        be given already loaded. With the cpp backend, the warps run concurrently.
+        The inverse transforms must be listed in the order expected by ANTs, the affine matrices being inverted.
+
+        Parameters
+        ----------
+        moving : List
+            Filepaths of the images to warp, or loaded ANTsImage with the python backend.
+        fixed : str
+            Filepath of the reference image, in the moving space of the registration.
+        interpolations : List[str]
+            Interpolation to use for each image (e.g., linear for a heatmap, nearestNeighbor for labels).
+        output_filepaths : List[str]
+            Destination of each warped image.
+        pixel_types : List[str]
+            Voxel type of each warped image, to sample from [uchar, uint, float] (float by default).
+        Returns
+        -------
+        List[str]
+            Filepaths of the warped images, in the same order as the moving images.
+        """
+        if pixel_types is None:
+            pixel_types = ['float'] * len(moving)
+        for fp in output_filepaths:
+            os.makedirs(os.path.dirname(fp), exist_ok=True)
+        if self.backend == 'python':
+            import ants
+            try:
+                fixed_ants = self.load_fixed_image(fixed)
+                transform_list, invert_flags = self.__get_python_transforms(fixed, inverse=True)
+                for m, interpolation, output_filepath, pixel_type in zip(moving, interpolations, output_filepaths,
+                                                                         pixel_types):
+                    moving_ants = ants.image_read(m, dimension=3) if isinstance(m, str) else m
+                    warped = ants.apply_transforms(fixed=fixed_ants, moving=moving_ants, transformlist=transform_list,
+                                                   interpolator=interpolation, whichtoinvert=invert_flags)
+                    if pixel_type != 'float':
+                        warped = warped.clone({'uchar': 'unsigned char', 'uint': 'unsigned int'}[pixel_type])
+                    ants.image_write(warped, output_filepath)
+                return output_filepaths
+            except Exception as e:
+                logging.error('Python-based ANTs apply inverse registration failed with: {}.\n'.format(
+                    traceback.format_exc()))
+                raise ValueError('Python-based ANTs apply inverse registration failed.\n')
+
+        if self.composite_warp:
+            chain = [(self.get_composite_transform(fixed, inverse=True), False)]
+        else:
+            chain = self.get_transform_chain(inverse=True)
+        if len(chain) == 0:
+            raise ValueError('List of transforms is empty.')
+        jobs = []
+        for m, interpolation, output_filepath, pixel_type in zip(moving, interpolations, output_filepaths,
+                                                                 pixel_types):
+            args = [os.path.join(self.ants_apply_dir, 'antsApplyTransforms'), "-d", "3", '-r', fixed, '-i', m]
+            for x, flag in chain:
+                args += ['-t', '[{}, 1]'.format(x) if flag else x]
+            args += ['-o', output_filepath, '-n', 'Linear' if interpolation == 'linear' else 'NearestNeighbor',
+                     '-u', {'uchar': 'uchar', 'uint': 'int', 'float': 'float'}[pixel_type]]
+            jobs.append((args, 'ants_apply_inverse_{}'.format(os.path.basename(output_filepath).split('.')[0])))
+        workers = max(1, min(len(jobs), self.threads))
+        try:
+            with self.get_subprocess_runner(workers=workers) as runner:
+                runner.run_all(jobs, env=self.__get_job_env(max(1, self.threads // workers)))
+        except Exception as e:
+            logging.error('Cpp-based ANTs apply inverse registration failed with: {}.\n'.format(
+                traceback.format_exc()))
+            raise ValueError('Cpp-based ANTs apply inverse registration failed.\n')
+        return output_filepaths
+
+
+def downsample_volume(filepath: str, factor: int, output_filepath: str) -> str:
+    """
+    Downsamples a volume by an integer factor along each axis, after a light smoothing against aliasing, keeping the
+    same physical extent.
+    :param filepath: Location on disk of the volume.
+    :param factor: Downsampling factor.
+    :param output_filepath: Location on disk where the downsampled volume is saved.
+    :return: Location on disk of the downsampled volume.
+    """
+    import nibabel as nib
+    from scipy.ndimage import gaussian_filter
+    from nibabel.processing import resample_from_to
+
+    image_ni = nib.load(filepath)
+    data = gaussian_filter(image_ni.get_fdata()[..., 0] if len(image_ni.shape) > 3 else image_ni.get_fdata(),
+                           sigma=(factor - 1) / 2.)
+    # Voxel centers of the downsampled grid placed at the center of each block of the original grid.
+    scaling = np.diag([factor, factor, factor, 1.])
+    scaling[:3, 3] = (factor - 1) / 2.
+    target_affine = image_ni.affine @ scaling
+    target_shape = tuple(int(np.ceil(x / factor)) for x in data.shape[:3])
+    resampled_ni = resample_from_to(nib.Nifti1Image(data.astype('float32'), image_ni.affine),
+                                    (target_shape, target_affine), order=1)
+    nib.save(resampled_ni, output_filepath)
+    return output_filepath
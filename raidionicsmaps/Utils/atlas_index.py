@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from typing import List, Tuple, Union
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from .resources import SharedResources
+
+# Atlas files, relative to the Atlases folder of raidionics_rads, following its own configuration.
+CORTICAL_ATLASES = {"MNI": ["mni_icbm152_nlin_sym_09a/reduced_lobes_brain.nii.gz",
+                            "mni_icbm152_nlin_sym_09a/lobe_labels_description.csv"],
+                    "Harvard-Oxford": ["Harvard-Oxford/HarvardOxford-cort-maxprob-thr0-1mm_mni.nii.gz",
+                                       "Harvard-Oxford/regions_description.csv"],
+                    "Schaefer400": ["Schaefer400/schaefer400MNI_mni.nii.gz",
+                                    "Schaefer400/400regions_description.csv"],
+                    "Schaefer17": ["Schaefer400/schaefer17MNI_mni.nii.gz", "Schaefer400/17regions_description.csv"],
+                    "Schaefer7": ["Schaefer400/schaefer7MNI_mni.nii.gz", "Schaefer400/7regions_description.csv"]}
+SUBCORTICAL_ATLASES = {"BCB": ["bcb_tracts/StandAlone", 0.5]}
+LATERALISATION_MASK = "mni_icbm152_nlin_sym_09a/extended_lateralisation_mask.nii.gz"
+ATLAS_INDEX_VERSION = 1
+
+# Atlas index opened inside the current process, shared by all patients.
+_atlas_index = None
+
+
+class AtlasIndex:
+    """
+    One-time on-disk index of the MNI-space atlases used for the location metrics, stored as memory-mappable .npy files
+    inside the models folder, such that no atlas volume is ever scanned again for a patient.
+    The hemisphere lookup and the region label of each cortical atlas are stored as the rows of a single flat-voxel
+    lookup array, each row shifted into a common region identifier space, for counting the object voxels within every
+    region of every atlas with a single np.bincount over the object voxel indices. As the subcortical tracts overlap
+    each other, the tracts of each voxel are stored as a compressed sparse row lookup instead, together with the
+    border voxels of each tract for the distances. The voxel size of each region and tract is stored alongside.
+    The index is rebuilt whenever one of the atlas files changes.
+    """
+    _index_folder = None  # Folder where the index files are stored
+    _atlases_folder = None  # Folder holding the atlases the index is built from
+    _header = None  # Content of index.json, with the atlases layout and the region names
+    _regions = None  # Region identifier of each flat voxel for the hemispheres and each cortical atlas, memory-mapped
+    _sizes = None  # Number of voxels of each region identifier
+    _tracts_pointers = None  # Start of the tracts of each flat voxel inside _tracts_ids, memory-mapped
+    _tracts_ids = None  # Tract identifiers of all voxels, ordered by voxel, memory-mapped
+    _surfaces_pointers = None  # Start of the border voxels of each tract inside _surfaces
+    _surfaces = None  # Border voxel coordinates of all tracts, ordered by tract
+    _trees = {}  # KD-trees over the tract borders, built on first use, indexed by tract identifier
+
+    def __init__(self, index_folder: str = None, atlases_folder: str = None) -> None:
+        """
+        :param index_folder: Folder where the index files are stored, Atlas_index inside the models folder if None.
+        :param atlases_folder: Folder holding the atlases, following the layout of the Atlases folder of
+        raidionics_rads, whose own folder is used if None.
+        """
+        self.__reset()
+        self._index_folder = index_folder if index_folder is not None else \
+            os.path.join(SharedResources.getInstance().system_models_folder, 'Atlas_index')
+        self._atlases_folder = atlases_folder if atlases_folder is not None else get_atlases_folder()
+        os.makedirs(self._index_folder, exist_ok=True)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._index_folder = None
+        self._atlases_folder = None
+        self._header = None
+        self._regions = None
+        self._sizes = None
+        self._tracts_pointers = None
+        self._tracts_ids = None
+        self._surfaces_pointers = None
+        self._surfaces = None
+        self._trees = {}
+
+    @property
+    def index_folder(self) -> str:
+        return self._index_folder
+
+    @property
+    def atlases_folder(self) -> str:
+        return self._atlases_folder
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(self._header["shape"])
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return self._sizes
+
+    def load(self) -> None:
+        """
+        Opens the index files, the index being built first if missing or outdated.
+        :return: None
+        """
+        header_filename = os.path.join(self.index_folder, 'index.json')
+        header = None
+        if os.path.exists(header_filename):
+            try:
+                with open(header_filename, 'r') as infile:
+                    header = json.load(infile)
+            except Exception as e:
+                logging.warning("Atlas index header {} could not be read, and is rebuilt.".format(header_filename))
+        if header is None or header.get("version") != ATLAS_INDEX_VERSION or \
+                header.get("sources") != get_atlas_sources(self.atlases_folder):
+            header = self.build()
+
+        self._header = header
+        self._regions = np.load(os.path.join(self.index_folder, 'regions.npy'), mmap_mode='r')
+        self._sizes = np.load(os.path.join(self.index_folder, 'sizes.npy'))
+        self._tracts_pointers = np.load(os.path.join(self.index_folder, 'tracts_pointers.npy'), mmap_mode='r')
+        self._tracts_ids = np.load(os.path.join(self.index_folder, 'tracts_ids.npy'), mmap_mode='r')
+        self._surfaces_pointers = np.load(os.path.join(self.index_folder, 'surfaces_pointers.npy'))
+        self._surfaces = np.load(os.path.join(self.index_folder, 'surfaces.npy'), mmap_mode='r')
+
+    def build(self) -> dict:
+        """
+        Builds the index from the atlases. The files are first written under a temporary name, for
+        the index to be safely built by parallel processes, the header being written last.
+        :return: Content of the index header.
+        """
+        start = time.time()
+        logging.info("Building the atlas index in {}.".format(self.index_folder))
+        atlases_folder = self.atlases_folder
+        header = {"version": ATLAS_INDEX_VERSION, "sources": get_atlas_sources(atlases_folder), "shape": None,
+                  "cortical": {}, "subcortical": {}}
+
+        lateralisation_ni = nib.load(os.path.join(atlases_folder, LATERALISATION_MASK))
+        header["shape"] = list(lateralisation_ni.shape)
+        rows = [np.rint(lateralisation_ni.get_fdata()).astype('uint16').ravel()]
+        header["lateralisation"] = {"offset": 0, "size": int(rows[0].max()) + 1}
+        offset = header["lateralisation"]["size"]
+        for reference in CORTICAL_ATLASES:
+            regions = np.rint(nib.load(os.path.join(atlases_folder, CORTICAL_ATLASES[reference][0])).get_fdata())
+            regions = regions.astype('uint16').ravel()
+            labels, names = get_region_names(reference, regions,
+                                             os.path.join(atlases_folder, CORTICAL_ATLASES[reference][1]))
+            if offset + int(regions.max()) + 1 > np.iinfo('uint16').max:
+                raise ValueError("Too many atlas regions for the atlas index.")
+            header["cortical"][reference] = {"offset": offset, "size": int(regions.max()) + 1, "labels": labels,
+                                             "names": names}
+            rows.append(regions + offset)
+            offset = offset + int(regions.max()) + 1
+        regions = np.stack(rows, axis=0)
+        sizes = np.bincount(regions.ravel(), minlength=offset)
+
+        voxels = []
+        surfaces = []
+        tract_sizes = []
+        for reference in SUBCORTICAL_ATLASES:
+            folder = os.path.join(atlases_folder, SUBCORTICAL_ATLASES[reference][0])
+            header["subcortical"][reference] = {"offset": len(tract_sizes), "names": [], "spacing": []}
+            for fn in sorted(os.listdir(folder), key=str.lower):
+                tract_ni = nib.load(os.path.join(folder, fn))
+                tract = tract_ni.get_fdata() >= SUBCORTICAL_ATLASES[reference][1]
+                if tract.shape != tuple(header["shape"]):
+                    raise ValueError("Tract {} not in the MNI space of the atlas index.".format(fn))
+                header["subcortical"][reference]["names"].append('_'.join(fn.split('.')[0].split('_')[:-1]))
+                header["subcortical"][reference]["spacing"].append([float(x) for x in tract_ni.header.get_zooms()])
+                voxels.append(np.flatnonzero(tract))
+                tract_sizes.append(len(voxels[-1]))
+                surfaces.append(get_surface_voxels(tract) if len(voxels[-1]) != 0 else np.zeros((0, 3), 'int16'))
+        header["tract_sizes"] = tract_sizes
+        tract_ids = np.repeat(np.arange(len(tract_sizes), dtype='uint16'), tract_sizes)
+        voxels = np.concatenate(voxels) if len(voxels) != 0 else np.zeros(0, dtype='int64')
+        order = np.argsort(voxels, kind='stable')
+        tracts_pointers = np.zeros(regions.shape[1] + 1, dtype='int64')
+        tracts_pointers[1:] = np.cumsum(np.bincount(voxels, minlength=regions.shape[1]))
+        surfaces_pointers = np.zeros(len(surfaces) + 1, dtype='int64')
+        surfaces_pointers[1:] = np.cumsum([len(s) for s in surfaces])
+
+        arrays = {'regions': regions, 'sizes': sizes, 'tracts_pointers': tracts_pointers,
+                  'tracts_ids': tract_ids[order],
+                  'surfaces_pointers': surfaces_pointers,
+                  'surfaces': np.concatenate(surfaces, axis=0) if len(surfaces) != 0 else np.zeros((0, 3), 'int16')}
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        try:
+            for name in arrays:
+                filename = os.path.join(self.index_folder, name + '.npy')
+                with open(filename + tmp_suffix, 'wb') as outfile:
+                    np.save(outfile, arrays[name])
+                os.replace(filename + tmp_suffix, filename)
+            header_filename = os.path.join(self.index_folder, 'index.json')
+            with open(header_filename + tmp_suffix, 'w') as outfile:
+                json.dump(header, outfile)
+            os.replace(header_filename + tmp_suffix, header_filename)
+        finally:
+            for fn in os.listdir(self.index_folder):
+                if fn.endswith(tmp_suffix):
+                    os.remove(os.path.join(self.index_folder, fn))
+        logging.info("Atlas index built in {} seconds.".format(round(time.time() - start, 1)))
+        return header
+
+    def check_shape(self, shape: Tuple[int, ...]) -> None:
+        """
+        Ensures that an annotation mask lies in the MNI space of the atlases.
+        """
+        if tuple(shape) != self.shape:
+            raise ValueError("Annotation mask of shape {} not in the MNI space of the atlases, of shape {}.".format(
+                tuple(shape), self.shape))
+
+    def count_regions(self, voxels: np.ndarray) -> np.ndarray:
+        """
+        Counts the voxels within each region of the hemispheres and of every cortical atlas at once.
+        :param voxels: Flat indices of the object voxels.
+        :return: Number of object voxels for each region identifier.
+        """
+        return np.bincount(self._regions[:, voxels].ravel(), minlength=len(self.sizes))
+
+    def count_tracts(self, voxels: np.ndarray) -> np.ndarray:
+        """
+        Counts the voxels within each tract of every subcortical atlas at once.
+        :param voxels: Flat indices of the object voxels.
+        :return: Number of object voxels for each tract identifier.
+        """
+        starts = np.asarray(self._tracts_pointers[voxels])
+        lengths = np.asarray(self._tracts_pointers[voxels + 1]) - starts
+        # Positions of the tracts of all object voxels inside the tract identifiers.
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(int(lengths.sum()))
+        return np.bincount(self._tracts_ids[positions], minlength=len(self._header["tract_sizes"]))
+
+    def get_hemisphere_counts(self, counts: np.ndarray) -> Tuple[int, int]:
+        """
+        :param counts: Number of object voxels for each region identifier.
+        :return: Number of object voxels within the left and right hemispheres.
+        """
+        offset = self._header["lateralisation"]["offset"]
+        return int(counts[offset + 2]), int(counts[offset + 1])
+
+    def get_cortical_counts(self, counts: np.ndarray, reference: str) -> dict:
+        """
+        :param counts: Number of object voxels for each region identifier.
+        :param reference: Cortical structures atlas.
+        :return: Number of object voxels within each region of the atlas, indexed by region name.
+        """
+        if reference not in self._header["cortical"]:
+            raise ValueError("Unknown cortical structures atlas {}, to sample from {}.".format(
+                reference, list(self._header["cortical"].keys())))
+        atlas = self._header["cortical"][reference]
+        return {n: int(counts[atlas["offset"] + l]) for l, n in zip(atlas["labels"], atlas["names"])}
+
+    def get_tracts(self, reference: str) -> List[Tuple[int, str]]:
+        """
+        :param reference: Subcortical structures atlas.
+        :return: Identifier and name of each tract of the atlas.
+        """
+        if reference not in self._header["subcortical"]:
+            raise ValueError("Unknown subcortical structures atlas {}, to sample from {}.".format(
+                reference, list(self._header["subcortical"].keys())))
+        atlas = self._header["subcortical"][reference]
+        return [(atlas["offset"] + i, n) for i, n in enumerate(atlas["names"])]
+
+    def get_tract_spacing(self, tract_id: int) -> Tuple[float, ...]:
+        for reference in self._header["subcortical"]:
+            atlas = self._header["subcortical"][reference]
+            if atlas["offset"] <= tract_id < atlas["offset"] + len(atlas["names"]):
+                return tuple(atlas["spacing"][tract_id - atlas["offset"]])
+        raise ValueError("Unknown tract identifier {}.".format(tract_id))
+
+    def get_tract_tree(self, tract_id: int) -> Union[None, cKDTree]:
+        """
+        KD-tree over the border coordinates, in millimeters, of a tract.
+        :param tract_id: Tract identifier.
+        :return: KD-tree, or None if the tract is empty.
+        """
+        if self._header["tract_sizes"][tract_id] == 0:
+            return None
+        if tract_id not in self._trees:
+            surface = self._surfaces[self._surfaces_pointers[tract_id]:self._surfaces_pointers[tract_id + 1]]
+            self._trees[tract_id] = cKDTree(surface * np.asarray(self.get_tract_spacing(tract_id)[0:3],
+                                                                 dtype=np.float64))
+        return self._trees[tract_id]
+
+
+def get_atlas_index() -> AtlasIndex:
+    """
+    Atlas index of the current process, opened on first use.
+    """
+    global _atlas_index
+    if _atlas_index is None:
+        index = AtlasIndex()
+        index.load()
+        _atlas_index = index
+    return _atlas_index
+
+
+def get_atlases_folder() -> str:
+    """
+    Folder holding the MNI-space atlases shipped with raidionics_rads.
+    """
+    import raidionicsrads
+    return os.path.join(os.path.dirname(os.path.realpath(raidionicsrads.__file__)), 'Atlases')
+
+
+def get_atlas_sources(atlases_folder: str) -> dict:
+    """
+    Identification of the atlas files the index is built from, by location, size and modification time.
+    :param atlases_folder: Folder holding the atlases.
+    """
+    filenames = [LATERALISATION_MASK] + [f for r in CORTICAL_ATLASES for f in CORTICAL_ATLASES[r]]
+    for reference in SUBCORTICAL_ATLASES:
+        folder = SUBCORTICAL_ATLASES[reference][0]
+        filenames.extend([folder + '/' + fn for fn in sorted(os.listdir(os.path.join(atlases_folder, folder)))])
+    sources = {"folder": atlases_folder}
+    for fn in filenames:
+        stat = os.stat(os.path.join(atlases_folder, fn))
+        sources[fn] = [stat.st_size, stat.st_mtime_ns]
+    return sources
+
+
+def get_region_names(reference: str, regions: np.ndarray, description_filename: str) -> Tuple[List[int], List[str]]:
+    """
+    Names of the regions of a cortical structures atlas, as inside the raidionics_rads reports, where later labels
+    sharing the same name override the earlier ones.
+    :param reference: Cortical structures atlas.
+    :param regions: Region labels of the atlas.
+    :param description_filename: Description of the atlas regions.
+    :return: Label and name of each region, without the background.
+    """
+    description = pd.read_csv(description_filename)
+    by_name = {}
+    for li in np.unique(regions)[1:]:  # Removing the background label with value 0.
+        row = description.loc[description['Label'] == li]
+        if reference == 'MNI':
+            laterality = str(row['Laterality'].values[0]).strip()
+            name = '-'.join(str(row['Region'].values[0]).strip().split(' ')) + '_' + \
+                   (laterality if laterality != 'None' else '')
+        elif reference == 'Harvard-Oxford':
+            name = '-'.join(row['Region'].values[0].strip().split(' '))
+        else:
+            name = '_'.join(row['Region'].values[0].strip().split(' '))
+        by_name[name] = int(li)
+    return list(by_name.values()), list(by_name.keys())
+
+
+def get_surface_voxels(mask: np.ndarray, bbox: Tuple[slice, ...] = None) -> np.ndarray:
+    """
+    Coordinates of the one-voxel border of a binary mask, the voxels along the volume boundaries being part of it.
+    :param mask: Binary mask.
+    :param bbox: Bounding box of the mask content, for only eroding the mask within (whole mask if None).
+    :return: Border voxels coordinates, as an array of shape (N, 3).
+    """
+    if bbox is None:
+        bbox = ndimage.find_objects(mask.astype('uint8'))[0]
+    # One voxel margin for the erosion, for the border to be identical to the whole volume one.
+    bbox = tuple([slice(max(0, s.start - 1), min(mask.shape[i], s.stop + 1)) for i, s in enumerate(bbox)])
+    crop = mask[bbox]
+    border = crop & ~ndimage.binary_erosion(crop, structure=ndimage.generate_binary_structure(crop.ndim, 1))
+    return (np.argwhere(border) + np.asarray([s.start for s in bbox])).astype('int16')
@@ -4,6 +4,9 @@ import pandas as pd
 import numpy as np
 from pathlib import PurePath
 from nibabel import four_to_three
+from nibabel.openers import Opener
+from nibabel.arraywriters import make_array_writer, get_slope_inter
+from nibabel.volumeutils import array_to_file, seek_tell
 import logging
 import traceback
 import zipfile
@@ -125,3 +128,117 @@ def download_model(model_name: str):
         print('{}'.format(traceback.format_exc()))
         logging.error('Issue trying to collect the latest {} model with: \n {}'.format(model_name,
                                                                                        traceback.format_exc()))
+
+
+def compute_file_fingerprint(filepath: str, previous: dict = None) -> dict:
+    """
+    Computes the fingerprint of a file, for identifying whether its content changed since it was last processed.
+    The content hash is only recomputed if the size or modification time of the file differ from the previous
+    fingerprint.
+
+    Parameters
+    ----------
+    filepath: str
+        Location on disk of the file to fingerprint.
+    previous: dict
+        Fingerprint of the file computed during a previous run, if any.
+    """
+    stat = os.stat(filepath)
+    if previous is not None and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": previous["sha1"]}
+
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            sha1.update(chunk)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha1": sha1.hexdigest()}
+
+
+class NiftiSlabWriter:
+    """
+    Writer of a (compressed) NIfTI file, one slab along the last axis after the other, such that the full volume never
+    needs to be held in memory.
+    The header is derived as nibabel would when saving a Nifti1Image built from the reference image header, for the
+    file content to be identical to a whole-volume save.
+    """
+    _filename = None  # Destination filepath of the NIfTI file
+    _fileobj = None  # Opened (compressed) destination file
+    _header = None  # NIfTI header written on disk
+    _dtype = None  # Type of the slabs to write
+    _out_dtype = None  # On-disk data type, including the byte order
+    _remaining = 0  # Number of voxels still to be written
+
+    def __init__(self, filename: str, reference_ni: nib.Nifti1Image, dtype, set_data_dtype: bool = False) -> None:
+        """
+        :param filename: Destination filepath, compressed if ending with .gz
+        :param reference_ni: Image providing the shape, affine, and header of the volume to write.
+        :param dtype: Type of the slabs to write.
+        :param set_data_dtype: Whether the on-disk data type is dtype, rather than the one from the reference header.
+        """
+        self.__reset()
+        self._filename = filename
+        self._dtype = np.dtype(dtype)
+        sample_ni = nib.Nifti1Image(np.zeros((1,) * len(reference_ni.shape), dtype=dtype), reference_ni.affine,
+                                    reference_ni.header)
+        if set_data_dtype:
+            sample_ni.set_data_dtype(dtype)
+        if (np.issubdtype(sample_ni.get_data_dtype(), np.integer) and
+                not np.issubdtype(np.dtype(dtype), np.integer)):
+            # A scaling into integers would depend on the values over the full volume, unknown while streaming.
+            logging.warning("Saving {} as {} rather than with a rescaling to {}.".format(
+                filename, np.dtype(dtype), sample_ni.get_data_dtype()))
+            sample_ni.set_data_dtype(dtype)
+        sample_ni.get_data_dtype(finalize=True)
+        sample_ni.update_header()
+        self._header = sample_ni.header
+        self._header.set_data_shape(reference_ni.shape)
+        self._out_dtype = self._header.get_data_dtype()
+        slope = self._header['scl_slope'].item()
+        inter = self._header['scl_inter'].item()
+        if np.all(np.isnan((slope, inter))):
+            self._header.set_slope_inter(*get_slope_inter(make_array_writer(np.asanyarray(sample_ni.dataobj),
+                                                                            self._out_dtype)))
+        self._remaining = int(np.prod(reference_ni.shape))
+
+        self._fileobj = Opener(filename, 'wb')
+        self._header.write_to(self._fileobj)
+        seek_tell(self._fileobj, self._header.get_data_offset(), write0=True)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._filename = None
+        self._fileobj = None
+        self._header = None
+        self._dtype = None
+        self._out_dtype = None
+        self._remaining = 0
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    def write_slab(self, slab: np.ndarray) -> None:
+        """
+        Appends the next slab of the volume, following the last axis.
+        :param slab: Slab with all but the last dimensions matching the volume, or its Fortran-ordered flat version.
+        :return: None
+        """
+        array_to_file(slab, self._fileobj, self._out_dtype, offset=self._fileobj.tell(), order='F')
+        self._remaining -= slab.size
+
+    def close(self) -> None:
+        """
+        Finalizes the file, which must have been written entirely.
+        :return: None
+        """
+        self._fileobj.close()
+        if self._remaining != 0:
+            raise ValueError("Incomplete NIfTI file written in {}, with {} missing voxels.".format(self._filename,
+                                                                                                   self._remaining))
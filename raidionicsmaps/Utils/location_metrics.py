@@ -0,0 +1,194 @@
+import logging
+import numpy as np
+from typing import List, Tuple
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from .atlas_index import AtlasIndex, get_atlas_index, get_surface_voxels
+
+
+def compute_location_report(tumor: np.ndarray, spacing: Tuple[float, ...], cortical: List[str] = None,
+                            subcortical: List[str] = None) -> dict:
+    """
+    Computes the location metrics of an annotation mask already registered to the MNI space, directly from voxel counts
+    through the atlas index, inside the current process. The values follow the raidionics_rads neuro_diagnosis
+    task, from the same refined mask, and are laid out as its neuro_clinical_report.json for the Metrics structure.
+    :param tumor: Annotation mask in MNI space, already refined with refine_mask.
+    :param spacing: Voxel size of the annotation mask.
+    :param cortical: Cortical structures atlases, to sample from [MNI, Harvard-Oxford, Schaefer7, Schaefer17,
+    Schaefer400].
+    :param subcortical: Subcortical structures atlases, to sample from [BCB].
+    :return: Report with the multifocality under Overall, and the lateralisation and structures overlap under
+    Main/Total.
+    """
+    cortical = cortical if cortical is not None else []
+    subcortical = subcortical if subcortical is not None else []
+    index = get_atlas_index()
+    report = {"Overall": {}, "Main": {"Total": {"CorticalStructures": {}, "SubcorticalStructures": {}}}}
+    total = report["Main"]["Total"]
+    if not np.any(tumor):
+        logging.warning("Empty annotation mask after refinement, all location metrics are left to zero.")
+        report["Overall"].update({"Multifocality": False, "Tumor parts nb": 0, "Multifocal distance (mm)": -1.})
+        total.update({"Left laterality (%)": 0., "Right laterality (%)": 0., "Midline crossing": False})
+        for s in cortical:
+            total["CorticalStructures"][s] = {n: 0. for n in index.get_cortical_counts(index.sizes, s)}
+        for s in subcortical:
+            names = [n for _, n in index.get_tracts(s)]
+            total["SubcorticalStructures"][s] = {**{n + '_overlap': 0. for n in names},
+                                                 **{n + '_distance': -1. for n in names}}
+        return report
+
+    index.check_shape(tumor.shape)
+    voxels = np.flatnonzero(tumor)
+    # All regions of all atlases counted at once, over the object voxels only.
+    region_counts = index.count_regions(voxels)
+    tract_counts = index.count_tracts(voxels) if len(subcortical) != 0 else None
+
+    status, parts, distance = compute_multifocality(tumor, spacing)
+    report["Overall"].update({"Multifocality": status, "Tumor parts nb": parts, "Multifocal distance (mm)": distance})
+    left, right, crossing = compute_lateralisation(index, region_counts, len(voxels))
+    total.update({"Left laterality (%)": left, "Right laterality (%)": right, "Midline crossing": crossing})
+    for s in cortical:
+        total["CorticalStructures"][s] = compute_cortical_overlaps(index, region_counts, len(voxels), s)
+    for s in subcortical:
+        overlaps, distances = compute_subcortical_overlaps(index, tract_counts, tumor, s)
+        total["SubcorticalStructures"][s] = {**{n + '_overlap': overlaps[n] for n in overlaps},
+                                             **{n + '_distance': distances[n] for n in distances}}
+    return report
+
+
+def refine_mask(mask: np.ndarray) -> np.ndarray:
+    """
+    Removes the small and noisy areas of the annotation mask, with a morphological closing and a 100 voxels cutoff on
+    the connected components, as done by raidionics_rads before computing the location metrics.
+    :param mask: Annotation mask.
+    :return: Refined mask, as boolean.
+    """
+    refined = np.zeros(mask.shape, dtype='bool')
+    bbox = ndimage.find_objects((mask != 0).astype('uint8'))
+    if len(bbox) == 0:
+        return refined
+    # Closing within the bounding box, with enough margin for the closing to be identical to the whole volume one.
+    bbox = tuple([slice(max(0, s.start - 5), min(mask.shape[i], s.stop + 5)) for i, s in enumerate(bbox[0])])
+    z, y, x = np.ogrid[-2:3, -2:3, -2:3]
+    kernel = (x ** 2 + y ** 2 + z ** 2) <= 4
+    closed = ndimage.binary_closing(mask[bbox] != 0, structure=kernel, iterations=1)
+    labels = ndimage.label(closed)[0]
+    keep = np.bincount(labels.ravel()) >= 100
+    keep[0] = False
+    refined[bbox] = keep[labels]
+    return refined
+
+
+def compute_lateralisation(index: AtlasIndex, region_counts: np.ndarray, total: int) -> Tuple[float, float, bool]:
+    """
+    Percentage of the object within each hemisphere, from the MNI lateralisation mask.
+    :param index: Atlas index.
+    :param region_counts: Number of object voxels for each region identifier of the atlas index.
+    :param total: Number of object voxels.
+    :return: Left and right hemisphere percentages, and whether the object crosses the midline.
+    """
+    left_count, right_count = index.get_hemisphere_counts(region_counts)
+    left = round(left_count / total * 100., 2)
+    right = round(right_count / total * 100., 2)
+    return float(left), float(right), True if max(left, right) < 100. else False
+
+
+def compute_multifocality(tumor: np.ndarray, spacing: Tuple[float, ...], volume_threshold: float = 0.1,
+                          distance_threshold: float = 5.0) -> Tuple[bool, int, float]:
+    """
+    Counts the foci of the object and the largest distance between the main focus and a satellite.
+    :param tumor: Refined annotation mask.
+    :param spacing: Voxel size of the annotation mask.
+    :param volume_threshold: Minimum volume, in milliliters, for a connected component to be considered as a focus.
+    :param distance_threshold: Minimum distance, in millimeters, between two foci for the object to be multifocal.
+    :return: Multifocality status, number of foci, and largest 95th percentile Hausdorff distance between the main
+    focus and a satellite (-1 if single focus).
+    When no connected component reaches the volume threshold, where raidionics_rads fails, the object is reported as
+    a single focus, as if it only had one connected component.
+    """
+    # Within the bounding box, with one voxel margin for the borders to be identical to the whole volume ones.
+    bbox = ndimage.find_objects(tumor.astype('uint8'))[0]
+    bbox = tuple([slice(max(0, s.start - 1), min(tumor.shape[i], s.stop + 1)) for i, s in enumerate(bbox)])
+    labels, nb_labels = ndimage.label(tumor[bbox])
+    if nb_labels <= 1:
+        return False, 1, -1.
+
+    sizes = np.bincount(labels.ravel())[1:]
+    parts = [l for l in range(nb_labels) if sizes[l] * np.prod(spacing[0:3]) * 1e-3 >= volume_threshold]
+    if len(parts) == 0:
+        return False, 1, -1.
+    main = parts[int(np.argmax(sizes[parts]))]
+    objects = ndimage.find_objects(labels)
+    main_points = cKDTree(get_surface_points(labels == (main + 1), spacing, objects[main]))
+    largest_distance = -1.
+    for l in parts:
+        if l != main:
+            satellite_points = get_surface_points(labels == (l + 1), spacing, objects[l])
+            largest_distance = max(largest_distance, compute_hd95(satellite_points, main_points))
+    return True if largest_distance >= distance_threshold else False, len(parts), float(largest_distance)
+
+
+def compute_cortical_overlaps(index: AtlasIndex, region_counts: np.ndarray, total: int, reference: str) -> dict:
+    """
+    Percentage of the object within each region of a cortical structures atlas.
+    :param index: Atlas index.
+    :param region_counts: Number of object voxels for each region identifier of the atlas index.
+    :param total: Number of object voxels.
+    :param reference: Cortical structures atlas.
+    :return: Overlap percentage for each region, indexed by region name.
+    """
+    counts = index.get_cortical_counts(region_counts, reference)
+    return {n: float(round(counts[n] / total * 100., 2)) for n in counts}
+
+
+def compute_subcortical_overlaps(index: AtlasIndex, tract_counts: np.ndarray, tumor: np.ndarray,
+                                 reference: str) -> Tuple[dict, dict]:
+    """
+    Percentage of the object within each tract of a subcortical structures atlas, and the 95th percentile Hausdorff
+    distance to the tracts not overlapping with the object.
+    :param index: Atlas index.
+    :param tract_counts: Number of object voxels for each tract identifier of the atlas index.
+    :param tumor: Refined annotation mask, in MNI space.
+    :param reference: Subcortical structures atlas.
+    :return: Overlap percentage and distance (-1 if overlapping) for each tract, indexed by tract name.
+    """
+    total = int(np.count_nonzero(tumor))
+    tumor_points = {}
+    overlaps = {}
+    distances = {}
+    for tract_id, name in index.get_tracts(reference):
+        overlaps[name] = float((int(tract_counts[tract_id]) / total) * 100.)
+        distances[name] = -1.
+        tree = index.get_tract_tree(tract_id)
+        if tract_counts[tract_id] == 0 and tree is not None:
+            spacing = index.get_tract_spacing(tract_id)
+            if spacing not in tumor_points:
+                tumor_points[spacing] = cKDTree(get_surface_points(tumor, spacing))
+            distances[name] = float(compute_hd95(tumor_points[spacing], tree))
+    return overlaps, distances
+
+
+def get_surface_points(mask: np.ndarray, spacing: Tuple[float, ...], bbox: Tuple[slice, ...] = None) -> np.ndarray:
+    """
+    Coordinates, in millimeters, of the one-voxel border of a binary mask.
+    :param mask: Binary mask.
+    :param spacing: Voxel size of the mask.
+    :param bbox: Bounding box of the mask content, for only eroding the mask within (whole mask if None).
+    :return: Border voxels coordinates, as an array of shape (N, 3).
+    """
+    return get_surface_voxels(mask, bbox) * np.asarray(spacing[0:3], dtype=np.float64)
+
+
+def compute_hd95(points, reference_points) -> float:
+    """
+    95th percentile of the symmetric surface distances between two objects, from their border coordinates, the
+    nearest border voxel of the other object being searched through a KD-tree.
+    :param points: Border coordinates of the first object, as an array of shape (N, 3), or a KD-tree built over them.
+    :param reference_points: Border coordinates of the second object, or a KD-tree built over them.
+    :return: Distance in millimeters.
+    """
+    tree = points if isinstance(points, cKDTree) else cKDTree(points)
+    reference_tree = reference_points if isinstance(reference_points, cKDTree) else cKDTree(reference_points)
+    distances = np.hstack((reference_tree.query(tree.data)[0], tree.query(reference_tree.data)[0]))
+    return float(np.percentile(distances, 95))
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import numpy as np
+import nibabel as nib
+from typing import List, Tuple
+
+from .resources import SharedResources
+
+
+class MaskCache:
+    """
+    On-disk cache of annotation masks in compact form, avoiding to decompress the same NIfTI files every time they
+    are used for computing the heatmaps or the metrics.
+    Each mask is stored as the bounding-box crop of its non-zero content, bit-packed when binary, inside a .npy file
+    which can be memory-mapped, together with a .json file holding the original shape, the bounding box, the affine
+    and the voxel size. Entries are identified by the mask filepath, modification time and size, such that a modified
+    mask is transparently reloaded from disk. The least recently used entries are evicted above the size limit.
+    """
+    _cache_folder = None  # Folder where the compact masks are stored
+    _size_limit = None  # Maximum size on disk of the cache, in MB
+
+    def __init__(self, cache_folder: str = None, size_limit: float = None) -> None:
+        self.__reset()
+        self._cache_folder = cache_folder if cache_folder is not None else SharedResources.getInstance().mask_cache_folder
+        self._size_limit = size_limit if size_limit is not None else SharedResources.getInstance().mask_cache_size_limit
+        os.makedirs(self._cache_folder, exist_ok=True)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cache_folder = None
+        self._size_limit = None
+
+    @property
+    def cache_folder(self) -> str:
+        return self._cache_folder
+
+    @property
+    def size_limit(self) -> float:
+        return self._size_limit
+
+    def get_entry_key(self, filepath: str) -> str:
+        """
+        Identifier of the cache entry for the current content of the mask file.
+        :param filepath: Location on disk of the annotation mask.
+        :return: Hash of the absolute filepath, modification time, and size of the annotation mask.
+        """
+        stat = os.stat(filepath)
+        key = '{}|{}|{}'.format(os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def load(self, filepath: str) -> Tuple[np.ndarray, np.ndarray, Tuple[float, ...]]:
+        """
+        Loads an annotation mask through the cache, the NIfTI file being only read if no entry exists for its current
+        content.
+        :param filepath: Location on disk of the annotation mask.
+        :return: Annotation mask as uint8, affine matrix, and voxel size.
+        """
+        crop, offset, shape, affine, zooms = self.load_crop(filepath)
+        labels = np.zeros(shape, dtype='uint8')
+        labels[tuple([slice(o, o + s) for o, s in zip(offset, crop.shape)])] = crop
+        return labels, affine, zooms
+
+    def load_crop(self, filepath: str) -> Tuple[np.ndarray, Tuple[int, ...], Tuple[int, ...], np.ndarray,
+                                                Tuple[float, ...]]:
+        """
+        Loads the bounding-box crop of the non-zero content of an annotation mask through the cache, for consumers
+        only needing the foreground. The crop is memory-mapped from the cache when not bit-packed.
+        :param filepath: Location on disk of the annotation mask.
+        :return: Crop as uint8, position of the crop inside the mask, shape of the mask, affine matrix, and voxel size.
+        """
+        key = self.get_entry_key(filepath)
+        header_filename = os.path.join(self.cache_folder, key + '.json')
+        data_filename = os.path.join(self.cache_folder, key + '.npy')
+        if os.path.exists(header_filename) and os.path.exists(data_filename):
+            try:
+                with open(header_filename, 'r') as infile:
+                    header = json.load(infile)
+                data = np.load(data_filename, mmap_mode='r')
+                # Access time tracked on the header, for the eviction of the least recently used entries.
+                os.utime(header_filename)
+                # The NIfTI voxel sizes are stored as float32.
+                return (self.__unpack(data, header), tuple([b[0] for b in header["bbox"]]), tuple(header["shape"]),
+                        np.asarray(header["affine"]), tuple([np.float32(x) for x in header["zooms"]]))
+            except Exception as e:
+                logging.warning("Cached entry for {} could not be read, and is recomputed.".format(filepath))
+
+        labels_ni = nib.load(filepath)
+        labels = labels_ni.get_fdata()[:].astype('uint8')
+        affine = labels_ni.affine
+        zooms = labels_ni.header.get_zooms()
+        bbox = self.__store(key, labels, affine, zooms, filepath)
+        return (labels[tuple([slice(b[0], b[1]) for b in bbox])], tuple([b[0] for b in bbox]), labels.shape, affine,
+                zooms)
+
+    def warm(self, filepaths: List[str]) -> None:
+        """
+        Creates the cache entries for all given annotation masks, if not already existing.
+        :param filepaths: Locations on disk of the annotation masks.
+        :return: None
+        """
+        for fp in filepaths:
+            try:
+                key = self.get_entry_key(fp)
+                if not os.path.exists(os.path.join(self.cache_folder, key + '.json')):
+                    self.load(fp)
+            except Exception as e:
+                logging.warning("Annotation mask {} could not be cached.".format(fp))
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache is under its size limit.
+        :return: None
+        """
+        entries = []
+        total_size = 0
+        for fn in os.listdir(self.cache_folder):
+            if not fn.endswith('.json'):
+                continue
+            header_filename = os.path.join(self.cache_folder, fn)
+            data_filename = os.path.join(self.cache_folder, fn[:-5] + '.npy')
+            try:
+                size = os.path.getsize(header_filename)
+                if os.path.exists(data_filename):
+                    size += os.path.getsize(data_filename)
+                entries.append([os.path.getmtime(header_filename), size, header_filename, data_filename])
+                total_size += size
+            except OSError:
+                # Entry concurrently evicted by another process.
+                continue
+
+        for _, size, header_filename, data_filename in sorted(entries):
+            if total_size <= self.size_limit * 1e6:
+                break
+            for fn in [header_filename, data_filename]:
+                if os.path.exists(fn):
+                    os.remove(fn)
+            total_size -= size
+
+    def __store(self, key: str, labels: np.ndarray, affine: np.ndarray, zooms: Tuple[float, ...],
+                filepath: str) -> List[List[int]]:
+        """
+        Saves the compact version of an annotation mask. The files are first written under a temporary name, for the
+        cache to be safely shared between parallel processes.
+        :return: Bounding box of the non-zero content of the annotation mask.
+        """
+        nonzero = np.nonzero(labels)
+        if len(nonzero[0]) != 0:
+            bbox = [[int(x.min()), int(x.max()) + 1] for x in nonzero]
+        else:
+            bbox = [[0, 0] for _ in labels.shape]
+        crop = labels[tuple([slice(b[0], b[1]) for b in bbox])]
+        packed = bool(crop.size != 0 and crop.max() <= 1)
+        data = np.packbits(crop, axis=None) if packed else np.ascontiguousarray(crop)
+        header = {"filepath": os.path.abspath(filepath), "shape": list(labels.shape), "bbox": bbox,
+                  "crop_shape": list(crop.shape), "packed": packed, "affine": np.asarray(affine).tolist(),
+                  "zooms": [float(x) for x in zooms], "created": time.time()}
+
+        tmp_suffix = '.{}.tmp'.format(os.getpid())
+        data_filename = os.path.join(self.cache_folder, key + '.npy')
+        header_filename = os.path.join(self.cache_folder, key + '.json')
+        try:
+            with open(data_filename + tmp_suffix, 'wb') as outfile:
+                np.save(outfile, data)
+            os.replace(data_filename + tmp_suffix, data_filename)
+            with open(header_filename + tmp_suffix, 'w') as outfile:
+                json.dump(header, outfile)
+            os.replace(header_filename + tmp_suffix, header_filename)
+        except Exception as e:
+            logging.warning("Annotation mask {} could not be cached.".format(filepath))
+            for fn in [data_filename + tmp_suffix, header_filename + tmp_suffix]:
+                if os.path.exists(fn):
+                    os.remove(fn)
+        return bbox
+
+    def __unpack(self, data: np.ndarray, header: dict) -> np.ndarray:
+        """
+        Restores the crop of the annotation mask from its compact version.
+        """
+        crop_shape = tuple(header["crop_shape"])
+        if header["packed"]:
+            return np.unpackbits(data, count=int(np.prod(crop_shape))).reshape(crop_shape)
+        return data
+
+
+def load_mask_volume(filepath: str) -> Tuple[np.ndarray, np.ndarray, Tuple[float, ...]]:
+    """
+    Loads an annotation mask as uint8, going through the mask cache if enabled in the configuration.
+    :param filepath: Location on disk of the annotation mask.
+    :return: Annotation mask as uint8, affine matrix, and voxel size.
+    """
+    if SharedResources.getInstance().mask_cache:
+        return MaskCache().load(filepath)
+
+    labels_ni = nib.load(filepath)
+    return labels_ni.get_fdata()[:].astype('uint8'), labels_ni.affine, labels_ni.header.get_zooms()
+
+
+def warm_mask_cache(cohort) -> None:
+    """
+    Fills the mask cache with the registered annotation masks of every patient of the cohort, as used for the
+    heatmaps and metrics computation.
+    :param cohort: Container for all loaded patients.
+    :return: None
+    """
+    filepaths = []
+    for p in cohort.patients:
+        patient = cohort.patients[p]
+        candidates = [patient.registered_label_filepath,
+                      os.path.join(patient.output_folderpath,
+                                   "input_reg_mni_" + SharedResources.getInstance().maps_gt_files_suffix)]
+        for fp in candidates:
+            if fp is not None and os.path.exists(fp) and fp not in filepaths:
+                filepaths.append(fp)
+    logging.info("Warming the mask cache with {} annotation masks.".format(len(filepaths)))
+    MaskCache().warm(filepaths)
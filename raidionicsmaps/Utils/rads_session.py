@@ -0,0 +1,155 @@
+import os
+import copy
+import gzip
+import shutil
+import logging
+import traceback
+import configparser
+
+from .resources import SharedResources
+
+
+class RadsSession:
+    """
+    Singleton class reusing the raidionics_rads backend inside the current process, for running the per-patient
+    pipelines one after the other without setting up the backend from scratch every time.
+    The backend configuration (including the atlas resources it enumerates) is parsed once, and only reloaded if the
+    requested configuration differs apart from the patient-specific folders. The backend state obtained after the
+    configuration is restored before each job, such that no runtime value leaks from one patient to the next. The
+    compressed atlases are decompressed once on disk, and the backend pointed at them, sparing their decompression for
+    every patient. The segmentation models run by the pipelines (e.g., MRI_Brain) are still loaded for every job, as
+    raidionics_seg creates its inference session inside each model run.
+    If the session cannot be set up, or is disabled (default), each job falls back to a fresh run_rads call.
+    """
+    __instance = None
+    _signature = None  # Backend configuration currently loaded, without the patient-specific folders
+    _baseline = None  # Backend configuration state right after loading, restored before each job
+    _fallback = False  # Whether the jobs are handed over to run_rads, the session being unavailable
+    _jobs = 0  # Number of jobs run inside the session
+
+    @staticmethod
+    def getInstance():
+        """ Static access method. """
+        if RadsSession.__instance == None:
+            RadsSession()
+        return RadsSession.__instance
+
+    def __init__(self):
+        """ Virtually private constructor. """
+        if RadsSession.__instance != None:
+            raise Exception("This class is a singleton!")
+        else:
+            RadsSession.__instance = self
+            self.__reset()
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._signature = None
+        self._baseline = None
+        self._fallback = not SharedResources.getInstance().rads_session
+        self._jobs = 0
+
+    @property
+    def jobs(self) -> int:
+        return self._jobs
+
+    def run(self, config_filename: str) -> None:
+        """
+        Runs one raidionics_rads pipeline, as described by its runtime configuration file.
+        :param config_filename: Filepath to the *.ini file for raidionics_rads, pointing to the pipeline file and the
+        patient-specific input and output folders.
+        :return: None
+        """
+        if not self._fallback:
+            try:
+                self.__prepare(config_filename)
+            except Exception as e:
+                logging.warning("[RadsSession] Session could not be set up, falling back to individual runs, with: "
+                                "{}".format(traceback.format_exc()))
+                self._fallback = True
+
+        if self._fallback:
+            from raidionicsrads.compute import run_rads
+            run_rads(config_filename)
+            return
+
+        from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+        from raidionicsrads.Utils.DataStructures.PatientStructure import PatientParameters
+        from raidionicsrads.Pipelines.PipelineStructure import Pipeline
+
+        self._jobs = self._jobs + 1
+        pip = Pipeline(ResourcesConfiguration.getInstance().pipeline_filename)
+        patient_parameters = PatientParameters(id="Patient",
+                                               patient_filepath=ResourcesConfiguration.getInstance().input_folder)
+        try:
+            patient_parameters = pip.setup(patient_parameters=patient_parameters)
+            pip.execute(patient_parameters=patient_parameters)
+        finally:
+            pip.cleanup()
+
+    def __prepare(self, config_filename: str) -> None:
+        """
+        Loads the backend configuration if not already loaded, and otherwise resets the backend to its state right
+        after loading, with the patient-specific folders of the requested configuration.
+        """
+        from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+
+        rads_config = configparser.ConfigParser()
+        rads_config.read(config_filename)
+        folders = {}
+        for key in ['input_folder', 'output_folder', 'pipeline_filename']:
+            folders[key] = rads_config['System'][key]
+            rads_config.remove_option('System', key)
+        signature = {s: dict(rads_config[s]) for s in rads_config.sections()}
+
+        resources = ResourcesConfiguration.getInstance()
+        if signature != self._signature:
+            resources.set_environment(config_path=config_filename)
+            self.__warm_atlases(resources)
+            self._baseline = copy.deepcopy(resources.__dict__)
+            self._signature = signature
+            logging.info("[RadsSession] Backend configuration loaded.")
+        else:
+            resources.__dict__.clear()
+            resources.__dict__.update(copy.deepcopy(self._baseline))
+        for key in folders:
+            setattr(resources, key, folders[key])
+
+    def __warm_atlases(self, resources) -> None:
+        """
+        Points all the atlas filepaths of the backend configuration to decompressed copies, created on disk the first
+        time they are needed.
+        """
+        import raidionicsrads
+        atlas_root = os.path.join(os.path.dirname(os.path.realpath(raidionicsrads.__file__)), 'Atlases')
+        decompressed = 0
+
+        def warm(value):
+            nonlocal decompressed
+            if isinstance(value, dict):
+                return {k: warm(v) for k, v in value.items()}
+            if not isinstance(value, str) or not value.endswith('.nii.gz') or \
+                    not os.path.realpath(value).startswith(atlas_root) or not os.path.exists(value):
+                return value
+            relative = os.path.relpath(os.path.realpath(value), atlas_root)
+            dest = os.path.join(SharedResources.getInstance().rads_session_atlas_folder, raidionicsrads.__name__,
+                                relative[:-len('.gz')])
+            if not os.path.exists(dest) or os.path.getmtime(dest) < os.path.getmtime(value):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                tmp_filename = dest + '.{}.tmp'.format(os.getpid())
+                with gzip.open(value, 'rb') as infile, open(tmp_filename, 'wb') as outfile:
+                    shutil.copyfileobj(infile, outfile)
+                os.replace(tmp_filename, dest)
+                decompressed = decompressed + 1
+            return dest
+
+        for key in list(resources.__dict__.keys()):
+            if key == 'config':
+                continue
+            resources.__dict__[key] = warm(resources.__dict__[key])
+        if decompressed != 0:
+            logging.info("[RadsSession] {} atlases decompressed in {}.".format(
+                decompressed, SharedResources.getInstance().rads_session_atlas_folder))
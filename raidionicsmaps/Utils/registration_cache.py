@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from typing import List, Union
+
+from .resources import SharedResources
+from .io import compute_file_fingerprint
+from .staging import stage_file
+
+
+class RegistrationCache:
+    """
+    On-disk cache of registrations to the atlas space, shared across runs and output folders, such that the same scan
+    is never registered twice.
+    Entries are identified by the content hashes of the moving volume, brain mask and atlas, together with the
+    registration settings (e.g., sequence type and ANTs backend). Each entry folder holds the forward and inverse
+    transforms, in the order expected by ANTs, alongside the warped volume and the warped annotation masks, the latter
+    being identified by their own content hash. The least recently used entries are evicted above the size limit.
+    """
+    _cache_folder = None  # Folder where the registration entries are stored
+    _size_limit = None  # Maximum size on disk of the cache, in MB
+    _fingerprints = None  # Content hashes of the already hashed files, indexed by absolute filepath
+
+    def __init__(self, cache_folder: str = None, size_limit: float = None) -> None:
+        self.__reset()
+        self._cache_folder = cache_folder if cache_folder is not None else SharedResources.getInstance().registration_cache_folder
+        self._size_limit = size_limit if size_limit is not None else SharedResources.getInstance().registration_cache_size_limit
+        os.makedirs(self._cache_folder, exist_ok=True)
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._cache_folder = None
+        self._size_limit = None
+        self._fingerprints = None
+
+    @property
+    def cache_folder(self) -> str:
+        return self._cache_folder
+
+    @property
+    def size_limit(self) -> float:
+        return self._size_limit
+
+    def get_file_hash(self, filepath: str) -> str:
+        """
+        Content hash of a file, only recomputed if the file was modified since it was last hashed.
+        :param filepath: Location on disk of the file.
+        :return: SHA1 of the file content.
+        """
+        index_filename = os.path.join(self.cache_folder, 'fingerprints.json')
+        if self._fingerprints is None:
+            self._fingerprints = {}
+            if os.path.exists(index_filename):
+                try:
+                    with open(index_filename, 'r') as infile:
+                        self._fingerprints = json.load(infile)
+                except Exception as e:
+                    logging.warning("The registration cache fingerprints could not be read, and are recomputed.")
+
+        path = os.path.abspath(filepath)
+        previous = self._fingerprints.get(path)
+        fingerprint = compute_file_fingerprint(path, previous=previous)
+        if previous != fingerprint:
+            self._fingerprints[path] = fingerprint
+            tmp_filename = index_filename + '.{}.tmp'.format(os.getpid())
+            try:
+                with open(tmp_filename, 'w') as outfile:
+                    json.dump(self._fingerprints, outfile)
+                os.replace(tmp_filename, index_filename)
+            except Exception as e:
+                logging.warning("The registration cache fingerprints could not be saved.")
+        return fingerprint["sha1"]
+
+    def get_entry_key(self, moving: str, fixed: str, settings: dict, mask: str = None) -> str:
+        """
+        Identifier of the cache entry for the registration of the moving volume onto the fixed volume.
+        :param moving: Location on disk of the volume to register.
+        :param fixed: Location on disk of the volume to register to (i.e., the atlas).
+        :param settings: Registration settings influencing the computed transforms.
+        :param mask: Location on disk of the brain mask of the moving volume, if any.
+        :return: Hash of the content of all inputs and of the settings.
+        """
+        description = {"moving": self.get_file_hash(moving), "fixed": self.get_file_hash(fixed),
+                       "mask": self.get_file_hash(mask) if mask is not None else None, "settings": settings}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(self, key: str) -> Union[None, dict]:
+        """
+        Collects the transforms stored for a registration.
+        :param key: Identifier of the cache entry.
+        :return: Forward and inverse transforms filepaths, in their original order, or None if not cached.
+        """
+        entry_folder = os.path.join(self.cache_folder, key)
+        header_filename = os.path.join(entry_folder, 'entry.json')
+        if not os.path.exists(header_filename):
+            return None
+        try:
+            with open(header_filename, 'r') as infile:
+                header = json.load(infile)
+            # Access time tracked on the header, for the eviction of the least recently used entries.
+            os.utime(header_filename)
+            return {"forward": [os.path.join(entry_folder, 'forward', x) for x in header["forward"]],
+                    "inverse": [os.path.join(entry_folder, 'inverse', x) for x in header["inverse"]]}
+        except Exception as e:
+            logging.warning("Cached registration {} could not be read.".format(key))
+            return None
+
+    def store_transforms(self, key: str, forward: List[str], inverse: List[str], description: dict = None) -> None:
+        """
+        Saves the transforms of a registration. The entry is first assembled under a temporary name, for the cache to
+        be safely shared between parallel processes.
+        :param key: Identifier of the cache entry.
+        :param forward: Forward transforms filepaths, in the order expected by ANTs.
+        :param inverse: Inverse transforms filepaths, in the order expected by ANTs.
+        :param description: Additional information saved with the entry, for inspection.
+        :return: None
+        """
+        entry_folder = os.path.join(self.cache_folder, key)
+        if os.path.exists(entry_folder):
+            return
+        tmp_folder = entry_folder + '.{}.tmp'.format(os.getpid())
+        try:
+            for kind, filepaths in [["forward", forward], ["inverse", inverse]]:
+                os.makedirs(os.path.join(tmp_folder, kind), exist_ok=True)
+                for fp in filepaths:
+                    stage_file(fp, os.path.join(tmp_folder, kind, os.path.basename(fp)), allow_symlink=False)
+            header = {"forward": [os.path.basename(x) for x in forward],
+                      "inverse": [os.path.basename(x) for x in inverse], "created": time.time(),
+                      "description": description if description is not None else {}}
+            with open(os.path.join(tmp_folder, 'entry.json'), 'w') as outfile:
+                json.dump(header, outfile, indent=4)
+            os.rename(tmp_folder, entry_folder)
+        except Exception as e:
+            # Including the case where the same entry was concurrently stored by another process.
+            if not os.path.exists(entry_folder):
+                logging.warning("Registration {} could not be cached.".format(key))
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    def restore_warped(self, key: str, name: str, destination: str) -> bool:
+        """
+        Copies a cached warped image to its destination.
+        :param key: Identifier of the cache entry.
+        :param name: Identifier of the warped image inside the entry (e.g., volume).
+        :param destination: Filepath where the warped image should be copied.
+        :return: True if the warped image was found in the cache, False otherwise.
+        """
+        filename = os.path.join(self.cache_folder, key, name + '.nii.gz')
+        if not os.path.exists(filename):
+            return False
+        try:
+            shutil.copyfile(filename, destination)
+            return True
+        except Exception as e:
+            logging.warning("Cached warped image {} could not be restored.".format(filename))
+            return False
+
+    def store_warped(self, key: str, name: str, filepath: str) -> None:
+        """
+        Saves a warped image inside an existing cache entry.
+        :param key: Identifier of the cache entry.
+        :param name: Identifier of the warped image inside the entry (e.g., volume).
+        :param filepath: Location on disk of the warped image.
+        :return: None
+        """
+        entry_folder = os.path.join(self.cache_folder, key)
+        if not os.path.exists(entry_folder):
+            return
+        filename = os.path.join(entry_folder, name + '.nii.gz')
+        tmp_filename = filename + '.{}.tmp'.format(os.getpid())
+        try:
+            shutil.copyfile(filepath, tmp_filename)
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            logging.warning("Warped image {} could not be cached.".format(filepath))
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache is under its size limit.
+        :return: None
+        """
+        entries = []
+        total_size = 0
+        for d in os.listdir(self.cache_folder):
+            entry_folder = os.path.join(self.cache_folder, d)
+            header_filename = os.path.join(entry_folder, 'entry.json')
+            if not os.path.isdir(entry_folder) or not os.path.exists(header_filename):
+                continue
+            try:
+                size = 0
+                for root, _, files in os.walk(entry_folder):
+                    size += sum([os.path.getsize(os.path.join(root, f)) for f in files])
+                entries.append([os.path.getmtime(header_filename), size, entry_folder])
+                total_size += size
+            except OSError:
+                # Entry concurrently evicted by another process.
+                continue
+
+        for _, size, entry_folder in sorted(entries):
+            if total_size <= self.size_limit * 1e6:
+                break
+            shutil.rmtree(entry_folder, ignore_errors=True)
+            total_size -= size
+
+
+def get_registration_settings() -> dict:
+    """
+    Registration settings influencing the computed transforms, used to identify the registration cache entries.
+    :return: Dictionary of settings.
+    """
+    return {"sequence_type": SharedResources.getInstance().maps_sequence_type,
+            "ants_backend": SharedResources.getInstance().system_ants_backend,
+            "method": SharedResources.getInstance().maps_registration_preset
+            if SharedResources.getInstance().maps_registration_preset is not None else "SyN"}
@@ -2,6 +2,7 @@ import os
 import sys
 import logging
 import configparser
+from typing import Tuple
 from pathlib import PurePath
 
 logger = logging.getLogger(__name__)
@@ -42,6 +43,21 @@ class SharedResources:
         self.ants_root = None
         self.ants_reg_dir = None
         self.ants_apply_dir = None
+        self.mask_cache = False
+        self.mask_cache_folder = os.path.join(os.path.expanduser('~'), '.raidionics', 'cache', 'masks')
+        self.mask_cache_size_limit = 2048
+        self.registration_cache = False
+        self.registration_cache_folder = os.path.join(os.path.expanduser('~'), '.raidionics', 'cache', 'registrations')
+        self.registration_cache_size_limit = 20480
+        self.preflight = False
+        self.preflight_fail_fast = False
+        self.system_threads_per_job = None
+        self.system_max_concurrent_jobs = None
+        self.system_job_threads = None
+        self.system_staging_strategy = 'auto'
+        self.system_ants_timeout = None
+        self.rads_session = False
+        self.rads_session_atlas_folder = os.path.join(os.path.expanduser('~'), '.raidionics', 'cache', 'atlases')
 
         self.maps_input_folder = ''
         self.maps_output_folder = ''
@@ -51,12 +67,25 @@ class SharedResources:
         self.maps_distribution_dense_parameters = []
         self.maps_distribution_categorical_parameters = []
         self.maps_sequence_type = None
+        self.maps_workers = 1
+        self.maps_low_memory = False
+        self.maps_incremental = False
+        self.maps_slab_thickness = None
+        self.maps_registration_workers = 1
+        self.maps_registration_composite_warp = False
+        self.maps_registration_preset = None
+        self.maps_brain_segmentation_prestage = False
+        self.maps_brain_segmentation_batch_size = 4
+        self.maps_warp_back_sources = []
+        self.maps_warp_back_workers = 1
 
         self.metrics_tumor_size = False
         self.metrics_multifocality = False
         self.metrics_brain_location = False
         self.metrics_cortical_features_location = []
         self.metrics_subcortical_features_location = []
+        self.metrics_workers = 1
+        self.metrics_location_engine = 'rads'
 
     def set_environment(self, config_filename):
         self.config = configparser.ConfigParser()
@@ -75,11 +104,75 @@ class SharedResources:
         self.__set_neuro_atlases_parameters()
         self.__set_ants_parameters()
 
+    def get_available_cores(self) -> int:
+        """
+        Number of cores the current process is allowed to run on (e.g., restricted by a job scheduler).
+        """
+        if hasattr(os, 'sched_getaffinity'):
+            return len(os.sched_getaffinity(0))
+        return os.cpu_count() or 1
+
+    def get_jobs_budget(self, workers: int = 1) -> Tuple[int, int]:
+        """
+        Splits the available cores between the jobs to run concurrently, according to the threads_per_job and
+        max_concurrent_jobs parameters.
+        :param workers: Number of parallel workers requested for the current stage.
+        :return: Number of jobs to actually run concurrently, and number of threads for each job.
+        """
+        cores = self.get_available_cores()
+        jobs = max(1, workers)
+        if self.system_max_concurrent_jobs is not None:
+            jobs = min(jobs, max(1, self.system_max_concurrent_jobs))
+        if self.system_threads_per_job is not None:
+            threads = max(1, self.system_threads_per_job)
+            jobs = min(jobs, max(1, cores // threads))
+        else:
+            threads = max(1, cores // jobs)
+        return jobs, threads
+
+    def set_job_threads(self, threads: int) -> None:
+        """
+        Constrains the number of threads used by ITK (python ANTs backend), the ANTs executables, and the OpenMP/BLAS
+        numerical libraries, for the current process and the processes it launches.
+        The environment variables are only picked up by libraries not yet loaded, threadpoolctl being used, if
+        installed, to also constrain the already loaded BLAS/OpenMP libraries.
+        :param threads: Number of threads for the current job.
+        :return: None
+        """
+        self.system_job_threads = threads
+        for var in ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                    'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+            os.environ[var] = str(threads)
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=threads)
+        except ImportError:
+            pass
+
     def __parse_default_parameters(self):
         """
         Parse the user-selected configuration parameters linked to the overall behaviour.
         :param: task: (str) identifier for the task to perform, for now validation or study
         :param: number_processes: (int) number of parallel processes to use to perform the different task
+        :param: mask_cache: (bool) to read the annotation masks through an on-disk cache of compact masks
+        :param: mask_cache_folder: (str) folder where the compact masks are stored
+        :param: mask_cache_size_limit: (float) maximum size of the mask cache on disk, in MB
+        :param: registration_cache: (bool) to reuse the registrations already computed for identical inputs and settings
+        :param: registration_cache_folder: (str) folder where the registration transforms and warped images are stored
+        :param: registration_cache_size_limit: (float) maximum size of the registration cache on disk, in MB
+        :param: preflight: (bool) to check the headers of the atlas and of all the cohort files before the computation
+        :param: preflight_fail_fast: (bool) to stop the computation if the preflight check finds unusable patients
+        :param: threads_per_job: (int) number of threads used by each job running in parallel (e.g., one patient
+        registration), the available cores being split between the concurrent jobs if empty
+        :param: max_concurrent_jobs: (int) maximum number of jobs running in parallel, capping the number of workers
+        :param: staging_strategy: (str) how the files are staged into the processing folders, to sample from [auto,
+        hardlink, symlink, reflink, copy]
+        :param: rads_session: (bool) to run the raidionics_rads pipelines inside a session reused across patients, where
+        the backend configuration is parsed once and the atlases are decompressed once on disk, instead of through a
+        fresh run for each patient. The segmentation models are still loaded for every patient. False by default
+        :param: rads_session_atlas_folder: (str) folder where the session stores the decompressed atlases
+        :param: ants_timeout: (float) maximum duration, in seconds, of each call to the C++ ANTs executables, after
+        which the call is stopped and fails. Unbounded if empty
         :return:
         """
         if self.config.has_option('Default', 'task'):
@@ -94,6 +187,62 @@ class SharedResources:
             if self.config['Default']['output_folder'].split('#')[0].strip() != '':
                 self.maps_output_folder = self.config['Default']['output_folder'].split('#')[0].strip()
 
+        if self.config.has_option('Default', 'mask_cache'):
+            if self.config['Default']['mask_cache'].split('#')[0].strip() != '':
+                self.mask_cache = True if self.config['Default']['mask_cache'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Default', 'mask_cache_folder'):
+            if self.config['Default']['mask_cache_folder'].split('#')[0].strip() != '':
+                self.mask_cache_folder = self.config['Default']['mask_cache_folder'].split('#')[0].strip()
+
+        if self.config.has_option('Default', 'mask_cache_size_limit'):
+            if self.config['Default']['mask_cache_size_limit'].split('#')[0].strip() != '':
+                self.mask_cache_size_limit = float(self.config['Default']['mask_cache_size_limit'].split('#')[0].strip())
+
+        if self.config.has_option('Default', 'registration_cache'):
+            if self.config['Default']['registration_cache'].split('#')[0].strip() != '':
+                self.registration_cache = True if self.config['Default']['registration_cache'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Default', 'registration_cache_folder'):
+            if self.config['Default']['registration_cache_folder'].split('#')[0].strip() != '':
+                self.registration_cache_folder = self.config['Default']['registration_cache_folder'].split('#')[0].strip()
+
+        if self.config.has_option('Default', 'registration_cache_size_limit'):
+            if self.config['Default']['registration_cache_size_limit'].split('#')[0].strip() != '':
+                self.registration_cache_size_limit = float(self.config['Default']['registration_cache_size_limit'].split('#')[0].strip())
+
+        if self.config.has_option('Default', 'preflight'):
+            if self.config['Default']['preflight'].split('#')[0].strip() != '':
+                self.preflight = True if self.config['Default']['preflight'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Default', 'preflight_fail_fast'):
+            if self.config['Default']['preflight_fail_fast'].split('#')[0].strip() != '':
+                self.preflight_fail_fast = True if self.config['Default']['preflight_fail_fast'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Default', 'threads_per_job'):
+            if self.config['Default']['threads_per_job'].split('#')[0].strip() != '':
+                self.system_threads_per_job = int(self.config['Default']['threads_per_job'].split('#')[0].strip())
+
+        if self.config.has_option('Default', 'max_concurrent_jobs'):
+            if self.config['Default']['max_concurrent_jobs'].split('#')[0].strip() != '':
+                self.system_max_concurrent_jobs = int(self.config['Default']['max_concurrent_jobs'].split('#')[0].strip())
+
+        if self.config.has_option('Default', 'staging_strategy'):
+            if self.config['Default']['staging_strategy'].split('#')[0].strip() != '':
+                self.system_staging_strategy = self.config['Default']['staging_strategy'].split('#')[0].strip().lower()
+
+        if self.config.has_option('Default', 'rads_session'):
+            if self.config['Default']['rads_session'].split('#')[0].strip() != '':
+                self.rads_session = True if self.config['Default']['rads_session'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Default', 'rads_session_atlas_folder'):
+            if self.config['Default']['rads_session_atlas_folder'].split('#')[0].strip() != '':
+                self.rads_session_atlas_folder = self.config['Default']['rads_session_atlas_folder'].split('#')[0].strip()
+
+        if self.config.has_option('Default', 'ants_timeout'):
+            if self.config['Default']['ants_timeout'].split('#')[0].strip() != '':
+                self.system_ants_timeout = float(self.config['Default']['ants_timeout'].split('#')[0].strip())
+
     def __parse_maps_parameters(self) -> None:
         """
         Parse the user-selected configuration parameters linked to the location maps creation process.
@@ -104,6 +253,30 @@ class SharedResources:
         :param: distribution_dense_parameters
         :param: distribution_categorical_parameters
         :param: sequence_type
+        :param: workers: (int) number of parallel processes to use for loading the annotation masks during the heatmaps
+        computation.
+        :param: low_memory: (bool) to accumulate the heatmaps into integer counters sized to the cohort, and to read the
+        annotation masks in their native dtype, for a reduced memory footprint.
+        :param: incremental: (bool) to persist the heatmaps accumulators, and only process the new, changed, or removed
+        patients when computing the heatmaps again for the same cohort.
+        :param: slab_thickness: (int) number of atlas slices, along the last axis, for streaming the heatmaps computation
+        slab after slab, with a memory footprint bounded by the slab size. The full atlas is processed at once if empty.
+        :param: registration_workers: (int) number of parallel processes to use for registering the patients to the
+        atlas space, each with its own scratch folder.
+        :param: registration_composite_warp: (bool) to collapse the registration transforms into a single displacement
+        field for each direction, built once per patient and reused for every following warp.
+        :param: registration_preset: (str) registration speed/accuracy preset, to sample from [rigid, affine, syn-quick,
+        syn-lowres, syn-full]. The registration is then directly performed with ANTs, instead of through the
+        raidionics_rads pipeline.
+        :param: brain_segmentation_prestage: (bool) to segment the brain of all patients without a brain mask in a
+        cohort-level pass before the registration, instead of inside the registration pipeline of each patient, with the
+        same runtime options (False by default).
+        :param: brain_segmentation_batch_size: (int) number of patients segmented together during the cohort-level pass,
+        bounding its memory footprint.
+        :param: warp_back_sources: (list) atlas-space images (e.g., heatmaps, atlas regions) to project into the native
+        space of every registered patient, as a comma-separated list of filepaths.
+        :param: warp_back_workers: (int) number of parallel processes to use for projecting the images into the native
+        space of the patients.
         :return: None
         """
         if self.config.has_option('Maps', 'gt_files_suffix'):
@@ -130,6 +303,50 @@ class SharedResources:
             if self.config['Maps']['sequence_type'].split('#')[0].strip() != '':
                 self.maps_sequence_type = self.config['Maps']['sequence_type'].split('#')[0].strip()
 
+        if self.config.has_option('Maps', 'workers'):
+            if self.config['Maps']['workers'].split('#')[0].strip() != '':
+                self.maps_workers = int(self.config['Maps']['workers'].split('#')[0].strip())
+
+        if self.config.has_option('Maps', 'low_memory'):
+            if self.config['Maps']['low_memory'].split('#')[0].strip() != '':
+                self.maps_low_memory = True if self.config['Maps']['low_memory'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Maps', 'incremental'):
+            if self.config['Maps']['incremental'].split('#')[0].strip() != '':
+                self.maps_incremental = True if self.config['Maps']['incremental'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Maps', 'slab_thickness'):
+            if self.config['Maps']['slab_thickness'].split('#')[0].strip() != '':
+                self.maps_slab_thickness = int(self.config['Maps']['slab_thickness'].split('#')[0].strip())
+
+        if self.config.has_option('Maps', 'registration_workers'):
+            if self.config['Maps']['registration_workers'].split('#')[0].strip() != '':
+                self.maps_registration_workers = int(self.config['Maps']['registration_workers'].split('#')[0].strip())
+
+        if self.config.has_option('Maps', 'registration_composite_warp'):
+            if self.config['Maps']['registration_composite_warp'].split('#')[0].strip() != '':
+                self.maps_registration_composite_warp = True if self.config['Maps']['registration_composite_warp'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Maps', 'registration_preset'):
+            if self.config['Maps']['registration_preset'].split('#')[0].strip() != '':
+                self.maps_registration_preset = self.config['Maps']['registration_preset'].split('#')[0].strip().lower()
+
+        if self.config.has_option('Maps', 'brain_segmentation_prestage'):
+            if self.config['Maps']['brain_segmentation_prestage'].split('#')[0].strip() != '':
+                self.maps_brain_segmentation_prestage = True if self.config['Maps']['brain_segmentation_prestage'].split('#')[0].strip().lower() == 'true' else False
+
+        if self.config.has_option('Maps', 'brain_segmentation_batch_size'):
+            if self.config['Maps']['brain_segmentation_batch_size'].split('#')[0].strip() != '':
+                self.maps_brain_segmentation_batch_size = max(1, int(self.config['Maps']['brain_segmentation_batch_size'].split('#')[0].strip()))
+
+        if self.config.has_option('Maps', 'warp_back_sources'):
+            if self.config['Maps']['warp_back_sources'].split('#')[0].strip() != '':
+                self.maps_warp_back_sources = [x.strip() for x in self.config['Maps']['warp_back_sources'].split('#')[0].strip().split(',') if x.strip() != '']
+
+        if self.config.has_option('Maps', 'warp_back_workers'):
+            if self.config['Maps']['warp_back_workers'].split('#')[0].strip() != '':
+                self.maps_warp_back_workers = int(self.config['Maps']['warp_back_workers'].split('#')[0].strip())
+
     def __parse_metrics_parameters(self):
         """
         Parse the user-selected configuration parameters linked to the metrics computation
@@ -138,6 +355,10 @@ class SharedResources:
         :param: metrics_brain_location
         :param: metrics_cortical_features_location
         :param: metrics_subcortical_features_location
+        :param: workers: (int) number of parallel processes to use for computing the metrics of the patients, each with
+        its own scratch folder.
+        :param: location_engine: (str) engine computing the location metrics, to sample from [native, rads] (rads by
+        default). The native engine reports one focus, instead of failing, when no focus reaches 0.1 ml.
         """
         if self.config.has_option('Metrics', 'tumor_size'):
             if self.config['Metrics']['tumor_size'].split('#')[0].strip() != '':
@@ -159,6 +380,14 @@ class SharedResources:
             if self.config['Metrics']['subcortical_features_location'].split('#')[0].strip() != '':
                 self.metrics_subcortical_features_location = [x.strip() for x in self.config['Metrics']['subcortical_features_location'].split('#')[0].strip().split(',')]
 
+        if self.config.has_option('Metrics', 'workers'):
+            if self.config['Metrics']['workers'].split('#')[0].strip() != '':
+                self.metrics_workers = int(self.config['Metrics']['workers'].split('#')[0].strip())
+
+        if self.config.has_option('Metrics', 'location_engine'):
+            if self.config['Metrics']['location_engine'].split('#')[0].strip() != '':
+                self.metrics_location_engine = self.config['Metrics']['location_engine'].split('#')[0].strip().lower()
+
     def __set_neuro_atlases_parameters(self):
         self.mni_atlas_filepath_T1 = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
                                                   'Atlases/mni_icbm152_nlin_sym_09a/mni_icbm152_t1_tal_nlin_sym_09a.nii')
@@ -0,0 +1,96 @@
+import os
+import errno
+import shutil
+import logging
+from .resources import SharedResources
+
+STAGING_STRATEGIES = ['hardlink', 'symlink', 'reflink', 'copy']
+
+# Strategy retained for each pair of source and destination filesystems, such that the failing strategies are not
+# attempted again for every staged file.
+_staging_record = {}
+
+
+def get_staging_record() -> dict:
+    """
+    Staging strategy chosen so far for each pair of (source, destination) filesystem device identifiers.
+    """
+    return dict(_staging_record)
+
+
+def reflink_file(src: str, dst: str) -> None:
+    """
+    Copy-on-write clone of a file, sharing the data blocks of the source until either file is modified. Only
+    supported on Linux, for filesystems such as Btrfs or XFS, an OSError being raised otherwise.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform.")
+    ficlone = 0x40049409  # FICLONE ioctl request, from linux/fs.h
+    with open(src, 'rb') as infile, open(dst, 'wb') as outfile:
+        try:
+            fcntl.ioctl(outfile.fileno(), ficlone, infile.fileno())
+        except OSError:
+            outfile.close()
+            os.remove(dst)
+            raise
+
+
+def stage_file(src: str, dst: str, allow_symlink: bool = True) -> str:
+    """
+    Makes a file available at a new location inside a processing folder, without duplicating its content whenever
+    possible: hardlinked when both locations are on the same filesystem, symlinked when allowed, and otherwise
+    reflinked or copied. The staged file must be treated as read-only, since it can share its content with the source.
+    :param src: Location on disk of the file to stage.
+    :param dst: Location on disk where the file should be staged, replaced if already existing.
+    :param allow_symlink: Whether the source is guaranteed to outlive the staged file (e.g., not a temporary file),
+    for the staged file to be a symbolic link.
+    :return: Strategy used for staging the file, from STAGING_STRATEGIES.
+    """
+    strategy = SharedResources.getInstance().system_staging_strategy
+    if strategy == 'auto':
+        candidates = ['hardlink', 'symlink', 'reflink', 'copy']
+    elif strategy in STAGING_STRATEGIES:
+        candidates = [strategy, 'copy'] if strategy != 'copy' else ['copy']
+    else:
+        raise ValueError("Staging strategy {} not supported, to sample from [auto, {}].".format(
+            strategy, ', '.join(STAGING_STRATEGIES)))
+    if not allow_symlink and 'symlink' in candidates:
+        # The source may not outlive the staged file (e.g., temporary or cached file), leaving a dangling link.
+        candidates.remove('symlink')
+
+    src = os.path.abspath(src)
+    dst = os.path.abspath(dst)
+    if src == dst:
+        return 'none'
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    record_key = devices + (allow_symlink,)
+    if record_key in _staging_record and _staging_record[record_key] in candidates:
+        # Skipping the strategies which already failed between these filesystems.
+        candidates = candidates[candidates.index(_staging_record[record_key]):]
+    elif devices[0] != devices[1] and 'hardlink' in candidates and len(candidates) > 1:
+        candidates.remove('hardlink')
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for candidate in candidates:
+        try:
+            if candidate == 'hardlink':
+                os.link(src, dst)
+            elif candidate == 'symlink':
+                os.symlink(src, dst)
+            elif candidate == 'reflink':
+                reflink_file(src, dst)
+            else:
+                shutil.copyfile(src, dst)
+        except OSError as e:
+            if candidate == 'copy':
+                raise
+            logging.debug("Staging with {} failed for {} with: {}".format(candidate, src, e))
+            continue
+        if _staging_record.get(record_key) != candidate:
+            _staging_record[record_key] = candidate
+            logging.info("Staging files from device {} to device {} with strategy: {}.".format(devices[0], devices[1],
+                                                                                               candidate))
+        return candidate
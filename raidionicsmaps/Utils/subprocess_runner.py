@@ -0,0 +1,243 @@
+import os
+import csv
+import time
+import signal
+import logging
+import platform
+import threading
+import subprocess
+from typing import List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, Future
+
+# Serializes the writes to the timings files, shared by all the runners of the process.
+_records_lock = threading.Lock()
+
+SUBPROCESS_RECORDS_FILENAME = 'subprocess_jobs.csv'
+SUBPROCESS_RECORDS_COLUMNS = ['Job', 'Status', 'Exit code', 'Wall time (s)', 'CPU user (s)', 'CPU system (s)', 'Log',
+                              'Command']
+
+
+class SubprocessRunner:
+    """
+    Runs external executables (e.g., the ANTs registration scripts and antsApplyTransforms) from a pool of threads,
+    with at most a given number of jobs running concurrently.
+    The output and error streams of each job are streamed to its own log file, never through a pipe which could fill
+    up. Each job is given a timeout, after which its whole process group is terminated, and killed if still alive
+    after a grace period. A job exiting with a non-zero code raises a ValueError, pointing to its log file.
+    The wall and CPU times of each job are appended to subprocess_jobs.csv inside the log folder.
+    """
+    _workers = 1  # Number of jobs running concurrently
+    _timeout = None  # Maximum duration of each job, in seconds, unbounded if None
+    _log_folder = None  # Folder where the log files and the timings of the jobs are saved
+    _executor = None  # Thread pool running the jobs, created on first use
+    _grace_period = 10.  # Seconds left to a terminated job before killing it
+
+    def __init__(self, log_folder: str, workers: int = 1, timeout: float = None):
+        """
+        :param log_folder: Folder where the log files and the timings of the jobs are saved (e.g., the patient output
+        folder).
+        :param workers: Number of jobs running concurrently.
+        :param timeout: Maximum duration of each job, in seconds, unbounded if None.
+        """
+        self.__reset()
+        self._log_folder = log_folder
+        self._workers = max(1, workers)
+        self._timeout = timeout
+
+    def __reset(self) -> None:
+        """
+        All objects share class or static variables.
+        An instance or non-static variables are different for different objects (every object has a copy).
+        """
+        self._workers = 1
+        self._timeout = None
+        self._log_folder = None
+        self._executor = None
+        self._grace_period = 10.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def timeout(self) -> Union[None, float]:
+        return self._timeout
+
+    @property
+    def log_folder(self) -> str:
+        return self._log_folder
+
+    def submit(self, args: List[str], name: str, env: dict = None) -> Future:
+        """
+        Schedules a job, started as soon as one of the workers is available.
+        :param args: Executable and its arguments.
+        :param name: Identifier of the job, naming its log file.
+        :param env: Additional environment variables for the job (e.g., its number of threads).
+        :return: Future holding the record of the job once completed, or the error it raised.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor.submit(self.run, args, name, env)
+
+    def run_all(self, jobs: List[Tuple[List[str], str]], env: dict = None) -> List[dict]:
+        """
+        Runs several jobs concurrently, and waits for all of them to complete.
+        :param jobs: Arguments and identifier of each job.
+        :param env: Additional environment variables for all jobs.
+        :return: Record of each job, in the same order as the jobs. The first error raised by a job is raised again,
+        once all jobs are completed.
+        """
+        futures = [self.submit(args, name, env) for args, name in jobs]
+        records = []
+        error = None
+        for f in futures:
+            try:
+                records.append(f.result())
+            except Exception as e:
+                records.append(None)
+                error = e if error is None else error
+        if error is not None:
+            raise error
+        return records
+
+    def run(self, args: List[str], name: str, env: dict = None) -> dict:
+        """
+        Runs one job inside the calling thread.
+        :param args: Executable and its arguments.
+        :param name: Identifier of the job, naming its log file.
+        :param env: Additional environment variables for the job.
+        :return: Record of the job, with its exit code, wall and CPU times, and log filepath.
+        """
+        log_folder = os.path.join(self.log_folder, 'logs')
+        os.makedirs(log_folder, exist_ok=True)
+        log_filename = os.path.join(log_folder, name + '.log')
+        job_env = None
+        if env is not None:
+            job_env = dict(os.environ)
+            job_env.update({k: str(v) for k, v in env.items()})
+
+        record = {"Job": name, "Status": "failed", "Exit code": None, "Wall time (s)": None, "CPU user (s)": None,
+                  "CPU system (s)": None, "Log": log_filename, "Command": ' '.join([str(x) for x in args])}
+        start = time.perf_counter()
+        try:
+            with open(log_filename, 'w') as logfile:
+                logfile.write(record["Command"] + '\n')
+                logfile.flush()
+                popen = subprocess.Popen([str(x) for x in args], stdout=logfile, stderr=subprocess.STDOUT, env=job_env,
+                                         shell=platform.system() == 'Windows',
+                                         start_new_session=platform.system() != 'Windows')
+                try:
+                    returncode, usage = self.__wait(popen, self.timeout)
+                    if returncode is None:
+                        record["Status"] = "timeout"
+                        returncode, usage = self.__stop(popen)
+                except BaseException:
+                    # Including KeyboardInterrupt, for no job to outlive the computation.
+                    self.__stop(popen)
+                    raise
+            record["Exit code"] = returncode
+            if usage is not None:
+                record["CPU user (s)"] = round(usage.ru_utime, 3)
+                record["CPU system (s)"] = round(usage.ru_stime, 3)
+            if record["Status"] != "timeout":
+                record["Status"] = "done" if returncode == 0 else "failed"
+        finally:
+            record["Wall time (s)"] = round(time.perf_counter() - start, 3)
+            self.__save_record(record)
+
+        if record["Status"] == "timeout":
+            raise ValueError("Job {} stopped after exceeding its timeout of {} seconds, see {}.".format(
+                name, self.timeout, log_filename))
+        if record["Status"] != "done":
+            raise ValueError("Job {} exited with code {}, see {}:\n{}".format(name, record["Exit code"], log_filename,
+                                                                            read_log_tail(log_filename)))
+        logging.debug("Job {} completed in {} seconds.".format(name, record["Wall time (s)"]))
+        return record
+
+    def shutdown(self) -> None:
+        """
+        Waits for the scheduled jobs to complete, and releases the workers.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __wait(self, popen: subprocess.Popen, timeout: Union[None, float]) -> Tuple[Union[None, int], object]:
+        """
+        Waits for the job to exit, collecting its resource usage (including its own terminated children, e.g., the
+        executables launched by an ANTs script) where supported.
+        :return: Exit code of the job and its resource usage, or None and None if the timeout expired first.
+        """
+        if not hasattr(os, 'wait4'):
+            try:
+                return popen.wait(timeout=timeout), None
+            except subprocess.TimeoutExpired:
+                return None, None
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            pid, status, usage = os.wait4(popen.pid, os.WNOHANG)
+            if pid != 0:
+                # Reaped here, hence not known to the Popen object.
+                popen.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                return popen.returncode, usage
+            if deadline is not None and time.monotonic() >= deadline:
+                return None, None
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def __stop(self, popen: subprocess.Popen) -> Tuple[Union[None, int], object]:
+        """
+        Terminates the job and all the processes it launched, killed if not exited after the grace period.
+        :return: Exit code of the job and its resource usage, where supported.
+        """
+        if popen.returncode is not None:
+            return popen.returncode, None
+        self.__signal(popen, signal.SIGTERM)
+        returncode, usage = self.__wait(popen, self._grace_period)
+        if returncode is None:
+            logging.warning("Job {} not exiting after {} seconds, killed.".format(popen.args, self._grace_period))
+            self.__signal(popen, signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+            returncode, usage = self.__wait(popen, None)
+        return returncode, usage
+
+    @staticmethod
+    def __signal(popen: subprocess.Popen, sig) -> None:
+        try:
+            if platform.system() != 'Windows':
+                os.killpg(popen.pid, sig)
+            else:
+                popen.kill()
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def __save_record(self, record: dict) -> None:
+        records_filename = os.path.join(self.log_folder, SUBPROCESS_RECORDS_FILENAME)
+        try:
+            with _records_lock:
+                new_file = not os.path.exists(records_filename)
+                with open(records_filename, 'a', newline='') as outfile:
+                    writer = csv.DictWriter(outfile, fieldnames=SUBPROCESS_RECORDS_COLUMNS)
+                    if new_file:
+                        writer.writeheader()
+                    writer.writerow(record)
+        except Exception as e:
+            logging.warning("Timings of job {} could not be saved in {}.".format(record["Job"], records_filename))
+
+
+def read_log_tail(log_filename: str, lines: int = 20) -> str:
+    """
+    Last lines of a job log file, for error messages.
+    """
+    try:
+        with open(log_filename, 'r', errors='replace') as infile:
+            return ''.join(infile.readlines()[-lines:])
+    except Exception as e:
+        return ''
@@ -1,6 +1,33 @@
+import sys
+from typing import Union
 from ..Utils.resources import SharedResources
 
 
 def get_metrics_target_class() -> str:
     target_class = SharedResources.getInstance().maps_gt_files_suffix.split('.')[0].split('label_')[-1]
     return target_class
+
+
+def get_peak_memory_usage() -> Union[None, float]:
+    """
+    Peak resident memory of the current process, plus the largest peak among its terminated child processes (e.g.,
+    pool workers), in MB.
+    Returns None on platforms not providing the information (e.g., Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # Expressed in bytes on macOS, and in kilobytes on Linux.
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def init_worker_threads(threads: int) -> None:
+    """
+    Initializer of the pool worker processes, constraining the number of threads each worker uses.
+    :param threads: Number of threads for each worker.
+    :return: None
+    """
+    SharedResources.getInstance().set_job_threads(threads)
@@ -1,12 +1,16 @@
 import traceback
 import logging
 from tqdm import tqdm
-from .Computation.registration_step import RegistrationStep
+from .Computation.registration_computation_processor import RegistrationComputationProcessor
+from .Computation.brain_segmentation_processor import BrainSegmentationProcessor
 from .Computation.heatmap_computation_processor import HeatmapComputationProcessor
 from .Computation.metrics_computation_processor import MetricsComputationProcessor
+from .Computation.preflight_processor import PreflightProcessor
+from .Computation.warp_back_processor import WarpBackProcessor
 from .Structures.CohortStructure import Cohort
 from .Utils.resources import SharedResources
 from .Utils.io import download_model
+from .Utils.mask_cache import warm_mask_cache
 
 
 def compute(config_filename: str, logging_filename: str = None) -> None:
@@ -18,6 +22,8 @@ def compute(config_filename: str, logging_filename: str = None) -> None:
     """
     try:
         SharedResources.getInstance().set_environment(config_filename=config_filename)
+        if SharedResources.getInstance().system_threads_per_job is not None:
+            SharedResources.getInstance().set_job_threads(SharedResources.getInstance().system_threads_per_job)
         if logging_filename:
             logger = logging.getLogger()
             handler = logging.FileHandler(filename=logging_filename, mode='a', encoding='utf-8')
@@ -38,20 +44,41 @@ def compute(config_filename: str, logging_filename: str = None) -> None:
         print('Parsing of the cohort folder could not proceed.  Collected: \n'.format(task))
         print('{}'.format(traceback.format_exc()))
 
+    if SharedResources.getInstance().preflight or task == 'preflight':
+        try:
+            processor = PreflightProcessor()
+            processor.setup(cohort)
+            processor.run()
+        except Exception as e:
+            print('Compute could not proceed. Issue arose during the preflight check. Collected: \n')
+            print('{}'.format(traceback.format_exc()))
+            return
+        if task == 'preflight':
+            return
+
     if not SharedResources.getInstance().maps_use_registered_data:
         # Perform the step of co-registration for the whole cohort beforehand
         download_model("MRI_Sequence_Classifier")
         download_model("MRI_Brain")
-        logging.info("Running registration to common atlas space.")
-        for p in tqdm(list(cohort.patients.keys())):
+        if SharedResources.getInstance().maps_brain_segmentation_prestage:
+            logging.info("Running brain segmentation over the cohort.")
             try:
-                pat = cohort.patients[p]
-                processor = RegistrationStep()
-                processor.setup(pat)
-                pat = processor.execute()
-                cohort.patients[p] = pat
+                processor = BrainSegmentationProcessor()
+                processor.setup(cohort)
+                processor.run()
             except Exception as e:
-                continue
+                # The brain segmentation is otherwise performed inside the registration of each patient.
+                logging.warning("Cohort-level brain segmentation could not proceed, with: {}".format(
+                    traceback.format_exc()))
+        logging.info("Running registration to common atlas space.")
+        try:
+            processor = RegistrationComputationProcessor()
+            processor.setup(cohort)
+            processor.run()
+        except Exception as e:
+            print('Compute could not proceed. Issue arose during the registration. Collected: \n')
+            print('{}'.format(traceback.format_exc()))
+            return
 
     try:
         if task == 'heatmap':
@@ -62,6 +89,12 @@ def compute(config_filename: str, logging_filename: str = None) -> None:
             processor = MetricsComputationProcessor()
             processor.setup(cohort)
             processor.run()
+        elif task == 'cache':
+            warm_mask_cache(cohort)
+        elif task == 'warp_back':
+            processor = WarpBackProcessor()
+            processor.setup(cohort)
+            processor.run()
         else:
             logging.warning("The requested task, with value {}, has not been implemented.\n"
                             "Please make sure to select a valid task!".format(task))
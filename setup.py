@@ -23,6 +23,7 @@ setup(
             'raidionicsmaps.Structures',
             'raidionicsmaps.Utils',
             'raidionicsmaps.Atlases',
+            'raidionicsmaps.Benchmarks',
             'tests',
         ]
     ),
@@ -0,0 +1,132 @@
+import os
+import re
+import shutil
+import logging
+import traceback
+import numpy as np
+import nibabel as nib
+
+
+def write_synthetic_atlases(atlases_folder, shape, rng):
+    """
+    Writes small random atlases following the layout of the Atlases folder of raidionics_rads, with one region name per
+    label, and returns their content.
+    """
+    from raidionicsmaps.Utils.atlas_index import CORTICAL_ATLASES, SUBCORTICAL_ATLASES, LATERALISATION_MASK
+    atlases = {}
+    lateralisation = np.zeros(shape, dtype='uint8')
+    lateralisation[:, :shape[1] // 2, :] = 1
+    lateralisation[:, shape[1] // 2:, :] = 2
+    lateralisation[0] = 0
+    atlases[LATERALISATION_MASK] = lateralisation
+    for reference in CORTICAL_ATLASES:
+        regions = rng.integers(0, 6, size=shape).astype('uint8')
+        atlases[CORTICAL_ATLASES[reference][0]] = regions
+        description = os.path.join(atlases_folder, CORTICAL_ATLASES[reference][1])
+        os.makedirs(os.path.dirname(description), exist_ok=True)
+        with open(description, 'w') as outfile:
+            if reference == 'MNI':
+                outfile.write('Region,Laterality,Matter type,Label\n')
+                outfile.writelines(['region{},left,gm,{}\n'.format(l, l) for l in range(1, 6)])
+            elif reference == 'Harvard-Oxford':
+                outfile.write('Label,Color,Region-short,Region\n')
+                outfile.writelines(['{},000000,R{},Region {}\n'.format(l, l, l) for l in range(0, 6)])
+            else:
+                outfile.write(',Label,Region\n')
+                outfile.writelines(['{},{},region {}\n'.format(l - 1, l, l) for l in range(1, 6)])
+    for reference in SUBCORTICAL_ATLASES:
+        for t in range(3):
+            atlases[SUBCORTICAL_ATLASES[reference][0] + '/Tract{}_mni.nii.gz'.format(t)] = rng.random(shape)
+    for fn in atlases:
+        os.makedirs(os.path.dirname(os.path.join(atlases_folder, fn)), exist_ok=True)
+        nib.save(nib.Nifti1Image(atlases[fn], np.eye(4)), os.path.join(atlases_folder, fn))
+    return atlases
+
+
+def check_index_counts(index, atlases, mask):
+    """
+    Compares the voxel counts of the index against a direct overlap of the object with each atlas.
+    """
+    from raidionicsmaps.Utils.atlas_index import CORTICAL_ATLASES, SUBCORTICAL_ATLASES, LATERALISATION_MASK
+    voxels = np.flatnonzero(mask)
+    region_counts = index.count_regions(voxels)
+    tract_counts = index.count_tracts(voxels)
+    lateralisation = atlases[LATERALISATION_MASK]
+    if index.get_hemisphere_counts(region_counts) != (np.count_nonzero(mask & (lateralisation == 2)),
+                                                      np.count_nonzero(mask & (lateralisation == 1))):
+        raise ValueError("Hemisphere counts differ from the direct overlap.")
+    for reference in CORTICAL_ATLASES:
+        regions = atlases[CORTICAL_ATLASES[reference][0]]
+        counts = index.get_cortical_counts(region_counts, reference)
+        if len(counts) != len(np.unique(regions)) - 1:
+            raise ValueError("Number of regions differs for {}.".format(reference))
+        for name in counts:
+            # The synthetic region names end with their label.
+            label = int(re.findall(r'\d+', name)[-1])
+            if counts[name] != np.count_nonzero(mask & (regions == label)):
+                raise ValueError("Region counts differ from the direct overlap for {} in {}.".format(name, reference))
+    for reference in SUBCORTICAL_ATLASES:
+        for tract_id, name in index.get_tracts(reference):
+            tract = atlases[SUBCORTICAL_ATLASES[reference][0] + '/' + name + '_mni.nii.gz']
+            if tract_counts[tract_id] != np.count_nonzero(mask & (tract >= SUBCORTICAL_ATLASES[reference][1])):
+                raise ValueError("Tract counts differ from the direct overlap for {}.".format(name))
+
+
+def atlas_index_test():
+    """
+    Builds the atlas index over small synthetic atlases, compares its counts against a direct voxel overlap, and
+    ensures that the index is rebuilt once an atlas file changes.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running atlas index unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_atlas_index_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    try:
+        from raidionicsmaps.Utils.atlas_index import AtlasIndex, CORTICAL_ATLASES
+        rng = np.random.default_rng(0)
+        shape = (16, 18, 14)
+        atlases_folder = os.path.join(test_dir, 'Atlases')
+        index_folder = os.path.join(test_dir, 'Atlas_index')
+        atlases = write_synthetic_atlases(atlases_folder, shape, rng)
+        mask = rng.random(shape) > 0.7
+
+        index = AtlasIndex(index_folder=index_folder, atlases_folder=atlases_folder)
+        index.load()
+        check_index_counts(index, atlases, mask)
+
+        # Opening the index again, with unchanged atlases, must not rebuild it.
+        header_filename = os.path.join(index_folder, 'index.json')
+        built = os.stat(header_filename).st_mtime_ns
+        index = AtlasIndex(index_folder=index_folder, atlases_folder=atlases_folder)
+        index.load()
+        if os.stat(header_filename).st_mtime_ns != built:
+            raise ValueError("Atlas index rebuilt while the atlases are unchanged.")
+
+        # Modifying one atlas, the index must be invalidated and rebuilt from the new content.
+        filename = os.path.join(atlases_folder, CORTICAL_ATLASES['Schaefer7'][0])
+        modified = os.stat(filename).st_mtime_ns
+        atlases[CORTICAL_ATLASES['Schaefer7'][0]] = rng.integers(0, 4, size=shape).astype('uint8')
+        nib.save(nib.Nifti1Image(atlases[CORTICAL_ATLASES['Schaefer7'][0]], np.eye(4)), filename)
+        # Ensuring a new modification time on file systems with a coarse timestamp resolution.
+        os.utime(filename, ns=(modified + 2000000000, modified + 2000000000))
+        index = AtlasIndex(index_folder=index_folder, atlases_folder=atlases_folder)
+        index.load()
+        if os.stat(header_filename).st_mtime_ns == built:
+            raise ValueError("Atlas index not rebuilt after an atlas changed.")
+        check_index_counts(index, atlases, mask)
+    except Exception as e:
+        logging.error("Error during atlas index unit test with: \n {}.\n".format(traceback.format_exc()))
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during atlas index unit test.\n")
+
+    logging.info("Atlas index unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+atlas_index_test()
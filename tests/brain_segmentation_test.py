@@ -0,0 +1,201 @@
+import os
+import shutil
+import configparser
+import logging
+import traceback
+import numpy as np
+import nibabel as nib
+
+
+def generate_synthetic_model(model_folder, nb_folds=2, seed=0):
+    """
+    Saves a small full-volume segmentation model, as one 3D convolution followed by a softmax, for each fold inside the
+    model folder, together with its pre_processing.ini. Requires the onnx package.
+    """
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    rng = np.random.RandomState(seed)
+    for f in range(nb_folds):
+        # Brain class for the normalized intensities above one half, perturbed for each fold.
+        weights = rng.normal(0., 0.1, (2, 1, 3, 3, 3)).astype('float32')
+        weights[1, 0, 1, 1, 1] = weights[1, 0, 1, 1, 1] + 8.
+        bias = np.asarray([0., -4.], dtype='float32')
+        graph = helper.make_graph(
+            [helper.make_node('Conv', ['input', 'weights', 'bias'], ['logits'], pads=[1] * 6),
+             helper.make_node('Softmax', ['logits'], ['output'], axis=1)],
+            'brain', [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['N', 1, 32, 32, 32])],
+            [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['N', 2, 32, 32, 32])],
+            [numpy_helper.from_array(weights, 'weights'), numpy_helper.from_array(bias, 'bias')])
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+        model.ir_version = 7
+        os.makedirs(os.path.join(model_folder, 'fold' + str(f)))
+        onnx.save(model, os.path.join(model_folder, 'fold' + str(f), 'model.onnx'))
+
+    pre_processing = configparser.ConfigParser()
+    pre_processing.add_section('Default')
+    pre_processing.set('Default', 'imaging_modality', 'MRI')
+    pre_processing.set('Default', 'training_backend', 'Torch')
+    pre_processing.add_section('PreProcessing')
+    pre_processing.set('PreProcessing', 'output_spacing', '1.0, 1.0, 1.0')
+    pre_processing.set('PreProcessing', 'new_axial_size', '32, 32, 32')
+    pre_processing.set('PreProcessing', 'normalization_method', 'default')
+    pre_processing.set('PreProcessing', 'number_inputs', '1')
+    pre_processing.set('PreProcessing', 'channels_order', 'channels_first')
+    pre_processing.add_section('Training')
+    pre_processing.set('Training', 'nb_classes', '2')
+    pre_processing.set('Training', 'classes', 'Background, Brain')
+    pre_processing.set('Training', 'optimal_thresholds', '0.5, 0.5')
+    with open(os.path.join(model_folder, 'pre_processing.ini'), 'w') as outfile:
+        pre_processing.write(outfile)
+
+
+def segment_with_rads_runtime(test_dir, volume_filepath, model_folder):
+    """
+    Segments one volume through raidionics_seg, with the runtime options given by raidionics_rads for the brain
+    segmentation inside the registration pipeline.
+    """
+    from raidionicsseg.fit import run_model
+    from raidionicsrads.Utils.configuration_parser import ResourcesConfiguration
+
+    folder = os.path.join(test_dir, 'Reference', os.path.basename(os.path.dirname(volume_filepath)))
+    os.makedirs(os.path.join(folder, 'inputs'))
+    os.makedirs(os.path.join(folder, 'outputs'))
+    shutil.copyfile(volume_filepath, os.path.join(folder, 'inputs', 'input0.nii.gz'))
+    rads = ResourcesConfiguration.getInstance()
+    seg_config = configparser.ConfigParser()
+    seg_config.add_section('System')
+    seg_config.set('System', 'gpu_id', "-1")
+    seg_config.set('System', 'inputs_folder', os.path.join(folder, 'inputs'))
+    seg_config.set('System', 'output_folder', os.path.join(folder, 'outputs'))
+    seg_config.set('System', 'model_folder', model_folder)
+    seg_config.add_section('Runtime')
+    seg_config.set('Runtime', 'batch_size', str(rads.predictions_batch_size))
+    seg_config.set('Runtime', 'overlapping_ratio', str(rads.predictions_overlapping_ratio))
+    # As set by the RegistrationStep in the raidionics_rads configuration.
+    seg_config.set('Runtime', 'reconstruction_method', 'thresholding')
+    seg_config.set('Runtime', 'reconstruction_order', 'resample_first')
+    seg_config.set('Runtime', 'use_preprocessed_data', str(rads.predictions_use_stripped_data))
+    seg_config.set('Runtime', 'folds_ensembling', str(rads.predictions_folds_ensembling))
+    seg_config.set('Runtime', 'ensembling_strategy', rads.predictions_ensembling_strategy)
+    seg_config.set('Runtime', 'test_time_augmentation_iteration',
+                   str(rads.predictions_test_time_augmentation_iterations))
+    seg_config.set('Runtime', 'test_time_augmentation_fusion_mode',
+                   rads.predictions_test_time_augmentation_fusion_mode)
+    seg_config_filename = os.path.join(folder, 'seg_config.ini')
+    with open(seg_config_filename, 'w') as outfile:
+        seg_config.write(outfile)
+    run_model(seg_config_filename)
+    return os.path.join(folder, 'outputs', 'labels_Brain.nii.gz')
+
+
+def brain_segmentation_test():
+    """
+    Segments the brain of a small synthetic cohort with a synthetic two-fold model, in batches through the cohort-level
+    brain segmentation, and ensures that each mask matches the one from the segmentation with the runtime options of
+    the registration pipeline. Batched fold ensembling is also compared to the per-patient inference of raidionics_seg.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running brain segmentation unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_brain_segmentation_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    from raidionicsmaps.Utils.resources import SharedResources
+    default_models_folder = SharedResources.getInstance().system_models_folder
+    try:
+        from raidionicsmaps.Structures.CohortStructure import Cohort
+        from raidionicsmaps.Computation.brain_segmentation_processor import BrainSegmentationProcessor, \
+            get_brain_mask_filepath, predict_whole_batch
+        from raidionicsseg.Utils.configuration_parser import ConfigResources
+        from raidionicsseg.Inference.predictions import run_predictions
+        import onnxruntime as rt
+
+        rng = np.random.RandomState(0)
+        shape = (40, 36, 30)
+        for p in range(5):
+            os.makedirs(os.path.join(test_dir, 'Cohort', 'Pat' + str(p).zfill(3)))
+            volume = rng.normal(100., 20., shape).astype('float32')
+            volume[8:30, 6:28, 5:25] = volume[8:30, 6:28, 5:25] + 150.
+            patient_dir = os.path.join(test_dir, 'Cohort', 'Pat' + str(p).zfill(3))
+            nib.save(nib.Nifti1Image(volume, np.diag([1.2, 1.1, 1.3, 1.])),
+                     os.path.join(patient_dir, 'Pat' + str(p).zfill(3) + '_MRI.nii.gz'))
+            nib.save(nib.Nifti1Image(np.zeros(shape, dtype='uint8'), np.diag([1.2, 1.1, 1.3, 1.])),
+                     os.path.join(patient_dir, 'Pat' + str(p).zfill(3) + '_MRI_label_tumor.nii.gz'))
+
+        config = configparser.ConfigParser()
+        config.add_section('Default')
+        config.set('Default', 'task', 'heatmap')
+        config.set('Default', 'input_folder', os.path.join(test_dir, 'Cohort'))
+        config.set('Default', 'output_folder', os.path.join(test_dir, 'Output'))
+        config.add_section('Maps')
+        config.set('Maps', 'gt_files_suffix', 'label_tumor.nii.gz')
+        config.set('Maps', 'brain_segmentation_prestage', 'true')
+        config.set('Maps', 'brain_segmentation_batch_size', '2')
+        config_filename = os.path.join(test_dir, 'config.ini')
+        with open(config_filename, 'w') as outfile:
+            config.write(outfile)
+        SharedResources.getInstance().set_environment(config_filename)
+        SharedResources.getInstance().system_models_folder = os.path.join(test_dir, 'Models')
+        model_folder = os.path.join(test_dir, 'Models', 'MRI_Brain')
+        generate_synthetic_model(model_folder)
+
+        cohort = Cohort(id='Cohort', input_folder=os.path.join(test_dir, 'Cohort'),
+                        output_folder=os.path.join(test_dir, 'Output'))
+        processor = BrainSegmentationProcessor()
+        processor.setup(cohort)
+        processor.run()
+        if len(cohort.patients) != 5:
+            raise ValueError("Synthetic cohort not fully loaded.")
+        for p in cohort.patients:
+            pat = cohort.patients[p]
+            if pat.mask_filepath != get_brain_mask_filepath(pat) or not os.path.exists(pat.mask_filepath):
+                raise ValueError("No brain mask saved for patient {}.".format(pat.patient_id))
+            reference = nib.load(segment_with_rads_runtime(test_dir, pat.volume_filepath, model_folder))
+            mask = nib.load(pat.mask_filepath)
+            if not np.allclose(reference.affine, mask.affine) or \
+                    not np.array_equal(np.asanyarray(reference.dataobj), np.asanyarray(mask.dataobj)):
+                raise ValueError("Brain mask of patient {} differs from the registration pipeline one.".format(
+                    pat.patient_id))
+            if np.count_nonzero(np.asanyarray(mask.dataobj)) in [0, np.prod(shape)]:
+                raise ValueError("Degenerate brain mask for patient {}.".format(pat.patient_id))
+
+        # Batched inference with the folds ensembled, against the per-patient inference of raidionics_seg.
+        models_path = sorted([os.path.join(model_folder, f, 'model.onnx') for f in ['fold0', 'fold1']])
+        models = [rt.InferenceSession(m, providers=["CPUExecutionProvider"]) for m in models_path]
+        data = rng.normal(0., 1., (3, 32, 32, 32, 1)).astype('float32')
+        for strategy in ['maximum', 'average']:
+            seg_config = configparser.ConfigParser()
+            seg_config.add_section('System')
+            seg_config.set('System', 'gpu_id', "-1")
+            seg_config.set('System', 'model_folder', model_folder)
+            seg_config.add_section('Runtime')
+            seg_config.set('Runtime', 'folds_ensembling', 'True')
+            seg_config.set('Runtime', 'ensembling_strategy', strategy)
+            seg_config_filename = os.path.join(test_dir, 'seg_config.ini')
+            with open(seg_config_filename, 'w') as outfile:
+                seg_config.write(outfile)
+            parameters = ConfigResources()
+            parameters.init_environment(seg_config_filename)
+            predictions = predict_whole_batch(models, data, parameters)
+            for i in range(data.shape[0]):
+                reference = run_predictions(data=data[i:i + 1], models_path=models_path, parameters=parameters)
+                if reference.shape != predictions[i].shape or \
+                        not np.allclose(reference, predictions[i], atol=1e-6):
+                    raise ValueError("Batched {} ensembling differs for sample {}.".format(strategy, i))
+    except Exception as e:
+        logging.error("Error during brain segmentation unit test with: \n {}.\n".format(traceback.format_exc()))
+        SharedResources.getInstance().system_models_folder = default_models_folder
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during brain segmentation unit test.\n")
+
+    SharedResources.getInstance().system_models_folder = default_models_folder
+    logging.info("Brain segmentation unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+brain_segmentation_test()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import logging
+import traceback
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import find_objects
+
+
+def heatmap_centroids_test():
+    """
+    Compares the foci centroids used for the heatmaps against the former per-foci implementation, over small synthetic
+    multifocal masks, both on the whole mask and on a crop of it around the object.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running heatmap centroids unit test.\n")
+
+    try:
+        from raidionicsmaps.Computation.heatmap_computation_processor import compute_foci_centroids
+        from raidionicsmaps.Benchmarks.heatmap_centroids_benchmark import reference_foci_centroids, \
+            generate_multifocal_mask
+
+        rng = np.random.RandomState(0)
+        shape = (64, 72, 60)
+        nb_multifocal = 0
+        for p in range(10):
+            # Margin around the foci, for the crop to lie strictly inside the mask.
+            labels = np.pad(generate_multifocal_mask(shape, rng.randint(2, 6), rng), 5)
+            # Including a speck below the 0.1 ml threshold, excluded from the centroids.
+            labels[2:4, 2:4, 2:4] = 1
+            reference = reference_foci_centroids(labels, voxel_volume=1.)
+            nb_multifocal = nb_multifocal + (1 if len(reference) > 1 else 0)
+
+            centroids = compute_foci_centroids(labels, voxel_volume=1.)
+            if not np.array_equal(np.asarray(reference), np.asarray(centroids)):
+                raise ValueError("Centroids differ from the reference for mask {}.".format(p))
+
+            bbox = find_objects(labels)[0]
+            centroids = compute_foci_centroids(labels[bbox], voxel_volume=1., offset=tuple([s.start for s in bbox]))
+            if not np.array_equal(np.asarray(reference), np.asarray(centroids)):
+                raise ValueError("Centroids differ from the reference for the crop of mask {}.".format(p))
+        if nb_multifocal == 0:
+            raise ValueError("No multifocal mask generated.")
+    except Exception as e:
+        logging.error("Error during heatmap centroids unit test with: \n {}.\n".format(traceback.format_exc()))
+        raise ValueError("Error during heatmap centroids unit test.\n")
+
+    logging.info("Heatmap centroids unit test succeeded.\n")
+
+
+def heatmap_centroids_widening_test():
+    """
+    Stamps more overlapping foci centroids than the accumulators capacity, both over the whole volume and slab after
+    slab, ensuring that the accumulators are widened instead of overflowing, with identical saved heatmaps.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running heatmap centroids widening unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_centroids_widening_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    try:
+        from raidionicsmaps.Structures.HeatmapStructure import Heatmap, get_centroid_cube
+
+        shape = (12, 10, 9)
+        atlas_ni = nib.Nifti1Image(np.zeros(shape, dtype='float32'), np.eye(4))
+        # A single patient, with more foci sharing the same centroid than the uint8 capacity.
+        centroids = [(5., 4., 4.)] * 300 + [(8., 6., 2.)]
+        whole = Heatmap(uid='', output_folder=os.path.join(test_dir, 'Whole'), shape=shape, dtype=np.uint8,
+                        pids_dtype=np.uint8)
+        whole.include_patient(None, centroids)
+        whole.dump_heatmaps_on_disk(atlas_ni)
+
+        thickness = 2
+        plane = int(np.prod(shape[:-1]))
+        streamed = Heatmap(uid='', output_folder=os.path.join(test_dir, 'Streamed'), shape=(plane * thickness,),
+                           dtype=np.uint8, pids_dtype=np.uint8)
+        streamed.open_streams(atlas_ni, count=1)
+        cubes = [np.ravel_multi_index(np.unravel_index(get_centroid_cube(com, shape), shape), shape, order='F')
+                 for com in centroids]
+        for z in range(0, shape[-1], thickness):
+            start = z * plane
+            end = min(z + thickness, shape[-1]) * plane
+            for cube in cubes:
+                streamed.stamp_centroid(cube[(cube >= start) & (cube < end)] - start, 1)
+            streamed.write_slab(end - start)
+        streamed.close_streams()
+
+        for fn in ['heatmap_centroids_cumulative.nii.gz', 'heatmap_centroids_percentages.nii.gz',
+                   'heatmap_patient_ids.nii.gz']:
+            reference = nib.load(os.path.join(test_dir, 'Whole', fn)).get_fdata()
+            result = nib.load(os.path.join(test_dir, 'Streamed', fn)).get_fdata()
+            if not np.array_equal(reference, result):
+                raise ValueError("Streamed {} differs from the whole-volume one.".format(fn))
+        if nib.load(os.path.join(test_dir, 'Streamed', 'heatmap_centroids_cumulative.nii.gz')).get_fdata().max() != 300:
+            raise ValueError("Overflowing centroids accumulator.")
+    except Exception as e:
+        logging.error("Error during heatmap centroids widening unit test with: \n {}.\n".format(
+            traceback.format_exc()))
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during heatmap centroids widening unit test.\n")
+
+    logging.info("Heatmap centroids widening unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+heatmap_centroids_test()
+heatmap_centroids_widening_test()
@@ -113,4 +113,141 @@ def heatmap_generation_test():
         shutil.rmtree(test_dir)
 
 
+
+def generate_synthetic_cohort(test_dir, nb_patients=8, shape=(20, 24, 18), seed=0):
+    """
+    Writes a small cohort of multifocal annotation masks already in the space of a synthetic atlas, together with the
+    patients parameters for the sub-populations heatmaps.
+    """
+    import numpy as np
+    import nibabel as nib
+    rng = np.random.RandomState(seed)
+    nib.save(nib.Nifti1Image(rng.rand(*shape).astype('float32'), np.eye(4)), os.path.join(test_dir, 'atlas.nii'))
+    with open(os.path.join(test_dir, 'parameters.csv'), 'w') as outfile:
+        outfile.write('Patient,Age,Gender\n')
+    for p in range(nb_patients):
+        add_synthetic_patient(test_dir, 'Pat{:03d}'.format(p), shape, rng)
+
+
+def add_synthetic_patient(test_dir, patient_id, shape, rng):
+    import numpy as np
+    import nibabel as nib
+    patient_dir = os.path.join(test_dir, 'Cohort', patient_id)
+    os.makedirs(patient_dir)
+    mask = np.zeros(shape, dtype='uint8')
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    for f in range(rng.randint(1, 4)):
+        radius = rng.randint(2, 5)
+        center = [rng.randint(radius, s - radius) for s in shape]
+        mask[sum((g - c) ** 2 for g, c in zip(grid, center)) <= radius ** 2] = 1
+    nib.save(nib.Nifti1Image(rng.rand(*shape).astype('float32'), np.eye(4)),
+             os.path.join(patient_dir, patient_id + '_MRI.nii.gz'))
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), os.path.join(patient_dir, patient_id + '_MRI_label_tumor.nii.gz'))
+    with open(os.path.join(test_dir, 'parameters.csv'), 'a') as outfile:
+        outfile.write('{},{},{}\n'.format(patient_id.lower(), rng.randint(20, 90), 'F' if rng.rand() > 0.5 else 'M'))
+
+
+def run_synthetic_heatmaps(test_dir, output_name, **options):
+    """
+    Computes the heatmaps of the synthetic cohort, with the heatmap processor options given, and returns the content
+    of all the heatmap files, indexed by their path relative to the Heatmaps folder.
+    """
+    import numpy as np
+    import nibabel as nib
+    from raidionicsmaps.Utils.resources import SharedResources
+    from raidionicsmaps.Structures.CohortStructure import Cohort
+    from raidionicsmaps.Computation.heatmap_computation_processor import HeatmapComputationProcessor
+
+    output_folder = os.path.join(test_dir, output_name)
+    os.makedirs(output_folder, exist_ok=True)
+    config = configparser.ConfigParser()
+    config.add_section('Default')
+    config.set('Default', 'task', 'heatmap')
+    config.set('Default', 'input_folder', os.path.join(test_dir, 'Cohort'))
+    config.set('Default', 'output_folder', output_folder)
+    config.add_section('Maps')
+    config.set('Maps', 'gt_files_suffix', 'label_tumor.nii.gz')
+    config.set('Maps', 'sequence_type', 'T1-CE')
+    config.set('Maps', 'use_registered_data', 'true')
+    config.set('Maps', 'extra_parameters_filename', os.path.join(test_dir, 'parameters.csv'))
+    config.set('Maps', 'distribution_dense_parameters', 'Age,30-50-70')
+    config.set('Maps', 'distribution_categorical_parameters', 'Gender,')
+    config_filename = os.path.join(output_folder, 'config.ini')
+    with open(config_filename, 'w') as outfile:
+        config.write(outfile)
+    SharedResources.getInstance().set_environment(config_filename)
+    SharedResources.getInstance().mni_atlas_filepath_T1 = os.path.join(test_dir, 'atlas.nii')
+
+    cohort = Cohort(id='0', input_folder=os.path.join(test_dir, 'Cohort'), output_folder=output_folder)
+    processor = HeatmapComputationProcessor(**options)
+    processor.setup(cohort)
+    processor.run()
+
+    heatmaps_folder = os.path.join(output_folder, 'Heatmaps')
+    results = {}
+    for root, _, files in os.walk(heatmaps_folder):
+        for fn in files:
+            if fn.endswith('.nii.gz'):
+                results[os.path.relpath(os.path.join(root, fn), heatmaps_folder)] = \
+                    np.asanyarray(nib.load(os.path.join(root, fn)).dataobj)
+    return results
+
+
+def compare_heatmaps(reference, results, mode):
+    import numpy as np
+    if sorted(reference.keys()) != sorted(results.keys()):
+        raise ValueError("Heatmap files differ from the serial computation with {}.".format(mode))
+    if len([x for x in reference.keys() if 'Overall' not in x]) == 0:
+        raise ValueError("No sub-population heatmap generated.")
+    for fn in reference:
+        if reference[fn].dtype != results[fn].dtype or not np.array_equal(reference[fn], results[fn]):
+            raise ValueError("Heatmap {} differs from the serial computation with {}.".format(fn, mode))
+
+
+def heatmap_modes_test():
+    """
+    Ensures that the heatmaps computed with parallel workers, low memory counters, incremental updates after adding
+    and removing patients, and slab streaming, are identical to the serial computation from scratch, over a small
+    synthetic cohort.
+    """
+    import numpy as np
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running heatmap computation modes unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_modes_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    try:
+        generate_synthetic_cohort(test_dir)
+        reference = run_synthetic_heatmaps(test_dir, 'Serial', workers=1)
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'Workers', workers=3), 'workers')
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'LowMemory', low_memory=True), 'low_memory')
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'Slab', slab_thickness=5), 'slab_thickness')
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'SlabLowMemory', slab_thickness=5,
+                                                           low_memory=True), 'slab_thickness with low_memory')
+
+        # Incremental runs over the same output folder, first from scratch, then after adding and removing patients.
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'Incremental', incremental=True), 'incremental')
+        add_synthetic_patient(test_dir, 'Pat100', (20, 24, 18), np.random.RandomState(100))
+        reference = run_synthetic_heatmaps(test_dir, 'SerialAdded', workers=1)
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'Incremental', incremental=True),
+                         'incremental after adding a patient')
+        shutil.rmtree(os.path.join(test_dir, 'Cohort', 'Pat002'))
+        reference = run_synthetic_heatmaps(test_dir, 'SerialRemoved', workers=1)
+        compare_heatmaps(reference, run_synthetic_heatmaps(test_dir, 'Incremental', incremental=True),
+                         'incremental after removing a patient')
+    except Exception as e:
+        logging.error("Error during heatmap computation modes unit test with: \n {}.\n".format(traceback.format_exc()))
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during heatmap computation modes unit test.\n")
+
+    logging.info("Heatmap computation modes unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+heatmap_modes_test()
 heatmap_generation_test()
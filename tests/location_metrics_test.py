@@ -0,0 +1,80 @@
+import os
+import shutil
+import json
+import logging
+import traceback
+import numpy as np
+
+
+def generate_blob(shape, center, radius):
+    z, y, x = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    return ((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2) <= radius * radius
+
+
+def location_metrics_test():
+    """
+    Compares the location metrics computed natively against the neuro_clinical_report.json produced by raidionics_rads
+    for the same synthetic mask in MNI space: a main focus crossing the midline, two satellites, and a speck discarded
+    by the mask refinement.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running location metrics unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_location_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    try:
+        from raidionicsmaps.Utils.resources import SharedResources
+        from raidionicsmaps.Utils.location_metrics import compute_location_report, compute_multifocality, refine_mask
+        SharedResources.getInstance().system_models_folder = test_dir
+
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'resources',
+                               'neuro_clinical_report.json'), 'r') as infile:
+            expected = json.load(infile)
+
+        shape = (197, 233, 189)
+        mask = generate_blob(shape, (98, 120, 100), 10) | generate_blob(shape, (70, 150, 80), 6) | \
+            generate_blob(shape, (130, 90, 110), 4) | generate_blob(shape, (120, 160, 60), 1)
+        report = compute_location_report(refine_mask(mask.astype('uint8')), (1., 1., 1.), ['MNI', 'Schaefer7'],
+                                         ['BCB'])
+
+        for k in ["Multifocality", "Tumor parts nb"]:
+            if report["Overall"][k] != expected["Overall"][k]:
+                raise ValueError("{} differs: {} instead of {}.".format(k, report["Overall"][k], expected["Overall"][k]))
+        if not np.isclose(report["Overall"]["Multifocal distance (mm)"],
+                          expected["Overall"]["Multifocal distance (mm)"], atol=1e-6):
+            raise ValueError("Multifocal distance differs.")
+        for k in ["Left laterality (%)", "Right laterality (%)", "Midline crossing"]:
+            if report["Main"]["Total"][k] != expected["Main"]["Total"][k]:
+                raise ValueError("{} differs: {} instead of {}.".format(k, report["Main"]["Total"][k],
+                                                                        expected["Main"]["Total"][k]))
+        for s in ['MNI', 'Schaefer7']:
+            if report["Main"]["Total"]["CorticalStructures"][s] != expected["Main"]["Total"]["CorticalStructures"][s]:
+                raise ValueError("Cortical structures overlap differs for {}.".format(s))
+        computed = report["Main"]["Total"]["SubcorticalStructures"]["BCB"]
+        reference = expected["Main"]["Total"]["SubcorticalStructures"]["BCB"]
+        if sorted(computed.keys()) != sorted(reference.keys()):
+            raise ValueError("Subcortical structures differ.")
+        for k in reference:
+            if (k.endswith('_overlap') and computed[k] != reference[k]) or \
+                    (k.endswith('_distance') and not np.isclose(computed[k], reference[k], atol=1e-6)):
+                raise ValueError("{} differs: {} instead of {}.".format(k, computed[k], reference[k]))
+
+        # No connected component reaching the focus volume threshold, reported as a single focus.
+        speckles = generate_blob(shape, (60, 60, 60), 3) | generate_blob(shape, (60, 80, 60), 3)
+        if compute_multifocality(speckles.astype('uint8'), (0.5, 0.5, 0.5)) != (False, 1, -1.):
+            raise ValueError("Multifocality differs when all foci are below the volume threshold.")
+    except Exception as e:
+        logging.error("Error during location metrics unit test with: \n {}.\n".format(traceback.format_exc()))
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during location metrics unit test.\n")
+
+    logging.info("Location metrics unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+location_metrics_test()
@@ -0,0 +1,148 @@
+import os
+import shutil
+import configparser
+import logging
+import traceback
+import numpy as np
+import nibabel as nib
+
+
+def cache_synthetic_registration(test_dir, patient, warped_label):
+    """
+    Fills the registration cache with transforms and warped images for the patient, for the registration stage to
+    restore them instead of running ANTs.
+    """
+    from raidionicsmaps.Utils.resources import SharedResources
+    from raidionicsmaps.Utils.registration_cache import RegistrationCache, get_registration_settings
+
+    cache = RegistrationCache()
+    key = cache.get_entry_key(moving=patient.volume_filepath, fixed=SharedResources.getInstance().mni_atlas_filepath_T1,
+                              settings=get_registration_settings(), mask=patient.mask_filepath)
+    transforms_folder = os.path.join(test_dir, 'Transforms', patient.patient_id)
+    os.makedirs(transforms_folder)
+    for fn in ['0GenericAffine.mat', '1InverseWarp.nii.gz']:
+        with open(os.path.join(transforms_folder, fn), 'wb') as outfile:
+            outfile.write(os.urandom(64))
+    cache.store_transforms(key, forward=[os.path.join(transforms_folder, '0GenericAffine.mat')],
+                           inverse=[os.path.join(transforms_folder, '1InverseWarp.nii.gz')])
+    warped_volume_fn = os.path.join(transforms_folder, 'warped_volume.nii.gz')
+    nib.save(nib.Nifti1Image(warped_label.astype('float32'), np.eye(4)), warped_volume_fn)
+    cache.store_warped(key, 'volume', warped_volume_fn)
+    warped_label_fn = os.path.join(transforms_folder, 'warped_label.nii.gz')
+    nib.save(nib.Nifti1Image(warped_label, np.eye(4)), warped_label_fn)
+    cache.store_warped(key, 'label_' + cache.get_file_hash(patient.label_filepath), warped_label_fn)
+
+
+def preflight_test():
+    """
+    Runs the preflight check, the registration, and the heatmap computation over a small synthetic cohort not yet
+    registered, with one patient discarded by the preflight check. The files produced after the check (brain mask,
+    registered annotations) must be used by the later stages, while the discarded patient must be left out.
+    The registrations are restored from the registration cache, filled beforehand.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running preflight unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_preflight_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    try:
+        from raidionicsmaps.Utils.resources import SharedResources
+        from raidionicsmaps.Structures.CohortStructure import Cohort
+        from raidionicsmaps.Computation.preflight_processor import PreflightProcessor
+        from raidionicsmaps.Computation.registration_computation_processor import RegistrationComputationProcessor
+        from raidionicsmaps.Computation.heatmap_computation_processor import HeatmapComputationProcessor
+
+        rng = np.random.RandomState(0)
+        atlas_shape = (20, 24, 18)
+        native_shape = (22, 26, 20)
+        nib.save(nib.Nifti1Image(rng.rand(*atlas_shape).astype('float32'), np.eye(4)),
+                 os.path.join(test_dir, 'atlas.nii'))
+        for p in range(4):
+            patient_id = 'Pat{:03d}'.format(p)
+            patient_dir = os.path.join(test_dir, 'Cohort', patient_id)
+            os.makedirs(patient_dir)
+            nib.save(nib.Nifti1Image(rng.rand(*native_shape).astype('float32'), np.eye(4)),
+                     os.path.join(patient_dir, patient_id + '_MRI.nii.gz'))
+            # The annotation of the last patient does not match its volume, discarded by the preflight check.
+            label = np.zeros(native_shape if p != 3 else atlas_shape, dtype='uint8')
+            label[5:10, 6:12, 4:9] = 1
+            nib.save(nib.Nifti1Image(label, np.eye(4)),
+                     os.path.join(patient_dir, patient_id + '_MRI_label_tumor.nii.gz'))
+
+        config = configparser.ConfigParser()
+        config.add_section('Default')
+        config.set('Default', 'task', 'heatmap')
+        config.set('Default', 'input_folder', os.path.join(test_dir, 'Cohort'))
+        config.set('Default', 'output_folder', os.path.join(test_dir, 'Output'))
+        config.set('Default', 'registration_cache', 'true')
+        config.set('Default', 'registration_cache_folder', os.path.join(test_dir, 'Cache'))
+        config.add_section('Maps')
+        config.set('Maps', 'gt_files_suffix', 'label_tumor.nii.gz')
+        config.set('Maps', 'sequence_type', 'T1-CE')
+        config.set('Maps', 'use_registered_data', 'false')
+        config_filename = os.path.join(test_dir, 'config.ini')
+        with open(config_filename, 'w') as outfile:
+            config.write(outfile)
+        SharedResources.getInstance().set_environment(config_filename)
+        SharedResources.getInstance().mni_atlas_filepath_T1 = os.path.join(test_dir, 'atlas.nii')
+
+        cohort = Cohort(id='0', input_folder=os.path.join(test_dir, 'Cohort'),
+                        output_folder=os.path.join(test_dir, 'Output'))
+        processor = PreflightProcessor()
+        processor.setup(cohort)
+        processor.run()
+        patients = {cohort.patients[p].patient_id: cohort.patients[p] for p in cohort.patients}
+        if cohort.is_file_validated(patients['pat003'].volume_filepath) or \
+                not cohort.is_file_validated(patients['pat000'].volume_filepath):
+            raise ValueError("Unexpected preflight check outcome.")
+
+        # Brain mask produced after the preflight check, as by the cohort-level brain segmentation.
+        mask_fn = os.path.join(patients['pat000'].output_folderpath, 'input_brain_mask.nii.gz')
+        nib.save(nib.Nifti1Image(np.ones(native_shape, dtype='uint8'), np.eye(4)), mask_fn)
+        patients['pat000'].mask_filepath = mask_fn
+
+        expected = np.zeros(atlas_shape)
+        for pid in ['pat000', 'pat001', 'pat002']:
+            warped_label = np.zeros(atlas_shape, dtype='uint8')
+            center = rng.randint(4, 14, size=3)
+            warped_label[center[0] - 3:center[0] + 3, center[1] - 3:center[1] + 3, center[2] - 3:center[2] + 3] = 1
+            cache_synthetic_registration(test_dir, patients[pid], warped_label)
+            expected = expected + warped_label
+
+        processor = RegistrationComputationProcessor(workers=1)
+        processor.setup(cohort)
+        processor.run()
+        patients = {cohort.patients[p].patient_id: cohort.patients[p] for p in cohort.patients}
+        if patients['pat000'].mask_filepath != mask_fn:
+            raise ValueError("Brain mask produced after the preflight check discarded by the registration.")
+        for pid in ['pat000', 'pat001', 'pat002']:
+            if patients[pid].registered_label_filepath is None or \
+                    not os.path.exists(patients[pid].registered_label_filepath):
+                raise ValueError("Patient {} not registered.".format(pid))
+        if patients['pat003'].registered_label_filepath is not None:
+            raise ValueError("Patient discarded by the preflight check registered.")
+
+        processor = HeatmapComputationProcessor(workers=1)
+        processor.setup(cohort)
+        processor.run()
+        heatmap_fn = os.path.join(test_dir, 'Output', 'Heatmaps', 'Overall', 'heatmap_cumulative.nii.gz')
+        percentages_fn = os.path.join(test_dir, 'Output', 'Heatmaps', 'Overall', 'heatmap_percentages.nii.gz')
+        if not np.array_equal(nib.load(heatmap_fn).get_fdata(), expected):
+            raise ValueError("Heatmap not computed from the registered annotations of the validated patients.")
+        if not np.allclose(nib.load(percentages_fn).get_fdata(), expected / 3.):
+            raise ValueError("Heatmap percentages not computed over the validated patients.")
+    except Exception as e:
+        logging.error("Error during preflight unit test with: \n {}.\n".format(traceback.format_exc()))
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during preflight unit test.\n")
+
+    logging.info("Preflight unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+preflight_test()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import configparser
+import logging
+import traceback
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import label
+from skimage.measure import regionprops
+
+
+class WarningsCollector(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def compute_size_metrics(test_dir, patient_id, mask):
+    """
+    Runs the size computation step over an annotation mask already registered to the MNI space.
+    """
+    from raidionicsmaps.Structures.PatientStructure import Patient
+    from raidionicsmaps.Computation.size_computation_step import SizeComputationStep
+    from raidionicsmaps.Utils.utils import get_metrics_target_class
+
+    patient_dir = os.path.join(test_dir, 'Cohort', patient_id)
+    os.makedirs(patient_dir)
+    nib.save(nib.Nifti1Image(np.zeros(mask.shape, dtype='float32'), np.eye(4)),
+             os.path.join(patient_dir, patient_id + '_MRI.nii.gz'))
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), os.path.join(patient_dir, patient_id + '_MRI_label_tumor.nii.gz'))
+    os.makedirs(os.path.join(test_dir, 'Output', patient_id))
+    nib.save(nib.Nifti1Image(mask, np.eye(4)), os.path.join(test_dir, 'Output', patient_id,
+                                                            'input_reg_mni_label_tumor.nii.gz'))
+    patient = Patient(id=patient_id, patient_id=patient_id, input_folder=patient_dir)
+    step = SizeComputationStep(scratch_folder=os.path.join(test_dir, 'Output', patient_id))
+    step.setup(patient)
+    patient = step.execute()
+    return patient.get_metrics_for_class(get_metrics_target_class()).size_metrics
+
+
+def size_metrics_test():
+    """
+    Computes the size metrics of an empty annotation mask, reported with a zero volume and -1 diameters together with
+    a warning, and of a multifocal annotation mask, whose main component is described within the bounding box.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running size metrics unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_size_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    collector = WarningsCollector()
+    logging.getLogger().addHandler(collector)
+    try:
+        from raidionicsmaps.Utils.resources import SharedResources
+        config = configparser.ConfigParser()
+        config.add_section('Default')
+        config.set('Default', 'task', 'metrics')
+        config.set('Default', 'input_folder', os.path.join(test_dir, 'Cohort'))
+        config.set('Default', 'output_folder', os.path.join(test_dir, 'Output'))
+        config.add_section('Maps')
+        config.set('Maps', 'gt_files_suffix', 'label_tumor.nii.gz')
+        config.set('Maps', 'use_registered_data', 'true')
+        config_filename = os.path.join(test_dir, 'config.ini')
+        with open(config_filename, 'w') as outfile:
+            config.write(outfile)
+        SharedResources.getInstance().set_environment(config_filename)
+
+        shape = (30, 34, 28)
+        metrics = compute_size_metrics(test_dir, 'Pat000', np.zeros(shape, dtype='uint8'))
+        expected = {"Volume (ml)": 0., "Long-axis diameter (mm)": -1., "Short-axis diameter (mm)": -1.,
+                    "Diameter X (mm)": -1., "Diameter Y (mm)": -1., "Diameter Z (mm)": -1.}
+        for k in expected:
+            if metrics[k] != expected[k]:
+                raise ValueError("{} of the empty mask is {} instead of {}.".format(k, metrics[k], expected[k]))
+        if len([m for m in collector.messages if 'Empty annotation mask' in m and 'Pat000' in m]) == 0:
+            raise ValueError("No warning raised for the empty mask.")
+
+        mask = np.zeros(shape, dtype='uint8')
+        mask[5:15, 8:20, 6:12] = 1
+        mask[20:24, 25:28, 20:23] = 1
+        metrics = compute_size_metrics(test_dir, 'Pat001', mask)
+        # Main component described over the whole volume, as reference.
+        main = sorted(regionprops(label(mask)[0]), key=lambda r: r.area, reverse=True)[0]
+        expected = {"Volume (ml)": np.count_nonzero(mask) * 1e-3, "Long-axis diameter (mm)": main.axis_major_length,
+                    "Short-axis diameter (mm)": main.axis_minor_length, "Diameter X (mm)": 10.,
+                    "Diameter Y (mm)": 12., "Diameter Z (mm)": 6.}
+        for k in expected:
+            if not np.isclose(metrics[k], expected[k]):
+                raise ValueError("{} of the multifocal mask is {} instead of {}.".format(k, metrics[k], expected[k]))
+    except Exception as e:
+        logging.error("Error during size metrics unit test with: \n {}.\n".format(traceback.format_exc()))
+        logging.getLogger().removeHandler(collector)
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during size metrics unit test.\n")
+
+    logging.getLogger().removeHandler(collector)
+    logging.info("Size metrics unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+size_metrics_test()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import logging
+import traceback
+
+
+def staging_test():
+    """
+    Stages files with each strategy, ensuring that a symbolic link is never created for a source which may not outlive
+    the staged file, even if the symlink strategy is explicitly requested.
+    """
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.DEBUG)
+    logging.info("Running staging unit test.\n")
+    test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'unit_tests_staging_dir')
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+    os.makedirs(test_dir)
+
+    from raidionicsmaps.Utils.resources import SharedResources
+    default_strategy = SharedResources.getInstance().system_staging_strategy
+    try:
+        from raidionicsmaps.Utils.staging import stage_file
+        src = os.path.join(test_dir, 'source.nii.gz')
+        with open(src, 'wb') as outfile:
+            outfile.write(os.urandom(1024))
+
+        for strategy in ['auto', 'symlink', 'hardlink', 'reflink', 'copy']:
+            SharedResources.getInstance().system_staging_strategy = strategy
+            dst = os.path.join(test_dir, 'staged_' + strategy + '.nii.gz')
+            used = stage_file(src, dst, allow_symlink=False)
+            if used == 'symlink' or os.path.islink(dst):
+                raise ValueError("Symbolic link created with strategy {} while not allowed.".format(strategy))
+            with open(src, 'rb') as infile, open(dst, 'rb') as stagedfile:
+                if infile.read() != stagedfile.read():
+                    raise ValueError("Staged content differs with strategy {}.".format(strategy))
+
+        SharedResources.getInstance().system_staging_strategy = 'symlink'
+        dst = os.path.join(test_dir, 'staged_allowed.nii.gz')
+        if stage_file(src, dst, allow_symlink=True) != 'symlink' or not os.path.islink(dst):
+            raise ValueError("Symbolic link not created with the symlink strategy while allowed.")
+
+        # A staged file must remain readable once its temporary source is removed.
+        dst = os.path.join(test_dir, 'staged_temporary.nii.gz')
+        stage_file(src, dst, allow_symlink=False)
+        os.remove(src)
+        if not os.path.exists(dst) or os.path.getsize(dst) != 1024:
+            raise ValueError("Staged file lost with its temporary source.")
+    except Exception as e:
+        logging.error("Error during staging unit test with: \n {}.\n".format(traceback.format_exc()))
+        SharedResources.getInstance().system_staging_strategy = default_strategy
+        if os.path.exists(test_dir):
+            shutil.rmtree(test_dir)
+        raise ValueError("Error during staging unit test.\n")
+
+    SharedResources.getInstance().system_staging_strategy = default_strategy
+    logging.info("Staging unit test succeeded.\n")
+    if os.path.exists(test_dir):
+        shutil.rmtree(test_dir)
+
+
+staging_test()